@@ -0,0 +1,133 @@
+#!/usr/bin/env python
+
+"""
+announcements.py -- "nearly sold out" announcement
+
+The set of nearly sold out conferences is kept in one durable
+Announcement entity. Registration adds or removes a conference when its
+seat count crosses ANNOUNCEMENT_THRESHOLD, conference updates keep its
+seats and name current, and the announcement text is
+served from memcache with stale-while-revalidate: a stale copy is still
+returned while a task refreshes it from the entity.
+
+"""
+
+import time
+
+from google.appengine.api import memcache
+from google.appengine.api import taskqueue
+from google.appengine.ext import ndb
+
+from models import Announcement
+
+import counters
+
+
+ANNOUNCEMENT_THRESHOLD = 5
+MEMCACHE_ANNOUNCEMENTS_KEY = 'RECENT_ANNOUNCEMENTS'
+MEMCACHE_REFRESH_LOCK_KEY = 'RECENT_ANNOUNCEMENTS_REFRESH'
+# seconds an announcement is served before it is revalidated
+ANNOUNCEMENT_FRESH_TIME = 60
+# conferences whose seats one sweep reads at a time
+SWEEP_BATCH_SIZE = 200
+
+
+def _announcementKey():
+    return ndb.Key(Announcement, 'nearly_sold_out')
+
+
+def _format(announcement):
+    """Return the announcement text of an Announcement entity."""
+    if not announcement or not announcement.conferences:
+        return ''
+    return '%s %s' % (
+        'Last chance to attend! The following conferences '
+        'are nearly sold out:',
+        ', '.join(sorted(announcement.conferences.values())))
+
+
+def _cache(text):
+    memcache.set(MEMCACHE_ANNOUNCEMENTS_KEY,
+        (text, time.time() + ANNOUNCEMENT_FRESH_TIME))
+
+
+@ndb.transactional()
+def _setMember(c_key, name, member):
+    """Add the conference c_key called name to (or remove it from) the
+    nearly sold out set; return the new announcement text, or None if
+    nothing changed."""
+    announcement = _announcementKey().get() or \
+        Announcement(key=_announcementKey())
+    confs = announcement.conferences or {}
+    wsck = c_key.urlsafe()
+    if confs.get(wsck) == (name if member else None):
+        return None
+    if member:
+        confs[wsck] = name
+    else:
+        del confs[wsck]
+    announcement.conferences = confs
+    announcement.put()
+    return _format(announcement)
+
+
+def seatsChanged(conf, resized=False):
+    """Update the announcement after the seat count of conf changed;
+    resized when it was set (or conf renamed) rather than moved by one."""
+    seats = counters.getSeats(conf)
+    # registration moves the count one seat at a time, so membership
+    # can only change around the threshold or at zero
+    if not resized and seats > ANNOUNCEMENT_THRESHOLD + 1:
+        return
+    text = _setMember(conf.key, conf.name,
+        0 < seats <= ANNOUNCEMENT_THRESHOLD)
+    if text is not None:
+        _cache(text)
+
+
+def getAnnouncement():
+    """Return the announcement text, revalidating it if stale."""
+    cached = memcache.get(MEMCACHE_ANNOUNCEMENTS_KEY)
+    if cached is None:
+        return refresh()
+    text, fresh_until = cached
+    # serve the stale text; only one request schedules the refresh
+    if fresh_until < time.time() and \
+            memcache.add(MEMCACHE_REFRESH_LOCK_KEY, 1,
+                time=ANNOUNCEMENT_FRESH_TIME):
+        taskqueue.add(url='/tasks/refresh_announcement')
+    return text
+
+
+def refresh():
+    """Reload the announcement text from the datastore into memcache."""
+    text = _format(_announcementKey().get())
+    _cache(text)
+    return text
+
+
+def sweep(query):
+    """Bring the nearly sold out set in line with the seat counters of
+    the conferences of query, SWEEP_BATCH_SIZE keys at a time; every
+    change goes through _setMember, so registrations may run meanwhile."""
+    announcement = _announcementKey().get()
+    members = dict(announcement.conferences or {}) if announcement else {}
+    # drop conferences deleted since they were added
+    member_keys = [ndb.Key(urlsafe=wsck) for wsck in members]
+    for c_key, conf in zip(member_keys, ndb.get_multi(member_keys)):
+        if not conf:
+            _setMember(c_key, None, False)
+
+    cursor, more = None, True
+    while more:
+        c_keys, cursor, more = query.fetch_page(SWEEP_BATCH_SIZE,
+            start_cursor=cursor, keys_only=True)
+        seats = counters.getSeatsForKeys(c_keys)
+        wanted = set(c_key for c_key in c_keys
+            if 0 < seats[c_key] <= ANNOUNCEMENT_THRESHOLD)
+        changed = [c_key for c_key in c_keys
+            if (c_key.urlsafe() in members) != (c_key in wanted)]
+        for conf in ndb.get_multi(changed):
+            if conf:
+                _setMember(conf.key, conf.name, conf.key in wanted)
+    return refresh()
@@ -0,0 +1,571 @@
+#!/usr/bin/env python
+
+"""
+benchmark.py -- local benchmarks of ConferenceApi against the App Engine
+    service stubs (datastore, memcache, taskqueue, ...)
+
+usage: python benchmark.py [--sdk PATH] [--count N] [--profiles N]
+    [--conferences N] [--sessions N] [--wishlist N] [--documents N]
+    [benchmark ...]
+
+The endpoint benchmarks seed the stub datastore with the given volumes
+and report p50/p95 latency, datastore & memcache RPCs and the entities
+(and keys) read per call. Results are printed as JSON so runs can be
+compared between commits.
+
+"""
+
+import argparse
+import datetime
+import json
+import os
+import random
+import sys
+import time
+
+
+DEFAULT_SDK_PATH = os.environ.get('APPENGINE_SDK',
+    '/usr/local/google_appengine')
+
+USER_EMAIL = 'organizer@example.com'
+
+
+def _fixSysPath(sdk_path):
+    """Make the App Engine SDK and its bundled libraries importable."""
+    sys.path.insert(0, sdk_path)
+    import dev_appserver
+    dev_appserver.fix_sys_path()
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+
+class StubEnvironment(object):
+    """Activates the service stubs an API call needs, logged in as
+    USER_EMAIL."""
+
+    def __init__(self):
+        from google.appengine.datastore import datastore_stub_util
+        from google.appengine.ext import testbed
+
+        self.testbed = testbed.Testbed()
+        self.testbed.activate()
+        self.testbed.init_datastore_v3_stub(consistency_policy=
+            datastore_stub_util.PseudoRandomHRConsistencyPolicy(probability=1))
+        self.testbed.init_memcache_stub()
+        self.testbed.init_taskqueue_stub(
+            root_path=os.path.dirname(os.path.abspath(__file__)))
+        self.testbed.init_urlfetch_stub()
+        self.testbed.init_app_identity_stub()
+        self.testbed.init_mail_stub()
+        self.testbed.setup_env(overwrite=True,
+            ENDPOINTS_AUTH_EMAIL=USER_EMAIL,
+            ENDPOINTS_AUTH_DOMAIN='example.com')
+
+    def login(self, email):
+        """Make email the current endpoints user."""
+        os.environ['ENDPOINTS_AUTH_EMAIL'] = email
+
+    def close(self):
+        self.testbed.deactivate()
+
+
+class RpcCounter(object):
+    """Counts API calls per service and the entities & keys the
+    datastore returned, through an apiproxy post-call hook."""
+
+    def __init__(self):
+        from google.appengine.api import apiproxy_stub_map
+        self.reset()
+        apiproxy_stub_map.apiproxy.GetPostCallHooks().Append(
+            'benchmark', self._hook)
+
+    def reset(self):
+        self.calls = {}
+        self.entities = 0
+        self.keys = 0
+
+    def _hook(self, service, call, request, response):
+        self.calls[service] = self.calls.get(service, 0) + 1
+        if service != 'datastore_v3':
+            return
+        if call == 'Get':
+            self.entities += sum(1 for result in response.entity_list()
+                if result.has_entity())
+        elif call in ('RunQuery', 'Next'):
+            if response.keys_only():
+                self.keys += response.result_size()
+            else:
+                self.entities += response.result_size()
+
+
+def _percentile(values, percent):
+    """Return the nearest-rank percentile of a non-empty list."""
+    values = sorted(values)
+    rank = max(0, int(round(percent / 100.0 * len(values))) - 1)
+    return values[rank]
+
+
+def _measure(counter, calls, setup=None):
+    """Run every call as its own request (fresh ndb context cache) and
+    return latency percentiles and mean RPC/read counts per call."""
+    from google.appengine.ext import ndb
+    latencies, datastore, memcache, entities, keys = [], [], [], [], []
+    for call in calls:
+        if setup:
+            setup()
+        ndb.get_context().clear_cache()
+        counter.reset()
+        start = time.time()
+        call()
+        latencies.append((time.time() - start) * 1000)
+        datastore.append(counter.calls.get('datastore_v3', 0))
+        memcache.append(counter.calls.get('memcache', 0))
+        entities.append(counter.entities)
+        keys.append(counter.keys)
+    mean = lambda values: float(sum(values)) / len(values)
+    return {'calls': len(latencies),
+        'p50_ms': _percentile(latencies, 50),
+        'p95_ms': _percentile(latencies, 95),
+        'datastore_rpcs': mean(datastore),
+        'memcache_rpcs': mean(memcache),
+        'entities_read': mean(entities),
+        'keys_read': mean(keys)}
+
+
+CITIES = ('London', 'Paris', 'Berlin', 'Tokyo', 'Chicago')
+TOPICS = ('Web', 'Mobile', 'Cloud', 'Data', 'Security')
+
+
+def _profileEmail(i):
+    return 'attendee%d@example.com' % i
+
+
+def _seed(args):
+    """Write args.profiles profiles, args.conferences conferences with
+    args.sessions sessions each, and put args.wishlist sessions on every
+    wishlist; return (conference keys, session keys)."""
+    from google.appengine.ext import ndb
+    import counters
+    import registrations
+    from models import Conference
+    from models import Profile
+    from models import Session
+    from models import WishlistEntry
+
+    rand = random.Random(0)
+    p_key = ndb.Key(Profile, USER_EMAIL)
+    confs = []
+    for i in range(args.conferences):
+        start = datetime.date(2015, 1, 1) + datetime.timedelta(days=i % 365)
+        confs.append(Conference(parent=p_key, name='Conference %05d' % i,
+            city=CITIES[i % len(CITIES)], topics=[TOPICS[i % len(TOPICS)]],
+            startDate=start, month=start.month, endDate=start,
+            maxAttendees=rand.choice((50, 100, 500, 1000, 5000)),
+            organizerUserId=USER_EMAIL, organizerDisplayName='Organizer'))
+        confs[-1].seatsAvailable = confs[-1].maxAttendees
+    c_keys = ndb.put_multi(confs)
+    counters.initSeatsMulti([(conf.key, conf.seatsAvailable)
+        for conf in confs])
+
+    sessions = [Session(parent=c_key, name='Session %d' % i,
+        speaker='Speaker %d' % rand.randrange(100), sessionType=rand.choice(
+            ('lecture', 'workshop', 'keynote')),
+        date=datetime.date(2015, 7, 1), startTime=datetime.time(9 + i % 8),
+        duration=1) for c_key in c_keys for i in range(args.sessions)]
+    s_keys = ndb.put_multi(sessions)
+
+    entities = []
+    for i in range(args.profiles):
+        prof = Profile(id=_profileEmail(i), displayName='Attendee %d' % i,
+            mainEmail=_profileEmail(i))
+        entities.append(prof)
+        entities.extend(WishlistEntry(key=registrations.wishlistKey(
+            prof.key, s_key), session=s_key) for s_key in
+            rand.sample(s_keys, min(args.wishlist, len(s_keys))))
+    ndb.put_multi(entities)
+    return c_keys, s_keys
+
+
+# (name, filters) mixes of queryConferences; the second filter of a
+# mix is applied in memory by the query planner
+QUERY_MIXES = (
+    ('all', []),
+    ('city', [('CITY', 'EQ', 'London')]),
+    ('month', [('MONTH', 'EQ', '7')]),
+    ('city_max_attendees', [('CITY', 'EQ', 'Paris'),
+        ('MAX_ATTENDEES', 'GT', '100')]),
+    ('topic_month_range', [('TOPIC', 'EQ', 'Cloud'),
+        ('MONTH', 'GTEQ', '6')]),
+)
+
+
+def benchQueryConferences(args, env):
+    """queryConferences with each filter mix, with the memcache flushed
+    before every call (cold) and with warm caches."""
+    from google.appengine.api import memcache
+    from conference import ConferenceApi
+    from models import ConferenceQueryForm
+    from models import ConferenceQueryForms
+    _seed(args)
+    counter = RpcCounter()
+
+    results = {}
+    for name, filters in QUERY_MIXES:
+        request = ConferenceQueryForms(filters=[ConferenceQueryForm(
+            field=field, operator=operator, value=value)
+            for field, operator, value in filters])
+        call = lambda: ConferenceApi().queryConferences(request)
+        results[name + '_cold'] = _measure(counter, [call] * args.count,
+            setup=memcache.flush_all)
+        results[name + '_warm'] = _measure(counter, [call] * args.count)
+    return results
+
+
+def benchWishlist(args, env):
+    """getSessionsInWishlist of profiles with args.wishlist sessions."""
+    from conference import ConferenceApi
+    from protorpc import message_types
+    _seed(args)
+    counter = RpcCounter()
+
+    def call(i):
+        def run():
+            env.login(_profileEmail(i % args.profiles))
+            return ConferenceApi().getSessionsInWishlist(
+                message_types.VoidMessage())
+        return run
+    calls = [call(i) for i in range(args.count)]
+    return {'getSessionsInWishlist': _measure(counter, calls)}
+
+
+def benchRegistration(args, env):
+    """registerForConference/unregisterFromConference (both through
+    _conferenceRegistration) by different profiles."""
+    from conference import ConferenceApi
+    from conference import CONF_GET_REQUEST
+    c_keys, s_keys = _seed(args)
+    counter = RpcCounter()
+    rand = random.Random(1)
+
+    pairs = [(_profileEmail(i % args.profiles),
+        rand.choice(c_keys[:10]).urlsafe()) for i in range(args.count)]
+    # the same profile can't register twice for a conference
+    pairs = sorted(set(pairs))
+
+    def call(method, email, wsck):
+        def run():
+            env.login(email)
+            getattr(ConferenceApi(), method)(
+                CONF_GET_REQUEST.combined_message_class(
+                    websafeConferenceKey=wsck))
+        return run
+    return {
+        'registerForConference': _measure(counter,
+            [call('registerForConference', *pair) for pair in pairs]),
+        'unregisterFromConference': _measure(counter,
+            [call('unregisterFromConference', *pair) for pair in pairs])}
+
+
+def benchQueuedRegistration(args, env):
+    """registerForConference of conferences in queued registration mode,
+    then the worker committing the reservations."""
+    from google.appengine.ext import ndb
+    from conference import ConferenceApi
+    from conference import CONF_GET_REQUEST
+    c_keys = _seed(args)[0]
+    confs = ndb.get_multi(c_keys[:10])
+    for conf in confs:
+        conf.queuedRegistration = True
+    ndb.put_multi(confs)
+    counter = RpcCounter()
+    rand = random.Random(1)
+
+    pairs = sorted(set((_profileEmail(i % args.profiles),
+        rand.choice(c_keys[:10]).urlsafe()) for i in range(args.count)))
+
+    def call(email, wsck):
+        def run():
+            env.login(email)
+            ConferenceApi().registerForConference(
+                CONF_GET_REQUEST.combined_message_class(
+                    websafeConferenceKey=wsck))
+        return run
+    results = {'registerForConference': _measure(counter,
+        [call(*pair) for pair in pairs])}
+
+    def drain():
+        while ConferenceApi._commitReservations():
+            pass
+    results['commit_seconds'] = _timed(drain)[1]
+    results['reservations'] = len(pairs)
+    return results
+
+
+# head of the search corpus vocabulary, the long tail is generated
+SEARCH_WORDS = ('cloud data web mobile security python design summit '
+    'developer machine learning startup product marketing devops open '
+    'source database network game music health finance science').split()
+
+# (name, query) mixes of searchConferences, from the term in every
+# document to the long tail
+SEARCH_MIXES = (
+    ('every_document', 'conference'),
+    ('common', 'cloud'),
+    ('mid', 'open'),
+    ('rare', 'topic4000'),
+    ('common_and_common', 'cloud data'),
+    ('common_and_rare', 'cloud topic4000'),
+)
+
+
+def benchSearch(args, env):
+    """searchConferences over args.documents conferences with skewed
+    word frequencies, then incremental indexing of new conferences
+    against the full index."""
+    from google.appengine.ext import ndb
+    import search
+    from conference import ConferenceApi
+    from conference import SEARCH_REQUEST
+    from models import Conference
+
+    rand = random.Random(0)
+    vocabulary = SEARCH_WORDS + ['topic%d' % i for i in range(5000)]
+
+    def words(n):
+        # cubed uniform numbers skew towards the head of the vocabulary
+        return ' '.join(vocabulary[int(len(vocabulary) * rand.random() ** 3)]
+            for i in range(n))
+
+    p_key = ndb.Key('Profile', USER_EMAIL)
+    confs = [Conference(id=i + 1, parent=p_key,
+        name='Conference %s' % words(3), description=words(20),
+        city=CITIES[i % len(CITIES)], topics=[TOPICS[i % len(TOPICS)]],
+        organizerUserId=USER_EMAIL) for i in range(args.documents)]
+    for i in range(0, len(confs), 1000):
+        ndb.put_multi(confs[i:i + 1000])
+    build = _timed(search.buildIndex, confs)[1]
+    counter = RpcCounter()
+
+    results = {'documents': args.documents, 'build_seconds': build}
+    for name, query in SEARCH_MIXES:
+        request = SEARCH_REQUEST.combined_message_class(query=query)
+        results[name] = _measure(counter, [lambda: ConferenceApi()
+            .searchConferences(request)] * args.count)
+
+    new = [Conference(id=args.documents + i + 1, parent=p_key,
+        name='Conference %s' % words(3), description=words(20),
+        organizerUserId=USER_EMAIL) for i in range(args.count)]
+    ndb.put_multi(new)
+    results['index_document'] = _measure(counter,
+        [lambda conf=conf: search.indexDocuments([conf]) for conf in new])
+    return results
+
+
+def _timed(func, *args):
+    """Return (result, seconds) of func(*args)."""
+    start = time.time()
+    result = func(*args)
+    return result, time.time() - start
+
+
+def _createConference(api, name='Benchmark Conference', maxAttendees=100):
+    """Create a conference through the batch API, return its websafe key."""
+    from models import ConferenceForm
+    from models import ConferenceForms
+    result = api.createConferencesBatch(ConferenceForms(items=[
+        ConferenceForm(name=name, city='London', topics=['Benchmark'],
+            startDate='2015-07-01', maxAttendees=maxAttendees)]))
+    return result.items[0].websafeKey
+
+
+def _sessionForm(i):
+    from models import SessionForm
+    return SessionForm(name='Session %d' % i, speaker='Speaker %d' % (i % 7),
+        sessionType='lecture', date='2015-07-01', startTime='10:00',
+        duration=1)
+
+
+def benchCreateSessions(args, env):
+    """N createSession calls vs. one createSessionsBatch of N items."""
+    count = args.count
+    from conference import ConferenceApi
+    from conference import SESSION_BATCH_POST_REQUEST
+    from conference import SESSION_POST_REQUEST
+    api = ConferenceApi()
+
+    wsck = _createConference(api)
+    requests = []
+    for i in range(count):
+        form = _sessionForm(i)
+        request = SESSION_POST_REQUEST.combined_message_class(
+            websafeConferenceKey=wsck)
+        for field in form.all_fields():
+            setattr(request, field.name, getattr(form, field.name))
+        requests.append(request)
+    start = time.time()
+    for request in requests:
+        api.createSession(request)
+    single = time.time() - start
+
+    wsck = _createConference(api, 'Benchmark Conference (batch)')
+    result, batch = _timed(api.createSessionsBatch,
+        SESSION_BATCH_POST_REQUEST.combined_message_class(
+            websafeConferenceKey=wsck,
+            items=[_sessionForm(i) for i in range(count)]))
+    assert all(item.success for item in result.items)
+
+    return {'items': count, 'single_seconds': single,
+        'batch_seconds': batch, 'speedup': single / batch}
+
+
+def benchCreateConferences(args, env):
+    """N createConference calls vs. one createConferencesBatch of N items."""
+    count = args.count
+    from conference import ConferenceApi
+    from models import ConferenceForm
+    from models import ConferenceForms
+    api = ConferenceApi()
+
+    def form(i):
+        return ConferenceForm(name='Conference %d' % i, city='London',
+            startDate='2015-07-01', maxAttendees=100)
+
+    start = time.time()
+    for i in range(count):
+        api.createConference(form(i))
+    single = time.time() - start
+
+    result, batch = _timed(api.createConferencesBatch,
+        ConferenceForms(items=[form(i) for i in range(count)]))
+    assert all(item.success for item in result.items)
+
+    return {'items': count, 'single_seconds': single,
+        'batch_seconds': batch, 'speedup': single / batch}
+
+
+def benchNotifications(args, env):
+    """Enqueue N notifications for a few recipients, then drain the
+    pull queue with the notification worker."""
+    count = args.count
+    import notifications
+    recipients = ['user%d@example.com' % i for i in range(max(1, count // 10))]
+    batch = [(recipients[i % len(recipients)], 'Notification %d' % i,
+        'Body of notification %d' % i) for i in range(count)]
+
+    rpc, enqueue = _timed(notifications.enqueueAsync, batch)
+    rpc.get_result()
+    leased, drain = _timed(notifications.run)
+    assert leased == count
+    mails = env.testbed.get_stub('mail').get_sent_messages()
+    # one digest per recipient
+    assert sorted(mail.to for mail in mails) == sorted(recipients)
+
+    return {'items': count, 'mails': len(mails),
+        'enqueue_seconds': enqueue, 'drain_seconds': drain,
+        'notifications_per_second': count / drain}
+
+
+def _reflectiveCopy(entity, form_class):
+    """The per-field reflection the _copy*ToForm methods used before
+    mappers.py, kept as the baseline of benchMappers."""
+    form = form_class()
+    for field in form.all_fields():
+        if hasattr(entity, field.name):
+            value = getattr(entity, field.name)
+            if field.name.endswith('Date') or field.name.endswith('date') \
+                    or field.name.endswith('Time'):
+                value = str(value) if value is not None else None
+            setattr(form, field.name, value)
+        elif field.name == 'websafeKey':
+            setattr(form, field.name, entity.key.urlsafe())
+    form.check_initialized()
+    return form
+
+
+def benchMappers(args, env):
+    """Convert N in-memory conferences & sessions with the reflective
+    copy vs. the precompiled mappers."""
+    count = args.count
+    import datetime
+    import mappers
+    from google.appengine.ext import ndb
+    from models import Conference
+    from models import ConferenceForm
+    from models import Session
+    from models import SessionForm
+
+    p_key = ndb.Key('Profile', USER_EMAIL)
+    confs = [Conference(key=ndb.Key(Conference, i + 1, parent=p_key),
+        name='Conference %d' % i, city='London', topics=['Benchmark'],
+        startDate=datetime.date(2015, 7, 1), month=7, maxAttendees=100,
+        seatsAvailable=100, endDate=datetime.date(2015, 7, 2),
+        organizerUserId=USER_EMAIL) for i in range(count)]
+    sessions = [Session(key=ndb.Key(Session, i + 1, parent=confs[0].key),
+        name='Session %d' % i, speaker='Speaker %d' % (i % 7),
+        sessionType='lecture', date=datetime.date(2015, 7, 1),
+        startTime=datetime.time(10, 0), duration=1) for i in range(count)]
+
+    results = {'items': count}
+    for name, entities, form_class in (
+            ('conference', confs, ConferenceForm),
+            ('session', sessions, SessionForm)):
+        mapper = mappers.getMapper(type(entities[0]), form_class)
+        old, reflective = _timed(lambda: [_reflectiveCopy(entity,
+            form_class) for entity in entities])
+        new, mapped = _timed(mapper.toForms, entities)
+        # second pass with the websafe key cache warm
+        new, cached = _timed(mapper.toForms, entities)
+        assert old == new
+        results.update({
+            '%s_reflective_seconds' % name: reflective,
+            '%s_mapper_seconds' % name: mapped,
+            '%s_mapper_cached_keys_seconds' % name: cached,
+            '%s_speedup' % name: reflective / mapped})
+    return results
+
+
+BENCHMARKS = {
+    'create_sessions': benchCreateSessions,
+    'create_conferences': benchCreateConferences,
+    'notifications': benchNotifications,
+    'mappers': benchMappers,
+    'query_conferences': benchQueryConferences,
+    'wishlist': benchWishlist,
+    'registration': benchRegistration,
+    'queued_registration': benchQueuedRegistration,
+    'search': benchSearch,
+}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip())
+    parser.add_argument('--sdk', default=DEFAULT_SDK_PATH,
+        help='App Engine SDK directory (default: $APPENGINE_SDK)')
+    parser.add_argument('--count', type=int, default=200,
+        help='number of items (or calls) per benchmark')
+    parser.add_argument('--profiles', type=int, default=100,
+        help='profiles to seed')
+    parser.add_argument('--conferences', type=int, default=500,
+        help='conferences to seed')
+    parser.add_argument('--sessions', type=int, default=5,
+        help='sessions to seed per conference')
+    parser.add_argument('--wishlist', type=int, default=100,
+        help='sessions on every seeded wishlist')
+    parser.add_argument('--documents', type=int, default=100000,
+        help='conferences in the search corpus')
+    parser.add_argument('benchmarks', nargs='*', default=sorted(BENCHMARKS),
+        choices=sorted(BENCHMARKS), metavar='benchmark')
+    args = parser.parse_args()
+    _fixSysPath(args.sdk)
+
+    results = {}
+    for name in args.benchmarks:
+        env = StubEnvironment()
+        try:
+            results[name] = BENCHMARKS[name](args, env)
+        finally:
+            env.close()
+    print(json.dumps(results, indent=2, sort_keys=True))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,67 @@
+#!/usr/bin/env python
+
+"""
+buckets.py -- calendar buckets of Session dates
+
+Sessions store the year, season and ISO week they fall in, so a query
+for a whole bucket is one equality filter instead of a date range scan.
+
+"""
+
+from datetime import date
+from datetime import timedelta
+
+
+# (name, month, day) on which each season starts; winter runs into the
+# next year and is labelled with the year it starts in
+SEASONS = (
+    ('winter', 1, 1),
+    ('spring', 3, 20),
+    ('summer', 6, 21),
+    ('autumn', 9, 23),
+    ('winter', 12, 21),
+)
+
+
+def yearOf(d):
+    return d.year if d else None
+
+
+def seasonOf(d):
+    """Return e.g. '2015-summer' for a date."""
+    if not d:
+        return None
+    for name, month, day in reversed(SEASONS):
+        if (d.month, d.day) >= (month, day):
+            year = d.year if (month, day) != (1, 1) else d.year - 1
+            return '%d-%s' % (year, name)
+
+
+def weekOf(d):
+    """Return the ISO week of a date, e.g. '2015-W26'."""
+    if not d:
+        return None
+    return '%d-W%02d' % d.isocalendar()[:2]
+
+
+def _seasonBounds(d):
+    """Return (first, last) date of the season d falls in."""
+    starts = [date(year, month, day) for year in (d.year - 1, d.year,
+        d.year + 1) for name, month, day in SEASONS[1:]]
+    first = max(start for start in starts if start <= d)
+    last = min(start for start in starts if start > d) - timedelta(days=1)
+    return first, last
+
+
+def bucketFor(first, last):
+    """Return (property name, value) of the bucket spanning exactly
+    first..last (inclusive), or None if the range is not a bucket."""
+    if not first or not last:
+        return None
+    if first == date(first.year, 1, 1) and last == date(first.year, 12, 31):
+        return 'year', first.year
+    if (first, last) == _seasonBounds(first):
+        return 'season', seasonOf(first)
+    if first.weekday() == 0 and last - first == timedelta(days=6):
+        return 'week', weekOf(first)
+    return None
@@ -16,9 +16,9 @@ Project 4: Conference Organisation App
 __author__ = 'amhar.ford@gmail.com'
 
 
-from datetime import datetime
+import logging
 from datetime import date
-from datetime import time
+from datetime import datetime
 
 import endpoints
 
@@ -26,37 +26,87 @@ from protorpc import messages
 from protorpc import message_types
 from protorpc import remote
 
-from google.appengine.api import memcache
 from google.appengine.api import taskqueue
 
+from google.appengine.datastore.datastore_query import Cursor
 from google.appengine.ext import ndb
+from google.appengine.api import datastore_errors
 
 from models import ConflictException
 from models import Profile
+from models import Registration
+from models import Reservation
+from models import WishlistEntry
 from models import ProfileMiniForm
 from models import ProfileForm
 from models import BooleanMessage
+from models import RegistrationResultForm
+from models import ReservationForm
 from models import Conference
 from models import ConferenceForm
 from models import ConferenceForms
+from models import ConferenceSummaryForm
 from models import ConferenceQueryForm
 from models import ConferenceQueryForms
 from models import TeeShirtSize
+from models import TeeShirtCount
+from models import TeeShirtCounts
+from models import AttendeeForm
+from models import AttendeeForms
+from models import RosterEntryForm
+from models import RosterForms
 from models import StringMessage
+from models import BatchResultForm
+from models import BatchResultForms
 from models import Session
 from models import SessionForm
 from models import SessionForms
+from models import SessionSummaryForm
+from models import ListView
 
 
 from utils import getUserId
 
+import announcements
+import buckets
+import counters
+import histograms
+import instrumentation
+import mappers
+import notifications
+import planner
+import profiles
+import querycache
+import registrations
+import reservations
+import responses
+import roster
+import search
+import speakers
+
 from settings import WEB_CLIENT_ID
 
 
 EMAIL_SCOPE = endpoints.EMAIL_SCOPE
 API_EXPLORER_CLIENT_ID = endpoints.API_EXPLORER_CLIENT_ID
-MEMCACHE_ANNOUNCEMENTS_KEY = "RECENT_ANNOUNCEMENTS"
-MEMCACHE_FEATURED_SPEAKER_KEY = 'FEATURED_SPEAKER'
+DEFAULT_PAGE_SIZE = 20
+# batch size of background jobs walking many entities
+BATCH_SIZE = 100
+MAX_PAGE_SIZE = 100
+# indexed properties read by the projection queries of the SUMMARY
+# view, see the matching composite indexes in index.yaml
+CONFERENCE_SUMMARY_FIELDS = ('name', 'city', 'startDate', 'endDate')
+SESSION_SUMMARY_FIELDS = ('name', 'speaker', 'sessionType', 'date',
+    'startTime')
+
+# entity -> form converters, see mappers.py
+CONFERENCE_MAPPER = mappers.getMapper(Conference, ConferenceForm)
+CONFERENCE_SUMMARY_MAPPER = mappers.getMapper(Conference,
+    ConferenceSummaryForm)
+SESSION_MAPPER = mappers.getMapper(Session, SessionForm)
+SESSION_SUMMARY_MAPPER = mappers.getMapper(Session, SessionSummaryForm)
+PROFILE_MAPPER = mappers.getMapper(Profile, ProfileForm)
+RESERVATION_MAPPER = mappers.getMapper(Reservation, ReservationForm)
 
 # - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
 
@@ -92,6 +142,17 @@ FIELDS =    {
             'TYPE': 'sessionType',
             }
 
+PAGE_REQUEST = endpoints.ResourceContainer(
+    message_types.VoidMessage,
+    pageSize=messages.IntegerField(1, variant=messages.Variant.INT32),
+    pageToken=messages.StringField(2),
+)
+
+VIEW_REQUEST = endpoints.ResourceContainer(
+    message_types.VoidMessage,
+    view=messages.EnumField(ListView, 1, default='FULL'),
+)
+
 CONF_GET_REQUEST = endpoints.ResourceContainer(
     message_types.VoidMessage,
     websafeConferenceKey=messages.StringField(1),
@@ -102,12 +163,33 @@ CONF_POST_REQUEST = endpoints.ResourceContainer(
     websafeConferenceKey=messages.StringField(1),
 )
 
+CONF_PAGE_REQUEST = endpoints.ResourceContainer(
+    message_types.VoidMessage,
+    websafeConferenceKey=messages.StringField(1),
+    pageSize=messages.IntegerField(2, variant=messages.Variant.INT32),
+    pageToken=messages.StringField(3),
+)
+
+RESERVATION_GET_REQUEST = endpoints.ResourceContainer(
+    message_types.VoidMessage,
+    websafeReservationKey=messages.StringField(1),
+)
+
+CONF_SHARDS_REQUEST = endpoints.ResourceContainer(
+    message_types.VoidMessage,
+    websafeConferenceKey=messages.StringField(1),
+    shards=messages.IntegerField(2, variant=messages.Variant.INT32),
+)
+
 SESSION_GET_REQUEST = endpoints.ResourceContainer(
     message_types.VoidMessage,
     websafeConferenceKey=messages.StringField(1),
     sessionType=messages.StringField(2),
     sessionSpeaker=messages.StringField(3),
     websafeSessionKey=messages.StringField(4),
+    pageSize=messages.IntegerField(5, variant=messages.Variant.INT32),
+    pageToken=messages.StringField(6),
+    view=messages.EnumField(ListView, 7, default='FULL'),
 )
 
 SESSION_POST_REQUEST = endpoints.ResourceContainer(
@@ -116,14 +198,52 @@ SESSION_POST_REQUEST = endpoints.ResourceContainer(
     
 )
 
+SESSION_BATCH_POST_REQUEST = endpoints.ResourceContainer(
+    SessionForms,
+    websafeConferenceKey=messages.StringField(1),
+)
+
+SESSION_QUERY_REQUEST = endpoints.ResourceContainer(
+    message_types.VoidMessage,
+    startDate=messages.StringField(1),
+    endDate=messages.StringField(2),
+    websafeConferenceKey=messages.StringField(3),
+    sessionType=messages.StringField(4),
+    speaker=messages.StringField(5),
+    pageSize=messages.IntegerField(6, variant=messages.Variant.INT32),
+    pageToken=messages.StringField(7),
+)
+
+TIME_OF_DAY_GET_REQUEST = endpoints.ResourceContainer(
+    message_types.VoidMessage,
+    excludeWorkshops=messages.BooleanField(1, default=True),
+    startAfter=messages.StringField(2),
+    startBefore=messages.StringField(3),
+    pageSize=messages.IntegerField(4, variant=messages.Variant.INT32),
+    pageToken=messages.StringField(5),
+)
+
 #I have seperate get request template for the sake of testing out how this works
 #in the API endpoint
+SEARCH_REQUEST = endpoints.ResourceContainer(
+    message_types.VoidMessage,
+    query=messages.StringField(1),
+    pageSize=messages.IntegerField(2, variant=messages.Variant.INT32),
+    pageToken=messages.StringField(3),
+)
+
 SPEAKER_SESSION_GET_REQUEST = endpoints.ResourceContainer(
     message_types.VoidMessage,
     speaker=messages.StringField(1),
+    pageSize=messages.IntegerField(2, variant=messages.Variant.INT32),
+    pageToken=messages.StringField(3),
 )
 
 
+def _chunks(items, size):
+    """Split a list into lists of at most size items."""
+    return [items[i:i + size] for i in range(0, len(items), size)]
+
 # - - - Create Conference API endpoint - - - - - - - - - - - - - - 
 
 
@@ -135,18 +255,22 @@ class ConferenceApi(remote.Service):
 
 # - - - Conference objects - - - - - - - - - - - - - - - - - - - -
 
-    @endpoints.method(ConferenceForm, ConferenceForm, path='conference',
+    @instrumentation.method(ConferenceForm, ConferenceForm, path='conference',
             http_method='POST', name='createConference')
     def createConference(self, request):
         """Create new conference."""
         return self._createConferenceObject(request)
 
-    @endpoints.method(CONF_POST_REQUEST, ConferenceForm,
+    @instrumentation.method(CONF_POST_REQUEST, ConferenceForm,
             path='conference/{websafeConferenceKey}',
             http_method='PUT', name='updateConference')
     def updateConference(self, request):
         """Update conference w/provided fields & return w/updated info."""
-        return self._updateConferenceObject(request)
+        form = self._updateConferenceObject(request)
+        # postings are separate entity groups, index after commit
+        search.indexDocuments(
+            [ndb.Key(urlsafe=request.websafeConferenceKey).get()])
+        return form
 
     def _createConferenceObject(self, request):
         """Create or update Conference object, return 
@@ -156,7 +280,53 @@ class ConferenceApi(remote.Service):
         if not user:
             raise endpoints.UnauthorizedException('Authorization required')
         user_id = getUserId(user)
+        data = self._conferenceData(request, user_id,
+            self._organizerName(user, user_id))
+
+        # generate Profile Key based on user ID and Conference
+        # ID based on Profile key get Conference key from ID
+        p_key = ndb.Key(Profile, user_id)
+        c_id = Conference.allocate_ids(size=1, parent=p_key)[0]
+        c_key = ndb.Key(Conference, c_id, parent=p_key)
+        data['key'] = c_key
 
+        # create Conference, send email to organizer confirming
+        # creation of Conference & return (modified) ConferenceForm
+        conf = Conference(**data)
+        conf.put()
+        # only once the conference is stored, so a failed put sends no mail
+        rpc = notifications.enqueueAsync(
+            [self._confirmationNotification(user, request)])
+        querycache.invalidate()
+        search.indexDocuments([conf])
+        counters.initSeats(c_key, data['seatsAvailable'])
+        rpc.get_result()
+        
+        return request
+
+    def _confirmationNotification(self, user, request):
+        """Return the (recipient, subject, body) notification confirming
+        creation of the conference in ConferenceForm request."""
+        details = [('Name', request.name),
+            ('Description', request.description),
+            ('City', request.city),
+            ('Topics', ', '.join(request.topics or [])),
+            ('Start date', request.startDate),
+            ('End date', request.endDate),
+            ('Max attendees', request.maxAttendees)]
+        return (user.email(), 'You created a new Conference!',
+            'Hi, you have created the following conference:\r\n\r\n%s' %
+            '\r\n'.join('%s: %s' % (label, value) for label, value
+                in details if value not in (None, '')))
+
+    def _organizerName(self, user, user_id):
+        """Return the display name to store on a new conference."""
+        prof = self._getProfile(user_id)
+        return getattr(prof, 'displayName', None) or user.nickname()
+
+    def _conferenceData(self, request, user_id, organizer_name):
+        """Validate ConferenceForm request and return the property dict
+        of a new Conference (without key); fills in request defaults."""
         if not request.name:
             raise endpoints.BadRequestException(
                 "Conference 'name' field required")
@@ -165,7 +335,6 @@ class ConferenceApi(remote.Service):
         data = {field.name: getattr(request, field.name) for field in \
                 request.all_fields()}
         del data['websafeKey']
-        del data['organizerDisplayName']
 
         # add default values for those missing (both data model & outbound Message)
         for df in DEFAULTS:
@@ -187,25 +356,78 @@ class ConferenceApi(remote.Service):
         # set seatsAvailable to be same as maxAttendees on creation
         if data["maxAttendees"] > 0:
             data["seatsAvailable"] = data["maxAttendees"]
-        # generate Profile Key based on user ID and Conference
-        # ID based on Profile key get Conference key from ID
-        p_key = ndb.Key(Profile, user_id)
-        c_id = Conference.allocate_ids(size=1, parent=p_key)[0]
-        c_key = ndb.Key(Conference, c_id, parent=p_key)
-        data['key'] = c_key
         data['organizerUserId'] = request.organizerUserId = user_id
 
-        # create Conference, send email to organizer confirming
-        # creation of Conference & return (modified) ConferenceForm
-        Conference(**data).put()
-        taskqueue.add(params={'email': user.email(),
-            'conferenceInfo': repr(request)},
-            url='/tasks/send_confirmation_email'
-        )
-        
-        return request
+        # store a snapshot of the organizer's name so listings need not
+        # fetch the organizer Profile
+        data['organizerDisplayName'] = request.organizerDisplayName = \
+            organizer_name
+        return data
+
+    @instrumentation.method(ConferenceForms, BatchResultForms,
+            path='conferences/batch',
+            http_method='POST', name='createConferencesBatch')
+    def createConferencesBatch(self, request):
+        """Create many conferences at once; report success per item."""
+        user = endpoints.get_current_user()
+        if not user:
+            raise endpoints.UnauthorizedException('Authorization required')
+        user_id = getUserId(user)
+        organizer_name = self._organizerName(user, user_id)
 
-    @ndb.transactional()
+        results = [BatchResultForm(index=i) for i in range(len(request.items))]
+        confs = []
+        for i, form in enumerate(request.items):
+            try:
+                confs.append((i, form, Conference(**self._conferenceData(
+                    form, user_id, organizer_name))))
+            except (endpoints.BadRequestException, ValueError,
+                    datastore_errors.BadValueError) as e:
+                results[i].error = str(e)
+        if not confs:
+            return BatchResultForms(items=results)
+
+        # one id range for the whole batch
+        p_key = ndb.Key(Profile, user_id)
+        first, last = Conference.allocate_ids(size=len(confs), parent=p_key)
+        for (i, form, conf), c_id in zip(confs, range(first, last + 1)):
+            conf.key = ndb.Key(Conference, c_id, parent=p_key)
+
+        rpcs = []
+        for chunk in _chunks(confs, BATCH_SIZE):
+            try:
+                ndb.put_multi([conf for i, form, conf in chunk])
+            except datastore_errors.Error as e:
+                for i, form, conf in chunk:
+                    results[i].error = str(e)
+                continue
+            for i, form, conf in chunk:
+                results[i].success = True
+                results[i].websafeKey = conf.key.urlsafe()
+            querycache.invalidate()
+            # confirmation emails, enqueued a chunk at a time while the
+            # next chunk is written
+            rpcs.append(notifications.enqueueAsync(
+                [self._confirmationNotification(user, form)
+                    for i, form, conf in chunk]))
+            # the conferences are stored; a missing seat counter is
+            # created from seatsAvailable on first use and
+            # /tasks/index_conferences indexes what is left out here
+            try:
+                counters.initSeatsMulti([(conf.key, conf.seatsAvailable)
+                    for i, form, conf in chunk])
+                search.indexDocuments([conf for i, form, conf in chunk])
+            except datastore_errors.Error:
+                logging.exception('Initializing batch conferences failed')
+        for rpc in rpcs:
+            try:
+                rpc.get_result()
+            except taskqueue.Error:
+                logging.exception('Enqueueing confirmations failed')
+
+        return BatchResultForms(items=results)
+
+    @ndb.transactional(xg=True)
     def _updateConferenceObject(self, request):
         user = endpoints.get_current_user()
         if not user:
@@ -232,8 +454,10 @@ class ConferenceApi(remote.Service):
         # copy relevant fields from ConferenceForm to Conference object
         for field in request.all_fields():
             data = getattr(request, field.name)
-            # only copy fields where we get data
-            if data not in (None, []):
+            # only copy fields where we get data; the organizer name
+            # is taken from the Profile below
+            if data not in (None, []) and \
+                    field.name != 'organizerDisplayName':
                 # special handling for dates (convert string to Date)
                 if field.name in ('startDate', 'endDate'):
                     data = datetime.strptime(data, "%Y-%m-%d").date()
@@ -241,25 +465,47 @@ class ConferenceApi(remote.Service):
                         conf.month = data.month
                 # write to Conference object
                 setattr(conf, field.name, data)
+        # Profile is the parent of Conference, so this read stays
+        # within the entity group
+        prof = self._getProfile(user_id)
+        if prof:
+            conf.organizerDisplayName = prof.displayName
         conf.put()
-        prof = ndb.Key(Profile, user_id).get()
-        return self._copyConferenceToForm(conf, getattr(prof, 'displayName'))
-
-    @endpoints.method(CONF_GET_REQUEST, ConferenceForm,
+        # seats are held by the sharded counter, reset it when given
+        seats = None
+        if request.seatsAvailable is not None:
+            seats = counters.resizeCounter(conf, seats=request.seatsAvailable)
+        if request.seatsAvailable is not None or request.name:
+            # seats may have jumped across the threshold, or the listed
+            # name changed
+            ndb.get_context().call_on_commit(
+                lambda: announcements.seatsChanged(conf, resized=True))
+        responses.bump(conf.key)
+        querycache.invalidate()
+        return self._copyConferenceToForm(conf, seats)
+
+    @instrumentation.method(CONF_GET_REQUEST, ConferenceForm,
             path='conference/{websafeConferenceKey}',
             http_method='GET', name='getConference')
     def getConference(self, request):
         """Return requested conference (by websafeConferenceKey)."""
-        # get Conference object from request; bail if not found
-        conf = ndb.Key(urlsafe=request.websafeConferenceKey).get()
-        if not conf:
-            raise endpoints.NotFoundException(
-                'No conference found with key: %s' % request.websafeConferenceKey)
-        prof = conf.key.parent().get()
-        # return ConferenceForm
-        return self._copyConferenceToForm(conf, getattr(prof, 'displayName'))
-
-    @endpoints.method(message_types.VoidMessage, ConferenceForms,
+        conf_key = ndb.Key(urlsafe=request.websafeConferenceKey)
+
+        def build():
+            # get Conference object from request; bail if not found
+            conf = conf_key.get()
+            if not conf:
+                raise endpoints.NotFoundException(
+                    'No conference found with key: %s'
+                    % request.websafeConferenceKey)
+            # the response is cached for longer than the seat aggregate,
+            # so count the shards
+            return self._copyConferenceToForm(conf,
+                counters.getExactSeats(conf))
+        return responses.getResponse('getConference', conf_key, request,
+            ConferenceForm, build)
+
+    @instrumentation.method(PAGE_REQUEST, ConferenceForms,
             path='getConferencesCreated',
             http_method='POST', name='getConferencesCreated')
     def getConferencesCreated(self, request):
@@ -270,79 +516,128 @@ class ConferenceApi(remote.Service):
             raise endpoints.UnauthorizedException('Authorization required')
         user_id =  getUserId(user)
         # create ancestor query for all key matches for this user
-        confs = Conference.query(ancestor=ndb.Key(Profile, user_id))
-        prof = ndb.Key(Profile, user_id).get()
+        confs, next_token = self._fetchPage(
+            Conference.query(ancestor=ndb.Key(Profile, user_id)), request)
         # return set of ConferenceForm objects per Conference
-        return ConferenceForms(
-            items=[self._copyConferenceToForm(conf, 
-                getattr(prof, 'displayName')) for conf in confs]
-        )
-
-    def _copyConferenceToForm(self, conf, displayName):
-        """Copy relevant fields from Conference to ConferenceForm."""
-        cf = ConferenceForm()
-        for field in cf.all_fields():
-            if hasattr(conf, field.name):
-                # convert Date to date string; just copy others
-                if field.name.endswith('Date'):
-                    setattr(cf, field.name, str(getattr(conf, field.name)))
-                else:
-                    setattr(cf, field.name, getattr(conf, field.name))
-            elif field.name == "websafeKey":
-                setattr(cf, field.name, conf.key.urlsafe())
-        if displayName:
-            setattr(cf, 'organizerDisplayName', displayName)
-        cf.check_initialized()
-        return cf
-
-    @endpoints.method(ConferenceQueryForms, ConferenceForms,
+        return self._conferenceForms(confs, ListView.FULL,
+            nextPageToken=next_token)
+
+    def _fetchPage(self, query, request, **options):
+        """Fetch one page of query using the request's pageSize/pageToken;
+        return (results, nextPageToken). Options (eg. projection) are
+        passed on to fetch_page."""
+        page_size, cursor = self._pageArgs(request)
+        results, next_cursor, more = query.fetch_page(page_size,
+            start_cursor=cursor, **options)
+        return results, self._nextPageToken(next_cursor, more)
+
+    def _pageSize(self, request):
+        """Return the page size of a paged request."""
+        page_size = min(request.pageSize or DEFAULT_PAGE_SIZE, MAX_PAGE_SIZE)
+        if page_size < 1:
+            raise endpoints.BadRequestException(
+                "'pageSize' must be a positive number.")
+        return page_size
+
+    def _pageArgs(self, request):
+        """Return (page size, start cursor) of a paged request."""
+        page_size = self._pageSize(request)
+        cursor = None
+        if request.pageToken:
+            try:
+                cursor = Cursor(urlsafe=request.pageToken)
+            except datastore_errors.BadValueError:
+                raise endpoints.BadRequestException(
+                    'Invalid page token: %s' % request.pageToken)
+        return page_size, cursor
+
+    def _nextPageToken(self, next_cursor, more):
+        """Return the pageToken of the next page, None on the last one."""
+        next_token = None
+        if more and next_cursor:
+            next_token = next_cursor.urlsafe()
+        return next_token
+
+    def _copyConferenceToForm(self, conf, seats=None):
+        """Copy relevant fields from Conference to ConferenceForm.
+
+        The organizer's name comes from the organizerDisplayName
+        snapshot on the Conference. Seats are read from the sharded
+        seat counter unless already looked up by the caller (see
+        counters.getSeatsMulti)."""
+        if seats is None:
+            seats = counters.getSeats(conf)
+        return CONFERENCE_MAPPER.toForm(conf, seatsAvailable=seats)
+
+    def _conferenceForms(self, confs, view, **kwargs):
+        """Return ConferenceForms of confs, as summaries for the
+        SUMMARY view."""
+        if view == ListView.SUMMARY:
+            # projected entities have no seatsAvailable snapshot
+            seats = counters.getSeatsForKeys([conf.key for conf in confs])
+            return ConferenceForms(summaries=CONFERENCE_SUMMARY_MAPPER.toForms(
+                confs, seatsAvailable=[seats[conf.key] for conf in confs]),
+                **kwargs)
+        seats = counters.getSeatsMulti(confs)
+        return ConferenceForms(items=CONFERENCE_MAPPER.toForms(confs,
+            seatsAvailable=[seats[conf.key] for conf in confs]), **kwargs)
+
+    @instrumentation.method(ConferenceQueryForms, ConferenceForms,
             path='queryConferences',
             http_method='POST',
             name='queryConferences')
     def queryConferences(self, request):
-        """Query for conferences."""
-        conferences = self._getQuery(request)
-
-        # need to fetch organiser displayName from profiles
-        # get all keys and use get_multi for speed
-        organisers = [(ndb.Key(Profile, 
-            conf.organizerUserId)) for conf in conferences]
-        profiles = ndb.get_multi(organisers)
-
-        # put display names in a dict for easier fetching
-        names = {}
-        for profile in profiles:
-            names[profile.key.id()] = profile.displayName
+        """Query for conferences.
+
+        With view=SUMMARY an unfiltered query is a projection query;
+        filtered ones still load entities but return summaries. Page
+        tokens are only valid for the view they were returned for.
+
+        Pages are served from the query cache (see querycache.py),
+        except when the plan is to be explained."""
+        page_size, cursor = self._pageArgs(request)
+        plan = self._getQuery(request)
+        cache_key = None
+        if not request.explain:
+            cache_key = querycache.cacheKey(plan.pushed + plan.residual,
+                page_size, request.pageToken, request.view)
+        cached = querycache.get(cache_key)
+        if cached:
+            conferences, next_token = cached
+        else:
+            if request.view == ListView.SUMMARY and plan.projectable():
+                conferences, next_cursor, more = plan.fetchProjectedPage(
+                    page_size, CONFERENCE_SUMMARY_FIELDS, cursor)
+            else:
+                conferences, next_cursor, more = plan.fetchPage(page_size,
+                    cursor)
+            next_token = self._nextPageToken(next_cursor, more)
+            querycache.put(cache_key, conferences, next_token)
 
         # return individual ConferenceForm object per Conference
-        return ConferenceForms(
-                items=[self._copyConferenceToForm(conf, 
-                    names[conf.organizerUserId]) for conf in conferences])
+        return self._conferenceForms(conferences, request.view,
+                nextPageToken=next_token,
+                explain=plan.explain() if request.explain else None)
 
     def _getQuery(self, request):
-        """Return formatted query from the submitted filters."""
-        q = Conference.query()
-        inequality_filter, filters = self._formatFilters(request.filters)
-
-        # If exists, sort on inequality filter first
-        if not inequality_filter:
-            q = q.order(Conference.name)
-        else:
-            q = q.order(ndb.GenericProperty(inequality_filter))
-            q = q.order(Conference.name)
-
+        """Return a QueryPlan for the submitted filters; see planner.py."""
+        filters = self._formatFilters(request.filters)
         for filtr in filters:
             if filtr["field"] in ["month", "maxAttendees"]:
-                filtr["value"] = int(filtr["value"])
-            formatted_query = ndb.query.FilterNode(filtr["field"], 
-                filtr["operator"], filtr["value"])
-            q = q.filter(formatted_query)
-        return q
+                try:
+                    filtr["value"] = int(filtr["value"])
+                except (TypeError, ValueError):
+                    raise endpoints.BadRequestException(
+                        "Filter value of '%s' must be a number."
+                        % filtr["field"])
+        return planner.planConferenceQuery(filters)
 
     def _formatFilters(self, filters):
-        """Parse, check validity and format user supplied filters."""
+        """Parse, check validity and format user supplied filters.
+
+        Inequalities on several fields are fine, the query planner
+        applies all but one of them in memory."""
         formatted_filters = []
-        inequality_field = None
 
         for f in filters:
             filtr = {field.name: getattr(f, field.name) for \
@@ -355,24 +650,12 @@ class ConferenceApi(remote.Service):
                 raise endpoints.BadRequestException(
                     "Filter contains invalid field or operator.")
 
-            # Every operation except "=" is an inequality
-            if filtr["operator"] != "=":
-                # check if inequality operation has been used in previous filters
-                # disallow the filter if inequality was performed on a different 
-                # field before track the field on which the inequality operation
-                # is performed
-                if inequality_field and inequality_field != filtr["field"]:
-                    raise endpoints.BadRequestException(
-                        "Inequality filter is allowed on only one field.")
-                else:
-                    inequality_field = filtr["field"]
-
             formatted_filters.append(filtr)
-        return (inequality_field, formatted_filters)
+        return formatted_filters
 
 # - - - Task 1: Add sessions to a conference - - - - - - - - - - - -
 
-    @endpoints.method(SESSION_POST_REQUEST, SessionForm, 
+    @instrumentation.method(SESSION_POST_REQUEST, SessionForm, 
             path='session/{websafeConferenceKey}',
             http_method='POST', name='createSession')
     def createSession(self, request):
@@ -386,30 +669,114 @@ class ConferenceApi(remote.Service):
         if not request.name:
             raise endpoints.BadRequestException("Session 'name' field required")
 
+        conf = self._getOrganizedConference(request.websafeConferenceKey)
+        data = self._sessionData(request)
+
+        # get Conference key from request key
+        c_key = conf.key
+
+        # generate Session ID based on Conference key 
+        s_id = Session.allocate_ids(size=1, parent=c_key)[0]
+
+        # generate Session key from Session ID with conf key as parent
+        s_key = ndb.Key(Session, s_id, parent=c_key) 
+
+        # add property value previously removed back to the data variable
+        data['key'] = s_key
+
+        # creation of Session in Datastore, together with the
+        # conference's speaker index if a speaker was given
+        sess = Session(**data)
+        self._storeSessions(c_key, [(sess, request.speaker)])
+        # resolve or create the speaker, it's in its own entity group
+        speakers.linkSessions([(request.speaker, sess.key)])
+        search.indexDocuments([sess])
+
+        # return response request in required format
+        return self._copySessionToForm(sess)
+
+    @instrumentation.method(SESSION_BATCH_POST_REQUEST, BatchResultForms,
+            path='sessions/batch/{websafeConferenceKey}',
+            http_method='POST', name='createSessionsBatch')
+    def createSessionsBatch(self, request):
+        """Create many sessions in one conference at once; report
+        success per item."""
+        conf = self._getOrganizedConference(request.websafeConferenceKey)
+        c_key = conf.key
+
+        results = [BatchResultForm(index=i) for i in range(len(request.items))]
+        sessions = []
+        for i, form in enumerate(request.items):
+            if not form.name:
+                results[i].error = "Session 'name' field required"
+                continue
+            try:
+                sessions.append((i, Session(**self._sessionData(form)),
+                    form.speaker))
+            except (ValueError, datastore_errors.BadValueError) as e:
+                results[i].error = str(e)
+        if not sessions:
+            return BatchResultForms(items=results)
+
+        # one id range for the whole batch
+        first, last = Session.allocate_ids(size=len(sessions), parent=c_key)
+        for (i, sess, speaker), s_id in zip(sessions, range(first, last + 1)):
+            sess.key = ndb.Key(Session, s_id, parent=c_key)
+
+        for chunk in _chunks(sessions, BATCH_SIZE):
+            try:
+                self._storeSessions(c_key, [(sess, speaker)
+                    for i, sess, speaker in chunk])
+            except datastore_errors.Error as e:
+                for i, sess, speaker in chunk:
+                    results[i].error = str(e)
+                continue
+            for i, sess, speaker in chunk:
+                results[i].success = True
+                results[i].websafeKey = sess.key.urlsafe()
+            # the sessions are stored; /tasks/backfill_speakers and
+            # /tasks/index_sessions catch up with what fails here
+            try:
+                speakers.linkSessions([(speaker, sess.key)
+                    for i, sess, speaker in chunk])
+                search.indexDocuments([sess for i, sess, speaker in chunk])
+            except datastore_errors.Error:
+                logging.exception('Linking & indexing batch sessions failed')
+
+        return BatchResultForms(items=results)
+
+    def _getOrganizedConference(self, websafeConferenceKey):
+        """Return the Conference if the current user organizes it."""
         # retrieve conference object using websafekey
         # validate that given websafe key points to an actual conference object
-        conf = ndb.Key(urlsafe=request.websafeConferenceKey).get()
+        conf = ndb.Key(urlsafe=websafeConferenceKey).get()
         if not conf:
             raise endpoints.NotFoundException(
-                'No conference found with key: %s' % request.websafeConferenceKey)
+                'No conference found with key: %s' % websafeConferenceKey)
 
         # retrieve current user submitting request, then get their user ID
         user = endpoints.get_current_user()
+        if not user:
+            raise endpoints.UnauthorizedException('Authorization required')
         user_id = getUserId(user)
 
         # check that user ID matches organizerID of conference as
         # only the organizer of a conference can create sessions in it
         if user_id != conf.organizerUserId:
-            raise endoints.UnauthorizedException("You have to be the \
+            raise endpoints.UnauthorizedException("You have to be the \
                 conference organizer to add sessions to it!")
+        return conf
 
+    def _sessionData(self, request):
+        """Return the property dict of a new Session (without key) from
+        a SessionForm request."""
         # copy SessionForm/ProtoRPC Message into a dictionary variable
         data = {field.name: getattr(request, field.name) for field in \
             request.all_fields()}
         
         # delete fields that will be recreated with property values from Datastore
         del data['websafeKey']
-        del data['websafeConferenceKey']
+        data.pop('websafeConferenceKey', None)
         del data['organizerDisplayName']
 
         # add default values for those missing (both data model & outbound Message)
@@ -422,74 +789,58 @@ class ConferenceApi(remote.Service):
             data['date'] = datetime.strptime(data['date'][:10], "%Y-%m-%d").date()
         if data['startTime']:
             data['startTime'] = datetime.strptime(data['startTime'][:10], "%H:%M").time()
+        return data
 
-        # get Conference key from request key
-        c_key = ndb.Key(urlsafe=request.websafeConferenceKey)
-
-        # generate Session ID based on Conference key 
-        s_id = Session.allocate_ids(size=1, parent=c_key)[0]
-
-        # generate Session key from Session ID with conf key as parent
-        s_key = ndb.Key(Session, s_id, parent=c_key) 
-
-        # add property value previously removed back to the data variable
-        data['key'] = s_key
-
-        # creation of Session in Datastore
-        Session(**data).put()
-
-        # obtain the newly created session object
-        sess = s_key.get()
-        
-        # check if there is a speaker in the request, if so add to task queue
-        if request.speaker:
-            
-            # pass websafekey and speaker name from request to task queue
-            taskqueue.add(params={
-                'websafeConferenceKey': request.websafeConferenceKey,
-                'sessionSpeaker': request.speaker},
-                url='/tasks/set_featured_speaker'
-            )
-
-        # return response request in required format
-        return self._copySessionToForm(sess)
+    @staticmethod
+    @ndb.transactional()
+    def _storeSessions(c_key, sessions):
+        """Write (Session, speaker) pairs of conference c_key and count
+        them in its speaker index; both are in the conference's entity
+        group. A speaker of None is not indexed. Link the sessions to
+        their Speakers with speakers.linkSessions after commit."""
+        for sess, speaker in sessions:
+            sess.speakerKey = speakers.speakerKey(speaker)
+        ndb.put_multi([sess for sess, speaker in sessions])
+        speakers.addSessions(c_key, [(speaker, sess.name)
+            for sess, speaker in sessions if speaker])
+        responses.bump(c_key)
 
         
     def _copySessionToForm(self, sess):
         """Copy relevant fields from Session to SessionForm."""
-        sf = SessionForm()
-        for field in sf.all_fields():
-            if hasattr(sess, field.name):
-                # convert Date to date string; just copy others
-                if field.name.endswith('date'):
-                    setattr(sf, field.name, str(getattr(sess, field.name)))
-                elif field.name.endswith('Time'):
-                    setattr(sf, field.name, str(getattr(sess, field.name)))
-                else:
-                    setattr(sf, field.name, getattr(sess, field.name))
-        setattr(sf, 'websafeKey', str(sess.key.urlsafe()))
-
-        sf.check_initialized()
-        return sf
-
-    @endpoints.method(SESSION_GET_REQUEST, SessionForms, 
+        return SESSION_MAPPER.toForm(sess)
+
+    @instrumentation.method(SESSION_GET_REQUEST, SessionForms, 
             path='sessions/all/{websafeConferenceKey}',
             http_method='GET', name='getConferenceSessions')
     def getConferenceSessions(self, request):
-        """Return sessions by conference."""
+        """Return sessions by conference; view=SUMMARY runs a projection
+        query and returns summaries."""
 
         # fetch conference by key in the request
         conference_key = ndb.Key(urlsafe=request.websafeConferenceKey)
-        
-        # query and return sessions by conference key
-        sessions = Session.query(ancestor=conference_key).fetch()
 
-        return SessionForms(
-            items=[self._copySessionToForm(sess) for sess in sessions]
-        )
+        def build():
+            # query and return sessions by conference key
+            query = Session.query(ancestor=conference_key)
+            if request.view == ListView.SUMMARY:
+                sessions, next_token = self._fetchPage(query, request,
+                    projection=SESSION_SUMMARY_FIELDS)
+                return SessionForms(
+                    summaries=SESSION_SUMMARY_MAPPER.toForms(sessions),
+                    nextPageToken=next_token
+                )
+            sessions, next_token = self._fetchPage(query, request)
+
+            return SessionForms(
+                items=SESSION_MAPPER.toForms(sessions),
+                nextPageToken=next_token
+            )
+        return responses.getResponse('getConferenceSessions', conference_key,
+            request, SessionForms, build)
 
 
-    @endpoints.method(SESSION_GET_REQUEST, SessionForms,
+    @instrumentation.method(SESSION_GET_REQUEST, SessionForms,
             path='sessions/sessionType/{websafeConferenceKey}/{sessionType}',
             http_method='GET', 
             name='getConferenceSessionByType')
@@ -502,43 +853,59 @@ class ConferenceApi(remote.Service):
         # fetch conference key from request 
         conference_key = ndb.Key(urlsafe=request.websafeConferenceKey)
 
-        # query Session by conference key
-        # filter sessions by request type and sort by name
-        sessions = Session.query(ancestor=conference_key).filter(
-            Session.sessionType == requestType).order(Session.name).fetch()
-        
-        return SessionForms(
-            items=[self._copySessionToForm(sess) for sess in sessions]
-        )
+        def build():
+            # query Session by conference key
+            # filter sessions by request type and sort by name
+            sessions, next_token = self._fetchPage(
+                Session.query(ancestor=conference_key).filter(
+                    Session.sessionType == requestType).order(Session.name),
+                request)
+
+            return SessionForms(
+                items=SESSION_MAPPER.toForms(sessions),
+                nextPageToken=next_token
+            )
+        return responses.getResponse('getConferenceSessionByType',
+            conference_key, request, SessionForms, build)
 
-    @endpoints.method(SPEAKER_SESSION_GET_REQUEST, SessionForms,
+    @instrumentation.method(SPEAKER_SESSION_GET_REQUEST, SessionForms,
             path='conferences/speaker/{speaker}',
             http_method='GET', 
             name='getConferenceSessionBySpeaker')
     def getConferenceSessionBySpeaker(self, request):
-        """Query sessions and filter by speaker"""
-
-        # get speaker as object from request
-        requestSpeaker = request.speaker
+        """Return the sessions of a speaker across conferences, in the
+        order they were added; any spelling of the name matches (see
+        speakers.canonicalName). The page token is an offset."""
+        page_size = self._pageSize(request)
+        try:
+            offset = int(request.pageToken or 0)
+        except ValueError:
+            raise endpoints.BadRequestException(
+                'Invalid page token: %s' % request.pageToken)
 
-        # query Session class, filter by speaker than order sessions
-        sessions = Session.query(Session.speaker == requestSpeaker).order(
-            Session.name).fetch()
+        # one get for the speaker's session keys, one for the page
+        session_keys = speakers.getSessionKeys(request.speaker)
+        page_keys = session_keys[offset:offset + page_size]
+        sessions = [sess for sess in ndb.get_multi(page_keys) if sess]
+        next_token = None
+        if offset + page_size < len(session_keys):
+            next_token = str(offset + page_size)
 
         return SessionForms(
-            items=[self._copySessionToForm(sess) for sess in sessions]
-        )        
+            items=SESSION_MAPPER.toForms(sessions),
+            nextPageToken=next_token
+        )
 
 # - - - Task 2: Add sessions to user wishlist - - - - - - - - -
 
-    @endpoints.method(SESSION_GET_REQUEST, BooleanMessage,
+    @instrumentation.method(SESSION_GET_REQUEST, BooleanMessage,
             path='profile/wishlist/{websafeSessionKey}',
             http_method='POST', name='addSessionToWishlist')
     def addSessionToWishlist(self, request):
         """Register user for selected session."""
         return self._sessionRegistration(request)
 
-    @endpoints.method(SESSION_GET_REQUEST, BooleanMessage,
+    @instrumentation.method(SESSION_GET_REQUEST, BooleanMessage,
             path='profile/wishlist/{websafeSessionKey}',
             http_method='DELETE', name='deleteSessionInWishlist')
     def deleteSessionInWishlist(self, request):
@@ -562,36 +929,38 @@ class ConferenceApi(remote.Service):
             raise endpoints.NotFoundException(
                 'No session found with key: %s' % wssk)
 
+        # the wishlist entry of this session, if on the wishlist
+        entry_key = registrations.wishlistKey(prof.key, key)
+        entry = entry_key.get()
+
         # add session to user wishlist
         # 'reg' was sent to True as method argument
         if reg:
             # check if user already added session otherwise raise error
-            if key in prof.sessionKeysToAttend:
+            if entry:
                 raise ConflictException(
                     "You have already registered for this session")
 
-            # add session key to user profile as a wishlist item
-            prof.sessionKeysToAttend.append(key)
+            # add session to the user's wishlist
+            WishlistEntry(key=entry_key, session=key).put()
             retval = True
 
         # remove session from user wishlist
         else:
             # check if user already added session
-            if key in prof.sessionKeysToAttend:
+            if entry:
 
-                # remove session key from user profile
-                prof.sessionKeysToAttend.remove(key)
+                # remove session from the user's wishlist
+                entry_key.delete()
                 retval = True
             else:
                 retval = False
 
-        # write things back to the datastore & return
-        prof.put()
         # return a Boolean value for response to confirm session
         # has been added
         return BooleanMessage(data=retval)
 
-    @endpoints.method(message_types.VoidMessage, SessionForms,
+    @instrumentation.method(message_types.VoidMessage, SessionForms,
             path='profile/wishlist',
             http_method='GET', 
             name='getSessionsInWishlist')
@@ -601,158 +970,281 @@ class ConferenceApi(remote.Service):
         # return profile entity
         prof = self._getProfileFromUser()
 
-        # return list of session websafe keys in profile entity
-        session_keys = prof.sessionKeysToAttend
-        
-        # create empty variable to store session entities in
-        sessions = []
-
-        # loop over list to return session entities and append to 
-        #empty list
-        for key in session_keys:
-            # fetch session entity
-            session = key.get()
-            
-            # append session entity to empty list
-            sessions.append(session)
+        # fetch the sessions on the wishlist in one batch, skipping
+        # deleted ones
+        sessions = [sess for sess in ndb.get_multi(
+            registrations.sessionKeys(prof.key)) if sess]
 
         return SessionForms(
-            items=[self._copySessionToForm(sess) for sess in sessions]
+            items=SESSION_MAPPER.toForms(sessions)
         )
 
 # - - - Task 3: work on indexes and queries - - - - - - - - - - -
 
-    @endpoints.method(CONF_GET_REQUEST, StringMessage,
+    @instrumentation.method(CONF_GET_REQUEST, TeeShirtCounts,
             path='conference/teeShirts/{websafeConferenceKey}',
             http_method='GET', name='getTeeShirtsForConference')
     def getTeeShirtsForConference(self, request):
-        """For registered conference attendees, return their 
-        TeeShirt sizes."""
+        """For registered conference attendees, return the number of
+        TeeShirts per size."""
         
         # retrieve websafekey from request
         wsck = request.websafeConferenceKey
-        key = ndb.Key(urlsafe=wsck)
 
         # if there is no value for websafekey raise an error
         if not wsck:
             raise endpoints.NotFoundException(
                 'Not a valid websafe conference key: %s' % wsck)
         
-        # query all profiles for given websafe key
-        profiles = Profile.query(
-            Profile.conferenceKeysToAttend == key).fetch()
+        # read the histogram kept up to date by registration; legacy
+        # free-form sizes are counted as NOT_SPECIFIED
+        counts = {}
+        for name, count in histograms.getCounts(
+                ndb.Key(urlsafe=wsck)).items():
+            key = self._teeShirtSize(name)
+            counts[key] = counts.get(key, 0) + count
+
+        return TeeShirtCounts(
+            items=[TeeShirtCount(size=size, count=count)
+                for size, count in sorted(counts.items(),
+                    key=lambda item: item[0].name)],
+            total=sum(counts.values())
+        )
 
-        tshirt_dict = {profile.displayName: profile.teeShirtSize for profile in profiles}
+    def _teeShirtSize(self, size):
+        """Return the TeeShirtSize of a stored size name, NOT_SPECIFIED
+        for a free-form size that predates the enum."""
+        if size in TeeShirtSize.names():
+            return TeeShirtSize(size)
+        return TeeShirtSize.NOT_SPECIFIED
+
+    @instrumentation.method(CONF_PAGE_REQUEST, AttendeeForms,
+            path='conference/teeShirts/{websafeConferenceKey}/attendees',
+            http_method='GET', name='getTeeShirtAttendees')
+    def getTeeShirtAttendees(self, request):
+        """Return registered attendees and their TeeShirt sizes, a page
+        at a time."""
+        key = ndb.Key(urlsafe=request.websafeConferenceKey)
+        reg_keys, next_token = self._fetchPage(
+            registrations.attendeesQuery(key), request, keys_only=True)
+        profs = [prof for prof in ndb.get_multi(
+            [reg_key.parent() for reg_key in reg_keys]) if prof]
+
+        return AttendeeForms(
+            items=[AttendeeForm(displayName=prof.displayName,
+                teeShirtSize=self._teeShirtSize(prof.teeShirtSize))
+                for prof in profs],
+            nextPageToken=next_token
+        )
 
-        return StringMessage(data=str(tshirt_dict))
+    @instrumentation.method(CONF_PAGE_REQUEST, RosterForms,
+            path='conference/{websafeConferenceKey}/attendees',
+            http_method='GET', name='getConferenceAttendees')
+    def getConferenceAttendees(self, request):
+        """Return the attendee roster of a conference a page at a time,
+        with the number of attendees; organizer only."""
+        conf = self._getOrganizedConference(request.websafeConferenceKey)
+        try:
+            entries, next_token = roster.getPage(conf.key,
+                self._pageSize(request), request.pageToken)
+        except ValueError as e:
+            raise endpoints.BadRequestException(str(e))
+
+        return RosterForms(
+            items=[RosterEntryForm(userId=user_id, displayName=name)
+                for user_id, name in entries],
+            nextPageToken=next_token,
+            count=roster.getCount(conf.key)
+        )
 
-    @endpoints.method(message_types.VoidMessage, SessionForms,
-            path='sessions/summer',
-            http_method='GET', 
-            name='getConferenceSessionInSummer')
-    def getConferenceSessionInSummer(self, request):
-        """Query sessions and filter by month"""
-
-        # query Session class, filter by speaker than order sessions
-        # filter for sessions occuring in the summer season
-        # sort sessions by date
-        sessions = Session.query(Session.date >= date(2015,6,21), \
-        Session.date <= date(2015,9,22)).order(Session.date).fetch()
-        
+    @instrumentation.method(SESSION_QUERY_REQUEST, SessionForms,
+            path='sessions/query',
+            http_method='GET',
+            name='querySessions')
+    def querySessions(self, request):
+        """Query sessions by date range (YYYY-MM-DD, both ends inclusive),
+        optionally filtered by conference, type and speaker."""
+        first = self._parseDate(request.startDate, 'startDate')
+        last = self._parseDate(request.endDate, 'endDate')
+        if first and last and first > last:
+            raise endpoints.BadRequestException(
+                "'startDate' must not be after 'endDate'.")
+
+        if request.websafeConferenceKey:
+            q = Session.query(
+                ancestor=ndb.Key(urlsafe=request.websafeConferenceKey))
+        else:
+            q = Session.query()
+        if request.sessionType:
+            q = q.filter(Session.sessionType == request.sessionType)
+        if request.speaker:
+            q = q.filter(Session.speaker == request.speaker)
+
+        bucket = buckets.bucketFor(first, last)
+        if bucket:
+            # a whole year, season or week is one equality filter; with
+            # equality filters only the datastore merge-joins built-in
+            # indexes, so results come in key order
+            name, value = bucket
+            q = q.filter(getattr(Session, name) == value).order(Session.key)
+        else:
+            # None sorts before every date, so a lower bound is always
+            # needed to leave out sessions without a date
+            q = q.filter(Session.date >= (first or date.min))
+            if last:
+                q = q.filter(Session.date <= last)
+            q = q.order(Session.date, Session.key)
+
+        sessions, next_token = self._fetchPage(q, request)
+        return SessionForms(
+            items=SESSION_MAPPER.toForms(sessions),
+            nextPageToken=next_token
+        )
+
+    def _search(self, kind, request):
+        """Return (entities, nextPageToken) of one page of the full-text
+        search of request; see search.py."""
+        if not request.query:
+            raise endpoints.BadRequestException("'query' field required")
+        offset = 0
+        if request.pageToken:
+            try:
+                offset = int(request.pageToken)
+            except ValueError:
+                raise endpoints.BadRequestException(
+                    'Invalid page token: %s' % request.pageToken)
+        entities, next_offset = search.search(kind, request.query,
+            self._pageSize(request), offset)
+        return entities, (str(next_offset) if next_offset is not None
+            else None)
+
+    @instrumentation.method(SEARCH_REQUEST, ConferenceForms,
+            path='conferences/search',
+            http_method='GET', name='searchConferences')
+    def searchConferences(self, request):
+        """Full-text search of conference names, descriptions, topics
+        and cities; best matches first."""
+        confs, next_token = self._search('Conference', request)
+        return self._conferenceForms(confs, ListView.FULL,
+            nextPageToken=next_token)
+
+    @instrumentation.method(SEARCH_REQUEST, SessionForms,
+            path='sessions/search',
+            http_method='GET', name='searchSessions')
+    def searchSessions(self, request):
+        """Full-text search of session names and highlights; best
+        matches first."""
+        sessions, next_token = self._search('Session', request)
         return SessionForms(
-            items=[self._copySessionToForm(sess) for sess in sessions]
+            items=SESSION_MAPPER.toForms(sessions),
+            nextPageToken=next_token
         )
 
-    @endpoints.method(message_types.VoidMessage, SessionForms,
+    def _parseDate(self, value, name):
+        """Convert a YYYY-MM-DD string to a date."""
+        if not value:
+            return None
+        try:
+            return datetime.strptime(value[:10], "%Y-%m-%d").date()
+        except ValueError:
+            raise endpoints.BadRequestException(
+                "'%s' must be a date formatted YYYY-MM-DD." % name)
+
+    @instrumentation.method(PAGE_REQUEST, SessionForms,
             path='sessions/preferred',
             http_method='GET',
             name='getPreferredSessions')
     def getPreferredSessions(self, request):
         """Query sessions that are not workshops and start before 7pm"""
 
-        # query sessions for non-workshops
-        sessions = Session.query(Session.sessionType != 'workshop').fetch()
-
-        # create empty lists to store preferred session and their websafe keys in
-        pref_sessions = []
-
-        # loop through the list of non-workshops 
-        for i in range(len(sessions)):
-            # if condition of 7pm starttime is met, append to empty lists
-            if sessions[i].startTime < time(19):
-                pref_sessions.append(sessions[i])
+        # both conditions are answered by the (isWorkshop, startMinute)
+        # index, see _getTimeOfDayQuery
+        sessions, next_token = self._fetchPage(
+            self._getTimeOfDayQuery(True, None, 19 * 60), request)
 
         # return response ready form for each session key in list
         return SessionForms(
-            items=[self._copySessionToForm(sess) for sess in pref_sessions]
+            items=SESSION_MAPPER.toForms(sessions),
+            nextPageToken=next_token
         )
 
-# - - - Task 4: add a task - - - - - - - - - - - - - - - -
+    @instrumentation.method(TIME_OF_DAY_GET_REQUEST, SessionForms,
+            path='sessions/timeOfDay',
+            http_method='GET',
+            name='getSessionsByTimeOfDay')
+    def getSessionsByTimeOfDay(self, request):
+        """Query sessions starting within a time-of-day window (HH:MM),
+        optionally excluding workshops."""
+        query = self._getTimeOfDayQuery(request.excludeWorkshops,
+            self._parseMinuteOfDay(request.startAfter, 'startAfter'),
+            self._parseMinuteOfDay(request.startBefore, 'startBefore'))
+        sessions, next_token = self._fetchPage(query, request)
 
-    @staticmethod
-    def _cacheFeaturedSpeaker(websafeConferenceKey,sessionSpeaker):
-        """Create featured speaker announcement & set to memcache"""
-        
-        # retrieve conference key 
-        c_key = ndb.Key(urlsafe=websafeConferenceKey)
-
-        # query all sessions associated with the conference
-        # filter query by speaker name in request
-        sessions = Session.query(ancestor=c_key).filter(
-            Session.speaker == sessionSpeaker).order(Session.name).fetch()
-
-        # if there is more than one session with the same speaker, 
-        # set message to memcache
-        if len(sessions) > 1:
-            featured_speaker = '%s %s %s' % (
-                'The following sessions '
-                'feature the main speaker',
-                sessionSpeaker+':',
-                ', '.join(session.name for session in sessions))
-            # set the memcache for the most recent speaker and their sessions
-            memcache.set(MEMCACHE_FEATURED_SPEAKER_KEY, featured_speaker)
-            
-        # return empty if condition is not met
-        else:
-            featured_speaker = ""
+        return SessionForms(
+            items=SESSION_MAPPER.toForms(sessions),
+            nextPageToken=next_token
+        )
+
+    def _getTimeOfDayQuery(self, excludeWorkshops, startAfter, startBefore):
+        """Return query for sessions starting at or after startAfter and
+        before startBefore (minutes of the day, either may be None).
+
+        Uses the computed isWorkshop/startMinute properties, so the
+        whole query is one index scan; sessions without a startTime
+        never match."""
+        q = Session.query()
+        if excludeWorkshops:
+            q = q.filter(Session.isWorkshop == False)
+        # None sorts before every integer, so a lower bound is always
+        # needed to leave out sessions without a startTime
+        q = q.filter(Session.startMinute >= (startAfter or 0))
+        if startBefore is not None:
+            q = q.filter(Session.startMinute < startBefore)
+        return q.order(Session.startMinute, Session.key)
+
+    def _parseMinuteOfDay(self, value, name):
+        """Convert a HH:MM string to minutes since midnight."""
+        if not value:
+            return None
+        try:
+            t = datetime.strptime(value, "%H:%M").time()
+        except ValueError:
+            raise endpoints.BadRequestException(
+                "'%s' must be a time formatted HH:MM." % name)
+        return t.hour * 60 + t.minute
 
-        return featured_speaker
+# - - - Task 4: add a task - - - - - - - - - - - - - - - -
 
-    @endpoints.method(message_types.VoidMessage, StringMessage,
-            path='conference/featured_speaker/get',
+    @instrumentation.method(CONF_GET_REQUEST, StringMessage,
+            path='conference/{websafeConferenceKey}/featured_speaker',
             http_method='GET', name='getFeaturedSpeaker')
     def getFeaturedSpeaker(self, request):
-        """Return featured speaker from memcache."""
+        """Return the featured speaker of a conference."""
         
-        # return an existing announcement from Memcache or an empty message.
-        featured_speaker = memcache.get(MEMCACHE_FEATURED_SPEAKER_KEY)
+        # served from memcache, falling back to the conference's
+        # speaker index; never needs a query
+        featured_speaker = speakers.getFeaturedSpeaker(
+            ndb.Key(urlsafe=request.websafeConferenceKey))
         
         return StringMessage(data=featured_speaker or "no featured speaker to return")
 
+    @staticmethod
+    def _rebuildSpeakerIndex(c_key):
+        """Rebuild the speaker index of conference c_key from its
+        sessions; see MapperHandler in main.py."""
+        speakers.rebuild(c_key, SESSION_DEFAULTS['speaker'])
+
 
 # - - - Profile objects - - - - - - - - - - - - - - - - - - - -
 
     def _copyProfileToForm(self, prof):
-        """Copy relevant fields from Profile to ProfileForm."""
-        # copy relevant fields from Profile to ProfileForm
-        pf = ProfileForm()
-
-        for field in pf.all_fields():
-            if hasattr(prof, field.name):
-                # convert t-shirt string to Enum; just copy others
-                if field.name == 'teeShirtSize':
-                    setattr(pf, field.name, getattr(TeeShirtSize, 
-                        getattr(prof, field.name)))
-                elif field.name == 'conferenceKeysToAttend':
-                    setattr(pf, field.name, [conf.urlsafe() for conf \
-                        in prof.conferenceKeysToAttend])    
-                elif field.name == 'sessionKeysToAttend':
-                    setattr(pf, field.name, [sess.urlsafe() for sess \
-                        in prof.sessionKeysToAttend])
-                else:
-                    setattr(pf, field.name, getattr(prof, field.name))
-        pf.check_initialized()
-        return pf
+        """Copy relevant fields from Profile to ProfileForm; the key
+        lists come from the profile's registrations & wishlist."""
+        return PROFILE_MAPPER.toForm(prof,
+            conferenceKeysToAttend=[mappers.urlsafe(c_key) for c_key
+                in registrations.conferenceKeys(prof.key)],
+            sessionKeysToAttend=[mappers.urlsafe(s_key) for s_key
+                in registrations.sessionKeys(prof.key)])
 
     def _getProfileFromUser(self):
         """Return user Profile from datastore, creating new one 
@@ -762,22 +1254,41 @@ class ConferenceApi(remote.Service):
         if not user:
             raise endpoints.UnauthorizedException('Authorization required')
 
-        # get Profile from datastore
+        # get Profile from cache or datastore
         user_id = getUserId(user)
-        p_key = ndb.Key(Profile, user_id)
-        profile = p_key.get()
+        profile = self._getProfile(user_id)
+        # move attendance & wishlist lists of old profiles to their
+        # own entities, see registrations.py
+        if profile and registrations.hasLegacyLists(profile):
+            profile = registrations.migrateProfile(profile.key,
+                self._profileMemo())
         # create new Profile if not there
         if not profile:
             profile = Profile(
-                key = p_key,
+                key = ndb.Key(Profile, user_id),
                 displayName = user.nickname(),
                 mainEmail= user.email(),
                 teeShirtSize = str(TeeShirtSize.NOT_SPECIFIED),
             )
-            profile.put()
+            self._putProfile(profile)
 
         return profile      # return Profile
 
+    def _getProfile(self, user_id):
+        """Return Profile of user_id through the profile cache."""
+        return profiles.getProfile(user_id, self._profileMemo())
+
+    def _putProfile(self, prof):
+        """Write Profile and invalidate its cached copies."""
+        profiles.putProfile(prof, self._profileMemo())
+
+    def _profileMemo(self):
+        """Return the per-request Profile memo; the service is
+        instantiated once per request."""
+        if not hasattr(self, '_profiles'):
+            self._profiles = {}
+        return self._profiles
+
     def _doProfile(self, save_request=None):
         """Get user Profile and return to user, possibly updating it first."""
         # get user Profile
@@ -785,6 +1296,8 @@ class ConferenceApi(remote.Service):
 
         # if saveProfile(), process user-modifyable fields
         if save_request:
+            old_name = prof.displayName
+            old_size = prof.teeShirtSize
             for field in ('displayName', 'teeShirtSize'):
                 if hasattr(save_request, field):
                     val = getattr(save_request, field)
@@ -794,18 +1307,31 @@ class ConferenceApi(remote.Service):
                         #    setattr(prof, field, str(val).upper())
                         #else:
                         #    setattr(prof, field, val)
-            prof.put()
+            self._putProfile(prof)
+
+            # copy the new name onto the user's conferences in the
+            # background
+            if prof.displayName != old_name:
+                taskqueue.add(params={'userId': prof.key.id()},
+                    url='/tasks/update_organizer_name')
+
+            # move the user between sizes in the histograms of the
+            # conferences they attend
+            if prof.teeShirtSize != old_size:
+                for c_key in registrations.conferenceKeys(prof.key):
+                    histograms.addSizes(c_key,
+                        {old_size: -1, prof.teeShirtSize: 1})
 
         # return ProfileForm
         return self._copyProfileToForm(prof)
 
-    @endpoints.method(message_types.VoidMessage, ProfileForm,
+    @instrumentation.method(message_types.VoidMessage, ProfileForm,
             path='profile', http_method='GET', name='getProfile')
     def getProfile(self, request):
         """Return user profile."""
         return self._doProfile()
 
-    @endpoints.method(ProfileMiniForm, ProfileForm,
+    @instrumentation.method(ProfileMiniForm, ProfileForm,
             path='profile', http_method='POST', name='saveProfile')
     def saveProfile(self, request):
         """Update & return user profile."""
@@ -814,14 +1340,19 @@ class ConferenceApi(remote.Service):
 
 # - - - Registration - - - - - - - - - - - - - - - - - - - -
 
-    @endpoints.method(CONF_GET_REQUEST, BooleanMessage,
+    @instrumentation.method(CONF_GET_REQUEST, RegistrationResultForm,
             path='conference/{websafeConferenceKey}',
             http_method='POST', name='registerForConference')
     def registerForConference(self, request):
-        """Register user for selected conference."""
-        return self._conferenceRegistration(request)
+        """Register user for selected conference; conferences with
+        queued registration return a reservation token instead."""
+        conf = ndb.Key(urlsafe=request.websafeConferenceKey).get()
+        if conf and conf.queuedRegistration:
+            return self._reserveSeat(conf)
+        return RegistrationResultForm(
+            data=self._conferenceRegistration(request).data)
 
-    @endpoints.method(CONF_GET_REQUEST, BooleanMessage,
+    @instrumentation.method(CONF_GET_REQUEST, BooleanMessage,
             path='conference/{websafeConferenceKey}',
             http_method='DELETE', name='unregisterFromConference')
     def unregisterFromConference(self, request):
@@ -844,104 +1375,330 @@ class ConferenceApi(remote.Service):
             raise endpoints.NotFoundException(
                 'No conference found with key: %s' % wsck)
 
+        # the user's registration for this conference, if any
+        reg_key = registrations.registrationKey(prof.key, key)
+        registration = reg_key.get()
+        registered = registration is not None
+
         # register
         if reg:
-            # check if user already registered otherwise add
-            if key in prof.conferenceKeysToAttend:
-                raise ConflictException(
-                    "You have already registered for this conference")
-
-            # check if seats avail
-            if conf.seatsAvailable <= 0:
-                raise ConflictException(
-                    "There are no seats available.")
-
-            # register user, take away one seat
-            prof.conferenceKeysToAttend.append(key)
-            conf.seatsAvailable -= 1
+            self._addRegistration(prof, conf, registered)
             retval = True
 
         # unregister
         else:
             # check if user already registered
-            if key in prof.conferenceKeysToAttend:
+            if registered:
 
                 # unregister user, add back one seat
-                prof.conferenceKeysToAttend.remove(key)
-                conf.seatsAvailable += 1
+                reg_key.delete()
+                if registration.rosterChunk:
+                    roster.remove(registration.rosterChunk, prof.key.id())
+                counters.returnSeat(conf)
+                histograms.addSize(key, prof.teeShirtSize, -1)
                 retval = True
             else:
-                retval = False
+                # cancel a queued registration not committed yet
+                retval = self._cancelReservation(prof, conf)
+            if retval and conf.queuedRegistration:
+                ndb.get_context().call_on_commit(
+                    lambda: reservations.release(key))
+
+        # update the nearly sold out announcement & drop cached
+        # responses showing the old seat count once seats changed
+        if retval:
+            ndb.get_context().call_on_commit(
+                lambda: announcements.seatsChanged(conf))
+            responses.bump(key)
 
-        # write things back to the datastore & return
-        prof.put()
-        conf.put()
         return BooleanMessage(data=retval)
 
-    @endpoints.method(message_types.VoidMessage, ConferenceForms,
+    @staticmethod
+    def _addRegistration(prof, conf, registered):
+        """Register prof for conf within the current transaction; raise
+        ConflictException if already registered or sold out."""
+        # check if user already registered otherwise add
+        if registered:
+            raise ConflictException(
+                "You have already registered for this conference")
+
+        # take away one seat from the sharded counter; the
+        # Conference entity itself is not written
+        if not counters.takeSeat(conf):
+            raise ConflictException(
+                "There are no seats available.")
+
+        # register user & add them to the attendee roster
+        Registration(key=registrations.registrationKey(prof.key, conf.key),
+            conference=conf.key, rosterChunk=roster.add(conf.key,
+                prof.key.id(), prof.displayName)).put()
+        histograms.addSize(conf.key, prof.teeShirtSize)
+
+    def _cancelReservation(self, prof, conf):
+        """Delete the pending Reservation of prof for conf, within the
+        current transaction; return whether there was one."""
+        res_key = reservations.reservationKey(prof.key, conf.key)
+        reservation = res_key.get()
+        if not reservation or reservation.status != 'PENDING':
+            return False
+        res_key.delete()
+        return True
+
+    def _reserveSeat(self, conf):
+        """Queue the registration of the current user for conf; return
+        the reservation token. See reservations.py."""
+        prof = self._getProfileFromUser()
+        if registrations.registrationKey(prof.key, conf.key).get():
+            raise ConflictException(
+                "You have already registered for this conference")
+        if not reservations.allocate(conf.key):
+            raise ConflictException(
+                "There are no seats available.")
+        try:
+            reservation = reservations.reserve(prof.key, conf.key)
+        except datastore_errors.Error:
+            reservations.release(conf.key)
+            raise
+        if not reservation:
+            reservations.release(conf.key)
+            raise ConflictException(
+                "You already have a pending reservation for this conference")
+        reservations.scheduleCommit(conf.key)
+        return RegistrationResultForm(data=True,
+            reservationToken=reservation.key.urlsafe())
+
+    @instrumentation.method(RESERVATION_GET_REQUEST, ReservationForm,
+            path='reservation/{websafeReservationKey}',
+            http_method='GET', name='getReservation')
+    def getReservation(self, request):
+        """Return the status of a queued registration by its token."""
+        user = endpoints.get_current_user()
+        if not user:
+            raise endpoints.UnauthorizedException('Authorization required')
+        try:
+            res_key = ndb.Key(urlsafe=request.websafeReservationKey)
+        except Exception:
+            res_key = None
+        reservation = res_key and res_key.kind() == 'Reservation' and \
+            res_key.get()
+        # tokens of other users are reported as unknown
+        if not reservation or res_key.parent().id() != getUserId(user):
+            raise endpoints.NotFoundException(
+                'No reservation found with key: %s'
+                % request.websafeReservationKey)
+        return RESERVATION_MAPPER.toForm(reservation,
+            websafeConferenceKey=reservation.conference.urlsafe())
+
+    @staticmethod
+    @ndb.transactional(xg=True)
+    def _commitReservation(res_key):
+        """Register the profile of a pending reservation; return the
+        reservation, marked CONFIRMED or FAILED, or None if it was
+        cancelled or already committed."""
+        reservation = res_key.get()
+        if not reservation or reservation.status != 'PENDING':
+            return None
+        prof, conf = ndb.get_multi([res_key.parent(), reservation.conference])
+        try:
+            if not prof or not conf:
+                raise ConflictException('Conference or profile deleted.')
+            ConferenceApi._addRegistration(prof, conf,
+                registrations.registrationKey(prof.key, conf.key).get()
+                is not None)
+            reservation.status = 'CONFIRMED'
+            ndb.get_context().call_on_commit(
+                lambda: announcements.seatsChanged(conf))
+            responses.bump(conf.key)
+        except ConflictException as e:
+            # nothing was written before the conflict was detected
+            reservation.status = 'FAILED'
+            reservation.error = str(e)
+        reservation.put()
+        return reservation
+
+    @staticmethod
+    def _commitReservations(websafeConferenceKey=None):
+        """Commit one batch of pending reservations of a conference, or
+        of all conferences; return whether more are pending."""
+        c_key = websafeConferenceKey and ndb.Key(urlsafe=websafeConferenceKey)
+        res_keys, cursor, more = reservations.pendingQuery(c_key).fetch_page(
+            reservations.COMMIT_BATCH_SIZE, keys_only=True)
+        failed = set()
+        for res_key in res_keys:
+            reservation = ConferenceApi._commitReservation(res_key)
+            if reservation and reservation.status == 'FAILED':
+                failed.add(reservation.conference)
+        # the allocator let too many through, rebuild it from the shards
+        for conf_key in failed:
+            reservations.resync(conf_key)
+        return more
+
+    @instrumentation.method(CONF_SHARDS_REQUEST, BooleanMessage,
+            path='conference/{websafeConferenceKey}/seatShards',
+            http_method='POST', name='setConferenceSeatShards')
+    def setConferenceSeatShards(self, request):
+        """Set the number of seat counter shards of a conference."""
+        user = endpoints.get_current_user()
+        if not user:
+            raise endpoints.UnauthorizedException('Authorization required')
+        user_id = getUserId(user)
+
+        conf = ndb.Key(urlsafe=request.websafeConferenceKey).get()
+        if not conf:
+            raise endpoints.NotFoundException(
+                'No conference found with key: %s' % request.websafeConferenceKey)
+        if user_id != conf.organizerUserId:
+            raise endpoints.ForbiddenException(
+                'Only the owner can update the conference.')
+
+        try:
+            counters.resizeCounter(conf, num_shards=request.shards)
+        except ValueError as e:
+            raise endpoints.BadRequestException(str(e))
+        return BooleanMessage(data=True)
+
+    @instrumentation.method(VIEW_REQUEST, ConferenceForms,
             path='conferences/attending',
             http_method='GET', name='getConferencesToAttend')
     def getConferencesToAttend(self, request):
-        """Get list of conferences that user has registered for."""
+        """Get list of conferences that user has registered for.
+
+        The keys are known, so there is no query to project; SUMMARY
+        only slims the response."""
         prof = self._getProfileFromUser() # get user Profile
         
         # get conference entities from confernece keys stoted in profile
-        conferences = ndb.get_multi(prof.conferenceKeysToAttend)
+        conferences = [conf for conf in ndb.get_multi(
+            registrations.conferenceKeys(prof.key)) if conf]
 
-        # get organizers
-        organisers = [ndb.Key(Profile, conf.organizerUserId) for \
-                conf in conferences]
-        profiles = ndb.get_multi(organisers)
+        # return set of ConferenceForm objects per Conference
+        return self._conferenceForms(conferences, request.view)
 
-        # put display names in a dict for easier fetching
-        names = {}
-        for profile in profiles:
-            names[profile.key.id()] = profile.displayName
+# - - - Organizer names - - - - - - - - - - - - - - - - - - - -
 
-        # return set of ConferenceForm objects per Conference
-        return ConferenceForms(items=[self._copyConferenceToForm(conf, 
-            names[conf.organizerUserId]) for conf in conferences]
-        )
+    @staticmethod
+    def _updateOrganizerName(user_id):
+        """Copy the organizer's current displayName onto all their
+        conferences; used by the update_organizer_name task."""
+        p_key = ndb.Key(Profile, user_id)
+        prof = p_key.get()
+        if not prof:
+            return
+        cursor, more = None, True
+        while more:
+            confs, cursor, more = Conference.query(ancestor=p_key).fetch_page(
+                BATCH_SIZE, start_cursor=cursor)
+            changed = [conf for conf in confs
+                if conf.organizerDisplayName != prof.displayName]
+            for conf in changed:
+                conf.organizerDisplayName = prof.displayName
+            ndb.put_multi(changed)
+            responses.bump(*[conf.key for conf in changed])
+
+    @staticmethod
+    def _setOrganizerName(conf):
+        """Return conf with organizerDisplayName set from its organizer's
+        profile, or None if it already has one; see MapperHandler in
+        main.py."""
+        if conf.organizerDisplayName is not None:
+            return None
+        # an organizer without a profile keeps an empty name
+        conf.organizerDisplayName = getattr(conf.key.parent().get(),
+            'displayName', '')
+        return conf
+
+# - - - Migrations - - - - - - - - - - - - - - - - - - - - - -
+
+    @staticmethod
+    def _setConferenceMonth(conf):
+        """Return conf with month set from startDate, or None if it
+        already is; see MapperHandler in main.py."""
+        month = conf.startDate.month if conf.startDate else 0
+        if conf.month == month:
+            return None
+        conf.month = month
+        return conf
+
+    @staticmethod
+    def _conferencesChanged(conf_keys):
+        """Drop cached responses & query pages after conferences were
+        written in bulk."""
+        if conf_keys:
+            responses.bump(*conf_keys)
+            querycache.invalidate()
+
+    @staticmethod
+    def _normalizeTeeShirtSize(prof):
+        """Return prof with teeShirtSize set to a TeeShirtSize name
+        ('xl-m' -> 'XL_M', unknown -> 'NOT_SPECIFIED'), or None if it
+        already is one; see MapperHandler in main.py."""
+        size = (prof.teeShirtSize or '').strip().upper().replace(
+            '-', '_').replace(' ', '_')
+        if size not in TeeShirtSize.names():
+            size = 'NOT_SPECIFIED'
+        if size == prof.teeShirtSize:
+            return None
+        prof.teeShirtSize = size
+        return prof
+
+    @staticmethod
+    def _migrateProfile(prof):
+        """Move the attendance & wishlist lists of prof to
+        Registration/WishlistEntry entities in their own transaction;
+        see MapperHandler in main.py."""
+        if registrations.hasLegacyLists(prof):
+            registrations.migrateProfile(prof.key, {})
+
+    @staticmethod
+    def _linkSpeaker(sess):
+        """Link sess to its Speaker; return it with speakerKey set, or
+        None if that already is; see MapperHandler in main.py."""
+        # the default speaker stands for "no speaker given"
+        if sess.speaker == SESSION_DEFAULTS['speaker']:
+            return None
+        # linking is idempotent, so a retried slice is harmless
+        speakers.linkSessions([(sess.speaker, sess.key)])
+        s_key = speakers.speakerKey(sess.speaker)
+        if sess.speakerKey == s_key:
+            return None
+        sess.speakerKey = s_key
+        return sess
+
+    @staticmethod
+    def _indexDocument(entity):
+        """Add a conference or session to the search index; see
+        MapperHandler in main.py."""
+        # reindexing is idempotent, so a retried slice is harmless
+        search.indexDocuments([entity])
+
+    @staticmethod
+    def _rebuildTeeShirtHistogram(c_key):
+        """Recount the tee-shirt histogram of conference c_key from its
+        attendee profiles; see MapperHandler in main.py."""
+        reg_keys = registrations.attendeesQuery(c_key).fetch(keys_only=True)
+        sizes = [prof.teeShirtSize for prof in ndb.get_multi(
+            [reg_key.parent() for reg_key in reg_keys]) if prof]
+        histograms.rebuild(c_key, sizes)
 
 # - - - Announcements - - - - - - - - - - - - - - - - - - - -
 
     @staticmethod
     def _cacheAnnouncement():
-        """Create Announcement & assign to memcache; used by
-        memcache cron job & putAnnouncement().
+        """Rebuild the nearly sold out set & its memcache entry from the
+        seat counters; used by the hourly consistency sweep cron job.
+        Registration keeps the set up to date in between.
         """
-        confs = Conference.query(ndb.AND(
-            Conference.seatsAvailable <= 5,
-            Conference.seatsAvailable > 0)
-        ).fetch(projection=[Conference.name])
-
-        if confs:
-            # If there are almost sold out conferences,
-            # format announcement and set it in memcache
-            announcement = '%s %s' % (
-                'Last chance to attend! The following conferences '
-                'are nearly sold out:',
-                ', '.join(conf.name for conf in confs))
-            memcache.set(MEMCACHE_ANNOUNCEMENTS_KEY, announcement)
-        else:
-            # If there are no sold out conferences,
-            # delete the memcache announcements entry
-            announcement = ""
-            memcache.delete(MEMCACHE_ANNOUNCEMENTS_KEY)
-
-        return announcement
+        return announcements.sweep(
+            Conference.query(Conference.maxAttendees > 0))
 
-    @endpoints.method(message_types.VoidMessage, StringMessage,
+    @instrumentation.method(message_types.VoidMessage, StringMessage,
             path='conference/announcement/get',
             http_method='GET', name='getAnnouncement')
     def getAnnouncement(self, request):
         """Return Announcement from memcache."""
         
-        # return an existing announcement from Memcache or an empty string.
-        announcement = memcache.get(MEMCACHE_ANNOUNCEMENTS_KEY)
-        if not announcement:
-            announcement = ""
-        return StringMessage(data=announcement)
+        # return the announcement, or an empty string if there is none
+        return StringMessage(data=announcements.getAnnouncement())
 
 
 api = endpoints.api_server([ConferenceApi]) # register API
@@ -0,0 +1,215 @@
+#!/usr/bin/env python
+
+"""
+counters.py -- sharded seat counters for Conference.seatsAvailable
+
+Registration used to decrement seatsAvailable on the Conference entity
+itself, so every registrant contended on the same entity group. The seats
+of a conference are now spread over N root-level SeatShard entities: a
+registration takes a seat from one randomly chosen shard and reads are
+served from a memcache aggregate of all shards.
+
+A shard never goes below zero, so a conference can never be oversold.
+
+"""
+
+import random
+
+from google.appengine.api import memcache
+from google.appengine.ext import ndb
+
+from models import SeatCounter
+from models import SeatShard
+
+
+DEFAULT_NUM_SHARDS = 5
+# every shard is its own entity group and an XG transaction may span
+# at most 25 of them; registration also touches the profile, conference,
+# counter, tee-shirt histogram shard and roster shard groups
+MAX_NUM_SHARDS = 20
+MEMCACHE_SEATS_KEY = 'SEATS_%s'
+SEATS_CACHE_TIME = 60
+
+
+def _counterKey(conf_key):
+    """Return the SeatCounter key of a conference."""
+    return ndb.Key(SeatCounter, conf_key.urlsafe())
+
+
+def _shardKeys(conf_key, num_shards):
+    """Return the SeatShard keys of a conference."""
+    return [ndb.Key(SeatShard, '%s-%d' % (conf_key.urlsafe(), i))
+        for i in range(num_shards)]
+
+
+def _cacheKey(conf_key):
+    return MEMCACHE_SEATS_KEY % conf_key.urlsafe()
+
+
+def _spread(seats, num_shards):
+    """Split seats as evenly as possible over num_shards shards."""
+    return [seats // num_shards + (1 if i < seats % num_shards else 0)
+        for i in range(num_shards)]
+
+
+def _counterEntities(conf_key, seats, num_shards):
+    """Return the counter & shard entities of a counter holding seats."""
+    counter = SeatCounter(key=_counterKey(conf_key), numShards=num_shards)
+    shards = [SeatShard(key=s_key, count=count) for s_key, count in
+        zip(_shardKeys(conf_key, num_shards), _spread(seats, num_shards))]
+    return [counter] + shards
+
+
+def _writeShards(conf_key, seats, num_shards):
+    """Write counter & shards holding seats; return the SeatCounter."""
+    entities = _counterEntities(conf_key, seats, num_shards)
+    ndb.put_multi(entities)
+    return entities[0]
+
+
+def _getCounter(conf):
+    """Return the SeatCounter of conf, creating it from
+    conf.seatsAvailable for conferences that predate sharding."""
+    counter = _counterKey(conf.key).get()
+    if not counter:
+        counter = _writeShards(conf.key, conf.seatsAvailable or 0,
+            DEFAULT_NUM_SHARDS)
+    return counter
+
+
+def initSeats(conf_key, seats, num_shards=DEFAULT_NUM_SHARDS):
+    """Create the seat counter of a new conference."""
+    _writeShards(conf_key, seats, num_shards)
+    memcache.set(_cacheKey(conf_key), seats, time=SEATS_CACHE_TIME)
+
+
+def initSeatsMulti(conf_seats, num_shards=DEFAULT_NUM_SHARDS):
+    """Create the seat counters of new conferences from a list of
+    (conference key, seats) pairs with one put_multi."""
+    ndb.put_multi([entity for conf_key, seats in conf_seats
+        for entity in _counterEntities(conf_key, seats, num_shards)])
+    memcache.set_multi(dict((_cacheKey(conf_key), seats)
+        for conf_key, seats in conf_seats), time=SEATS_CACHE_TIME)
+
+
+@ndb.transactional(xg=True)
+def takeSeat(conf):
+    """Take one seat from a random non-empty shard; return False
+    when the conference is sold out."""
+    counter = _getCounter(conf)
+    shard_keys = _shardKeys(conf.key, counter.numShards)
+    random.shuffle(shard_keys)
+    # only the shards we actually read join the transaction, so
+    # concurrent registrations rarely touch the same entity group
+    for s_key in shard_keys:
+        shard = s_key.get()
+        if shard and shard.count > 0:
+            shard.count -= 1
+            shard.put()
+            ndb.get_context().call_on_commit(
+                lambda: memcache.decr(_cacheKey(conf.key)))
+            return True
+    return False
+
+
+@ndb.transactional(xg=True)
+def returnSeat(conf):
+    """Give one seat back to a random shard."""
+    counter = _getCounter(conf)
+    s_key = random.choice(_shardKeys(conf.key, counter.numShards))
+    shard = s_key.get() or SeatShard(key=s_key)
+    shard.count += 1
+    shard.put()
+    ndb.get_context().call_on_commit(
+        lambda: memcache.incr(_cacheKey(conf.key)))
+
+
+@ndb.transactional(xg=True)
+def resizeCounter(conf, num_shards=None, seats=None):
+    """Redistribute the seats of conf over num_shards shards, optionally
+    resetting the total to seats; return the new number of seats."""
+    counter = _getCounter(conf)
+    old_keys = _shardKeys(conf.key, counter.numShards)
+    if seats is None:
+        seats = sum(shard.count for shard in ndb.get_multi(old_keys) if shard)
+    num_shards = num_shards or counter.numShards
+    if not 0 < num_shards <= MAX_NUM_SHARDS:
+        raise ValueError('Shard count must be between 1 and %d.'
+            % MAX_NUM_SHARDS)
+
+    _writeShards(conf.key, seats, num_shards)
+    # drop shards that are no longer part of the counter
+    ndb.delete_multi(old_keys[num_shards:])
+    ndb.get_context().call_on_commit(
+        lambda: memcache.set(_cacheKey(conf.key), seats,
+            time=SEATS_CACHE_TIME))
+    return seats
+
+
+def getSeats(conf):
+    """Return the number of seats available for conf."""
+    return getSeatsMulti([conf])[conf.key]
+
+
+def getExactSeats(conf):
+    """Return the seats available for conf summed from its shards,
+    skipping the memcache aggregate, which may lag behind a
+    registration by up to SEATS_CACHE_TIME."""
+    counter = _counterKey(conf.key).get()
+    if not counter:
+        return conf.seatsAvailable or 0
+    return sum(shard.count for shard in ndb.get_multi(
+        _shardKeys(conf.key, counter.numShards)) if shard)
+
+
+def getSeatsMulti(confs):
+    """Return a dict of conference key -> seats available, reading
+    the memcache aggregate first and summing shards for the misses."""
+    snapshots = dict((conf.key, conf.seatsAvailable) for conf in confs)
+    return _getSeats(snapshots.keys(),
+        lambda c_keys: [snapshots[c_key] for c_key in c_keys])
+
+
+def getSeatsForKeys(c_keys):
+    """Like getSeatsMulti, for conference keys; conferences are only
+    loaded if they have no counter yet."""
+    return _getSeats(c_keys, lambda c_keys: [getattr(conf, 'seatsAvailable',
+        0) for conf in ndb.get_multi(c_keys)])
+
+
+def _getSeats(c_keys, snapshots):
+    """Return a dict of conference key -> seats available; snapshots
+    maps a list of keys to their Conference.seatsAvailable values."""
+    seats = {}
+    cached = memcache.get_multi([_cacheKey(c_key) for c_key in c_keys])
+    missing = []
+    for c_key in c_keys:
+        count = cached.get(_cacheKey(c_key))
+        if count is None:
+            missing.append(c_key)
+        else:
+            seats[c_key] = count
+    if not missing:
+        return seats
+
+    counters = ndb.get_multi([_counterKey(c_key) for c_key in missing])
+    shard_keys = {}
+    uncounted = []
+    for c_key, counter in zip(missing, counters):
+        if counter:
+            shard_keys[c_key] = _shardKeys(c_key, counter.numShards)
+        else:
+            uncounted.append(c_key)
+    # counter not created yet, the entity is still authoritative
+    for c_key, count in zip(uncounted, snapshots(uncounted) if uncounted
+            else []):
+        seats[c_key] = count or 0
+    all_keys = [s_key for keys in shard_keys.values() for s_key in keys]
+    shards = dict(zip(all_keys, ndb.get_multi(all_keys)))
+    for c_key, keys in shard_keys.items():
+        seats[c_key] = sum(shards[s_key].count for s_key in keys
+            if shards[s_key])
+
+    memcache.set_multi(dict((_cacheKey(c_key), seats[c_key])
+        for c_key in missing), time=SEATS_CACHE_TIME)
+    return seats
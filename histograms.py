@@ -0,0 +1,64 @@
+#!/usr/bin/env python
+
+"""
+histograms.py -- per-conference tee-shirt size histograms
+
+Counting tee-shirt sizes used to query every attendee Profile of a
+conference. The counts are now kept up to date on registration and on
+profile changes, in a few root-level shards so concurrent registrations
+rarely write the same entity group.
+
+"""
+
+import random
+
+from google.appengine.ext import ndb
+
+from models import TeeShirtShard
+
+
+NUM_SHARDS = 10
+
+
+def _shardKeys(conf_key):
+    """Return the TeeShirtShard keys of a conference."""
+    return [ndb.Key(TeeShirtShard, '%s-%d' % (conf_key.urlsafe(), i))
+        for i in range(NUM_SHARDS)]
+
+
+@ndb.transactional(xg=True)
+def addSizes(conf_key, changes):
+    """Apply a dict of size -> delta to one random shard of conf_key."""
+    s_key = random.choice(_shardKeys(conf_key))
+    shard = s_key.get() or TeeShirtShard(key=s_key)
+    counts = shard.counts or {}
+    for size, delta in changes.items():
+        counts[size] = counts.get(size, 0) + delta
+    shard.counts = counts
+    shard.put()
+
+
+def addSize(conf_key, size, delta=1):
+    """Count one more (or, with delta=-1, one less) attendee of size."""
+    addSizes(conf_key, {size: delta})
+
+
+def getCounts(conf_key):
+    """Return a dict of size -> number of attendees of conf_key."""
+    counts = {}
+    for shard in ndb.get_multi(_shardKeys(conf_key)):
+        for size, count in (shard and shard.counts or {}).items():
+            counts[size] = counts.get(size, 0) + count
+    return dict((size, count) for size, count in counts.items() if count)
+
+
+def rebuild(conf_key, sizes):
+    """Replace the histogram of conf_key with the given attendee sizes."""
+    counts = {}
+    for size in sizes:
+        counts[size] = counts.get(size, 0) + 1
+    shards = [TeeShirtShard(key=s_key) for s_key in _shardKeys(conf_key)]
+    shards[0].counts = counts
+    for shard in shards[1:]:
+        shard.counts = {}
+    ndb.put_multi(shards)
@@ -0,0 +1,153 @@
+#!/usr/bin/env python
+
+"""
+instrumentation.py -- per-endpoint RPC & latency statistics
+
+ConferenceApi methods are declared with instrumentation.method instead
+of endpoints.method. A sampled call records its wall time and, through
+an apiproxy post-call hook, the datastore gets/queries/puts, memcache
+hits/misses, taskqueue adds and urlfetch calls it made.
+
+A sample is recorded as one stats.py record, into counters of the
+current WINDOW seconds long time window. getStats() adds up the last
+WINDOWS windows, so the numbers roll over about once an hour.
+
+The share of calls sampled is INSTRUMENTATION_SAMPLE_RATE (app.yaml).
+
+"""
+
+import bisect
+import functools
+import os
+import random
+import threading
+import time
+
+import endpoints
+from google.appengine.api import apiproxy_stub_map
+
+import stats
+
+
+SAMPLE_RATE = float(os.getenv('INSTRUMENTATION_SAMPLE_RATE', '0.1'))
+WINDOW = 600
+WINDOWS = 6
+STAT_NAME = 'endpoint.%d.%s.%s'
+
+# upper bounds (ms) of the latency histogram buckets
+LATENCY_BUCKETS = (10, 25, 50, 100, 250, 500, 1000, 2500, 5000)
+
+RPC_COUNTERS = ('datastore_get', 'datastore_query', 'datastore_put',
+    'memcache_hit', 'memcache_miss', 'taskqueue_add', 'urlfetch')
+COUNTERS = ('calls', 'wall_ms') + RPC_COUNTERS + tuple('latency_%s' % bound
+    for bound in LATENCY_BUCKETS + ('inf',))
+
+# names of the instrumented methods
+METHODS = []
+
+_local = threading.local()
+
+
+def _hook(service, call, request, response):
+    """Count the RPCs of the sample recorded on this thread."""
+    sample = getattr(_local, 'sample', None)
+    if sample is None:
+        return
+    if service == 'datastore_v3':
+        if call == 'Get':
+            sample['datastore_get'] += 1
+        elif call in ('RunQuery', 'Next'):
+            sample['datastore_query'] += 1
+        elif call == 'Put':
+            sample['datastore_put'] += 1
+    elif service == 'memcache' and call == 'Get':
+        hits = response.item_size()
+        sample['memcache_hit'] += hits
+        sample['memcache_miss'] += request.key_size() - hits
+    elif service == 'taskqueue' and call in ('Add', 'BulkAdd'):
+        sample['taskqueue_add'] += 1
+    elif service == 'urlfetch':
+        sample['urlfetch'] += 1
+
+apiproxy_stub_map.apiproxy.GetPostCallHooks().Append(
+    'instrumentation', _hook)
+
+
+def _record(name, sample):
+    """Record a finished sample of method name."""
+    window = int(time.time()) // WINDOW
+    stats.recordMulti(dict((STAT_NAME % (window, name, counter), value)
+        for counter, value in sample.items() if value))
+
+
+def _instrument(name, func):
+    @functools.wraps(func)
+    def wrapper(self, request):
+        if getattr(_local, 'sample', None) is not None or \
+                random.random() >= SAMPLE_RATE:
+            # not sampled, or called by another endpoint method
+            return func(self, request)
+        _local.sample = sample = dict.fromkeys(RPC_COUNTERS, 0)
+        start = time.time()
+        try:
+            return func(self, request)
+        finally:
+            _local.sample = None
+            wall_ms = int((time.time() - start) * 1000)
+            sample['calls'] = 1
+            sample['wall_ms'] = wall_ms
+            bucket = (LATENCY_BUCKETS + ('inf',))[
+                bisect.bisect_left(LATENCY_BUCKETS, wall_ms)]
+            sample['latency_%s' % bucket] = 1
+            _record(name, sample)
+    return wrapper
+
+
+def method(*args, **kwargs):
+    """endpoints.method that also instruments the decorated method."""
+    def decorator(func):
+        name = kwargs.get('name', func.__name__)
+        METHODS.append(name)
+        return endpoints.method(*args, **kwargs)(_instrument(name, func))
+    return decorator
+
+
+def _percentile(histogram, calls, percent):
+    """Return the upper bound of the latency bucket holding percent of
+    the calls."""
+    rank = percent / 100.0 * calls
+    seen = 0
+    for bound in LATENCY_BUCKETS + ('inf',):
+        seen += histogram[bound]
+        if seen >= rank:
+            return bound
+    return 'inf'
+
+
+def getStats():
+    """Return a dict of method name -> summed counters, latency
+    histogram, p50/p95 bucket and mean RPCs per sampled call over the
+    last WINDOWS windows."""
+    current = int(time.time()) // WINDOW
+    windows = range(current - WINDOWS + 1, current + 1)
+    values = stats.getStats([STAT_NAME % (window, name, counter)
+        for window in windows for name in METHODS for counter in COUNTERS])
+
+    result = {}
+    for name in METHODS:
+        totals = dict((counter, sum(values[STAT_NAME % (window, name,
+            counter)] for window in windows)) for counter in COUNTERS)
+        calls = totals.pop('calls')
+        if not calls:
+            continue
+        histogram = dict((bound, totals.pop('latency_%s' % bound))
+            for bound in LATENCY_BUCKETS + ('inf',))
+        summary = {'sampled_calls': calls, 'latency_ms_histogram':
+            dict((str(bound), count) for bound, count in histogram.items()),
+            'p50_ms': _percentile(histogram, calls, 50),
+            'p95_ms': _percentile(histogram, calls, 95)}
+        for counter, total in totals.items():
+            summary['mean_' + counter] = float(total) / calls
+        result[name] = summary
+    return {'sample_rate': SAMPLE_RATE, 'window_seconds': WINDOW * WINDOWS,
+        'methods': result}
@@ -12,10 +12,29 @@ created by wesc on 2014 may 24
 
 __author__ = 'wesc+api@google.com (Wesley Chun)'
 
+import json
+import logging
+from datetime import datetime
+
 import webapp2
-from google.appengine.api import app_identity
-from google.appengine.api import mail
+from google.appengine.api import taskqueue
+from google.appengine.datastore.datastore_query import Cursor
+from google.appengine.ext import ndb
 from conference import ConferenceApi
+from models import Conference
+from models import MapperState
+from models import Profile
+from models import Session
+
+import announcements
+import instrumentation
+import notifications
+import profiles
+import querycache
+import reservations
+import responses
+import roster
+import stats
 
 
 class SetAnnouncementHandler(webapp2.RequestHandler):
@@ -24,33 +43,304 @@ class SetAnnouncementHandler(webapp2.RequestHandler):
         ConferenceApi._cacheAnnouncement()
 
 
-class SendConfirmationEmailHandler(webapp2.RequestHandler):
+class RefreshAnnouncementHandler(webapp2.RequestHandler):
     def post(self):
-        """Send email confirming Conference creation."""
-        mail.send_mail(
-            'noreply@%s.appspotmail.com' % (
-                app_identity.get_application_id()),     # from
-            self.request.get('email'),                  # to
-            'You created a new Conference!',            # subj
-            'Hi, you have created a following '         # body
-            'conference:\r\n\r\n%s' % self.request.get(
-                'conferenceInfo')
-        )
-# - - - Task4 additional class - - - - - - - - - - - - - - - -
-
-class SetFeaturedSpeakerHandler(webapp2.RequestHandler):
+        """Reload a stale Announcement into Memcache."""
+        announcements.refresh()
+
+
+class SendNotificationsHandler(webapp2.RequestHandler):
+    def get(self):
+        """Send queued notifications (eg. Conference confirmations)
+        as per-recipient digests."""
+        notifications.run()
+
+class UpdateOrganizerNameHandler(webapp2.RequestHandler):
     def post(self):
-        """Set Featured Speaker in Memcache."""
-        # call the _cacheFeaturedSpeaker method passing in
-        # required arguments from the request
-        ConferenceApi._cacheFeaturedSpeaker(
-            self.request.get('websafeConferenceKey'), 
-            self.request.get('sessionSpeaker'))
+        """Copy an organizer's new displayName onto their conferences."""
+        ConferenceApi._updateOrganizerName(self.request.get('userId'))
+
+
+class CommitReservationsHandler(webapp2.RequestHandler):
+    def get(self):
+        """Commit reservations whose worker task got lost."""
+        ConferenceApi._commitReservations()
+
+    def post(self):
+        """Commit a batch of a conference's pending reservations, then
+        chain the next batch."""
+        wsck = self.request.get('websafeConferenceKey')
+        if ConferenceApi._commitReservations(wsck):
+            taskqueue.add(params={'websafeConferenceKey': wsck},
+                url=self.request.path, queue_name=reservations.COMMIT_QUEUE)
+
+
+class MapperHandler(webapp2.RequestHandler):
+    """Cursor-walking mapper: GET starts a run, every POST task maps one
+    slice of query() with map(entity) and chains the next slice. map
+    returns the entities to write (one, a list or None); they are
+    written with put_multi in PUT_BATCH_SIZE batches, up to
+    concurrency batches in flight. With KEYS_ONLY set, map is passed
+    the keys of the query instead.
+
+    Progress is checkpointed in a MapperState after every slice, in the
+    same transaction that enqueues the next slice, so a retried task
+    never checkpoints a slice twice. A slice still failing after
+    MAX_RETRIES marks the run FAILED; GET with resume=1 continues it
+    from the last checkpoint. slice_size and concurrency parameters
+    override the defaults for a run. A slice that failed after writing
+    is mapped again, so map must be idempotent."""
+    SLICE_SIZE = 200
+    CONCURRENCY = 4
+    PUT_BATCH_SIZE = 50
+    MAX_RETRIES = 5
+    KEYS_ONLY = False
+
+    query = None
+    map = None
+
+    def written(self, entities):
+        """Called with the entities written by a slice."""
+
+    def get(self):
+        """Start the mapper, or with resume=1 continue its last run."""
+        state = MapperState.get_by_id(self.request.path)
+        resume = self.request.get('resume') and state and \
+            state.status != 'DONE'
+        if state and state.status == 'RUNNING' and not resume:
+            self.response.write('Mapper already running.')
+            return
+        if not resume:
+            state = MapperState(id=self.request.path,
+                run=state.run + 1 if state else 1, started=datetime.utcnow())
+        state.sliceSize = int(self.request.get('slice_size') or
+            state.sliceSize or self.SLICE_SIZE)
+        state.concurrency = int(self.request.get('concurrency') or
+            state.concurrency or self.CONCURRENCY)
+        state.status = 'RUNNING'
+        state.error = None
+        state.updated = datetime.utcnow()
+        self._schedule(state)
+        self.response.write('Mapper %s.' % ('resumed' if resume else 'started'))
+
+    def post(self):
+        """Map one slice, then checkpoint it and chain the next one."""
+        run = int(self.request.get('run') or 0)
+        slice_ = int(self.request.get('slice') or 0)
+        state = MapperState.get_by_id(self.request.path)
+        if not self._current(state, run, slice_):
+            # a duplicate task or one of an older run
+            return
+        try:
+            entities, cursor, more = self.query().fetch_page(
+                state.sliceSize, start_cursor=state.cursor and
+                Cursor(urlsafe=state.cursor), keys_only=self.KEYS_ONLY)
+            changed = []
+            for entity in entities:
+                result = self.map(entity)
+                if isinstance(result, list):
+                    changed.extend(result)
+                elif result is not None:
+                    changed.append(result)
+            self._putAll(changed, state.concurrency)
+            self.written(changed)
+        except Exception as e:
+            retries = int(self.request.headers.get(
+                'X-AppEngine-TaskRetryCount', 0))
+            if retries < self.MAX_RETRIES:
+                # the task queue retries the slice
+                raise
+            logging.exception('Mapper %s failed', self.request.path)
+            self._fail(run, slice_, repr(e))
+            return
+        self._advance(run, slice_, cursor.urlsafe() if more and cursor
+            else None, len(entities), len(changed))
+
+    def _putAll(self, entities, concurrency):
+        """put_multi entities in batches, concurrency batches at a time."""
+        in_flight = []
+        for i in range(0, len(entities), self.PUT_BATCH_SIZE):
+            if len(in_flight) >= concurrency:
+                for future in in_flight.pop(0):
+                    future.check_success()
+            in_flight.append(ndb.put_multi_async(
+                entities[i:i + self.PUT_BATCH_SIZE]))
+        for futures in in_flight:
+            for future in futures:
+                future.check_success()
+
+    def _current(self, state, run, slice_):
+        return bool(state and state.status == 'RUNNING' and
+            state.run == run and state.slice == slice_)
+
+    @ndb.transactional()
+    def _schedule(self, state):
+        """Write state and enqueue the task of its current slice."""
+        state.put()
+        taskqueue.add(url=self.request.path, transactional=True,
+            params={'run': state.run, 'slice': state.slice})
+
+    @ndb.transactional()
+    def _advance(self, run, slice_, cursor, processed, written):
+        """Checkpoint a mapped slice; chain the next one or finish."""
+        state = MapperState.get_by_id(self.request.path)
+        if not self._current(state, run, slice_):
+            return
+        state.slice += 1
+        state.cursor = cursor
+        state.processed += processed
+        state.written += written
+        state.updated = datetime.utcnow()
+        if cursor:
+            self._schedule(state)
+        else:
+            state.status = 'DONE'
+            state.put()
+
+    @ndb.transactional()
+    def _fail(self, run, slice_, error):
+        state = MapperState.get_by_id(self.request.path)
+        if self._current(state, run, slice_):
+            state.status = 'FAILED'
+            state.error = error
+            state.updated = datetime.utcnow()
+            state.put()
+
+
+class BackfillOrganizerNamesHandler(MapperHandler):
+    """Set organizerDisplayName on existing conferences."""
+    query = staticmethod(Conference.query)
+    map = staticmethod(ConferenceApi._setOrganizerName)
+
+    def written(self, confs):
+        ConferenceApi._conferencesChanged([conf.key for conf in confs])
+
+
+class MigrateSessionsHandler(MapperHandler):
+    """Store the computed properties of existing sessions."""
+    query = staticmethod(Session.query)
+    # rewriting a session stores its computed properties
+    map = staticmethod(lambda sess: sess)
+
+
+class BackfillConferenceMonthsHandler(MapperHandler):
+    """Set month from startDate on existing conferences."""
+    query = staticmethod(Conference.query)
+    map = staticmethod(ConferenceApi._setConferenceMonth)
+
+    def written(self, confs):
+        ConferenceApi._conferencesChanged([conf.key for conf in confs])
+
+
+class NormalizeTeeShirtSizesHandler(MapperHandler):
+    """Map free-form tee-shirt sizes of existing profiles to TeeShirtSize
+    names; run rebuild_tee_shirt_histograms afterwards."""
+    query = staticmethod(Profile.query)
+    map = staticmethod(ConferenceApi._normalizeTeeShirtSize)
+
+    def written(self, profs):
+        profiles.dropCached([prof.key.id() for prof in profs])
+
+
+class MigrateProfilesHandler(MapperHandler):
+    """Move profile attendance & wishlist lists to their own entities."""
+    query = staticmethod(Profile.query)
+    map = staticmethod(ConferenceApi._migrateProfile)
+
+
+class RebuildRostersHandler(MapperHandler):
+    """Rebuild the attendee rosters from the registrations."""
+    query = staticmethod(Conference.query)
+    KEYS_ONLY = True
+    map = staticmethod(roster.rebuild)
+
+
+class BackfillSpeakersHandler(MapperHandler):
+    """Link existing sessions to Speaker entities."""
+    query = staticmethod(Session.query)
+    map = staticmethod(ConferenceApi._linkSpeaker)
+
+
+class IndexConferencesHandler(MapperHandler):
+    """Add existing conferences to the search index."""
+    query = staticmethod(Conference.query)
+    map = staticmethod(ConferenceApi._indexDocument)
+
+
+class IndexSessionsHandler(MapperHandler):
+    """Add existing sessions to the search index."""
+    query = staticmethod(Session.query)
+    map = staticmethod(ConferenceApi._indexDocument)
+
+
+class RebuildTeeShirtHistogramsHandler(MapperHandler):
+    """Recount the tee-shirt histograms of existing conferences."""
+    query = staticmethod(Conference.query)
+    KEYS_ONLY = True
+    map = staticmethod(ConferenceApi._rebuildTeeShirtHistogram)
+
+
+class RebuildSpeakerIndexesHandler(MapperHandler):
+    """Rebuild the speaker indexes of existing conferences."""
+    query = staticmethod(Conference.query)
+    KEYS_ONLY = True
+    map = staticmethod(ConferenceApi._rebuildSpeakerIndex)
+
+
+class CacheStatsHandler(webapp2.RequestHandler):
+    def get(self):
+        """Return cache hit/miss & notification counters as JSON."""
+        self.response.headers['Content-Type'] = 'application/json'
+        self.response.write(json.dumps(stats.getStats(
+            profiles.STAT_NAMES + responses.STAT_NAMES +
+            querycache.STAT_NAMES + notifications.STAT_NAMES)))
+
+class MapperProgressHandler(webapp2.RequestHandler):
+    def get(self):
+        """Return the progress & rate of every mapper run as JSON."""
+        progress = {}
+        for state in MapperState.query():
+            elapsed = (state.updated - state.started).total_seconds() \
+                if state.started and state.updated else 0
+            progress[state.key.id()] = {'status': state.status,
+                'run': state.run, 'slices': state.slice,
+                'processed': state.processed, 'written': state.written,
+                'slice_size': state.sliceSize,
+                'concurrency': state.concurrency,
+                'started': str(state.started), 'updated': str(state.updated),
+                'elapsed_seconds': elapsed,
+                'entities_per_second': state.processed / elapsed
+                    if elapsed else None,
+                'error': state.error}
+        self.response.headers['Content-Type'] = 'application/json'
+        self.response.write(json.dumps(progress, sort_keys=True))
+
+class EndpointStatsHandler(webapp2.RequestHandler):
+    def get(self):
+        """Return sampled per-endpoint RPC counts & latencies as JSON."""
+        self.response.headers['Content-Type'] = 'application/json'
+        self.response.write(json.dumps(instrumentation.getStats()))
 
 app = webapp2.WSGIApplication([
     ('/crons/set_announcement', SetAnnouncementHandler),
-    ('/tasks/send_confirmation_email', SendConfirmationEmailHandler),
-    # add the url for the task
-    ('/tasks/set_featured_speaker', SetFeaturedSpeakerHandler)
+    ('/crons/send_notifications', SendNotificationsHandler),
+    ('/tasks/refresh_announcement', RefreshAnnouncementHandler),
+    ('/tasks/update_organizer_name', UpdateOrganizerNameHandler),
+    ('/tasks/commit_reservations', CommitReservationsHandler),
+    ('/crons/commit_reservations', CommitReservationsHandler),
+    ('/tasks/backfill_organizer_names', BackfillOrganizerNamesHandler),
+    ('/tasks/migrate_sessions', MigrateSessionsHandler),
+    ('/tasks/migrate_profiles', MigrateProfilesHandler),
+    ('/tasks/rebuild_tee_shirt_histograms', RebuildTeeShirtHistogramsHandler),
+    ('/tasks/rebuild_rosters', RebuildRostersHandler),
+    ('/tasks/backfill_speakers', BackfillSpeakersHandler),
+    ('/tasks/rebuild_speaker_indexes', RebuildSpeakerIndexesHandler),
+    ('/tasks/backfill_conference_months', BackfillConferenceMonthsHandler),
+    ('/tasks/normalize_tee_shirt_sizes', NormalizeTeeShirtSizesHandler),
+    ('/tasks/index_conferences', IndexConferencesHandler),
+    ('/tasks/index_sessions', IndexSessionsHandler),
+    ('/admin/cache_stats', CacheStatsHandler),
+    ('/admin/endpoint_stats', EndpointStatsHandler),
+    ('/admin/mapper_progress', MapperProgressHandler),
 ], debug=True)
 
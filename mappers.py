@@ -0,0 +1,133 @@
+#!/usr/bin/env python
+
+"""
+mappers.py -- precompiled entity -> ProtoRPC message converters
+
+The _copy*ToForm methods used to walk all_fields() of the form for every
+entity, checking hasattr() and field name suffixes each time. A Mapper
+does that work once per (model, message) pair, when it is registered at
+import time, and keeps a list of (field name, getter) pairs; converting
+an entity is then a single pass over that list.
+
+Websafe keys are cached, since the same keys (eg. the conferences in a
+profile) are encoded over and over.
+
+"""
+
+import operator
+
+from google.appengine.ext import ndb
+from protorpc import messages
+
+from models import Conference
+from models import ConferenceForm
+from models import ConferenceSummaryForm
+from models import Profile
+from models import ProfileForm
+from models import Reservation
+from models import ReservationForm
+from models import Session
+from models import SessionForm
+from models import SessionSummaryForm
+
+
+MAX_CACHED_KEYS = 10000
+
+_urlsafe_keys = {}
+
+
+def urlsafe(key):
+    """Return key.urlsafe(), cached."""
+    try:
+        return _urlsafe_keys[key]
+    except KeyError:
+        if len(_urlsafe_keys) >= MAX_CACHED_KEYS:
+            _urlsafe_keys.clear()
+        value = _urlsafe_keys[key] = key.urlsafe()
+        return value
+
+
+def _toStr(value):
+    return str(value) if value is not None else None
+
+
+def _getter(prop, field):
+    """Return a function reading prop from an entity and converting it
+    to the type of message field."""
+    get = operator.attrgetter(prop._code_name)
+    if isinstance(prop, (ndb.DateProperty, ndb.TimeProperty,
+            ndb.DateTimeProperty)):
+        convert = _toStr
+    elif isinstance(prop, ndb.KeyProperty):
+        convert = urlsafe
+    elif isinstance(field, messages.EnumField):
+        # stored as the name of the enum value
+        enum = field.type
+        convert = lambda value: enum(value) if value is not None else None
+    else:
+        return get
+    if prop._repeated:
+        return lambda entity: [convert(value) for value in get(entity)]
+    return lambda entity: convert(get(entity))
+
+
+class Mapper(object):
+    """Mapper -- converts model entities to message forms"""
+
+    def __init__(self, model, message):
+        self.model = model
+        self.message = message
+        self.getters = []
+        props = model._properties
+        for field in message.all_fields():
+            if field.name in props:
+                self.getters.append((field.name,
+                    _getter(props[field.name], field)))
+            elif field.name == 'websafeKey':
+                self.getters.append((field.name,
+                    lambda entity: urlsafe(entity.key)))
+        # only required fields can leave a form uninitialized
+        self.check = any(field.required for field in message.all_fields())
+
+    def toForm(self, entity, **values):
+        """Return the form of entity; values override copied fields."""
+        form = self.message()
+        for name, get in self.getters:
+            if name not in values:
+                setattr(form, name, get(entity))
+        for name, value in values.items():
+            setattr(form, name, value)
+        if self.check:
+            form.check_initialized()
+        return form
+
+    def toForms(self, entities, **columns):
+        """Return the forms of entities; every column is a list of
+        override values, one per entity."""
+        if not columns:
+            return [self.toForm(entity) for entity in entities]
+        names = columns.keys()
+        return [self.toForm(entity, **dict(zip(names, row)))
+            for entity, row in zip(entities, zip(*columns.values()))]
+
+
+_mappers = {}
+
+
+def register(model, message):
+    """Build and register the Mapper of (model, message)."""
+    mapper = _mappers[(model, message)] = Mapper(model, message)
+    return mapper
+
+
+def getMapper(model, message):
+    """Return the registered Mapper of (model, message)."""
+    return _mappers[(model, message)]
+
+
+register(Conference, ConferenceForm)
+register(Conference, ConferenceSummaryForm)
+register(Session, SessionForm)
+register(Session, SessionSummaryForm)
+register(Profile, ProfileForm)
+register(Reservation, ReservationForm)
@@ -17,6 +17,8 @@ import endpoints
 from protorpc import messages
 from google.appengine.ext import ndb
 
+import buckets
+
 class ConflictException(endpoints.ServiceException):
     """ConflictException -- exception mapped to HTTP 409 response"""
     http_status = httplib.CONFLICT
@@ -26,8 +28,29 @@ class Profile(ndb.Model):
     displayName = ndb.StringProperty()
     mainEmail = ndb.StringProperty()
     teeShirtSize = ndb.StringProperty(default='NOT_SPECIFIED')
-    conferenceKeysToAttend = ndb.KeyProperty(kind='Conference', repeated=True)
-    sessionKeysToAttend = ndb.KeyProperty(kind='Session', repeated=True)
+    # legacy, moved to Registration & WishlistEntry (see registrations.py)
+    conferenceKeysToAttend = ndb.KeyProperty(kind='Conference', repeated=True,
+                                indexed=False)
+    sessionKeysToAttend = ndb.KeyProperty(kind='Session', repeated=True,
+                                indexed=False)
+
+class Registration(ndb.Model):
+    """Registration -- Profile (parent) attends Conference"""
+    conference = ndb.KeyProperty(kind='Conference')
+    rosterChunk = ndb.KeyProperty(kind='RosterChunk', indexed=False)
+
+class Reservation(ndb.Model):
+    """Reservation -- queued registration of the parent Profile for a
+    Conference, keyed by its websafe key"""
+    conference      = ndb.KeyProperty(kind='Conference')
+    status          = ndb.StringProperty(default='PENDING',
+                        choices=('PENDING', 'CONFIRMED', 'FAILED'))
+    created         = ndb.DateTimeProperty(auto_now_add=True)
+    error           = ndb.StringProperty(indexed=False)
+
+class WishlistEntry(ndb.Model):
+    """WishlistEntry -- Session on the wishlist of Profile (parent)"""
+    session = ndb.KeyProperty(kind='Session', indexed=False)
 
 class ProfileMiniForm(messages.Message):
     """ProfileMiniForm -- update Profile form message"""
@@ -42,15 +65,47 @@ class ProfileForm(messages.Message):
     conferenceKeysToAttend = messages.StringField(4, repeated=True)
     sessionKeysToAttend = messages.StringField(5, repeated=True)
 
+class BatchResultForm(messages.Message):
+    """BatchResultForm -- outcome of one item of a batch request"""
+    index = messages.IntegerField(1)
+    success = messages.BooleanField(2, default=False)
+    websafeKey = messages.StringField(3)
+    error = messages.StringField(4)
+
+class BatchResultForms(messages.Message):
+    """BatchResultForms -- outcome of every item of a batch request"""
+    items = messages.MessageField(BatchResultForm, 1, repeated=True)
+
 class BooleanMessage(messages.Message):
     """BooleanMessage-- outbound Boolean value message"""
     data = messages.BooleanField(1)
 
+class RegistrationResultForm(messages.Message):
+    """RegistrationResultForm -- registration outbound form message;
+    queued registrations return a reservation token"""
+    data = messages.BooleanField(1)
+    reservationToken = messages.StringField(2)
+
+class ReservationStatus(messages.Enum):
+    """ReservationStatus -- queued registration status enumeration value"""
+    PENDING = 1
+    CONFIRMED = 2
+    FAILED = 3
+
+class ReservationForm(messages.Message):
+    """ReservationForm -- Reservation outbound form message"""
+    websafeKey      = messages.StringField(1)
+    websafeConferenceKey = messages.StringField(2)
+    status          = messages.EnumField('ReservationStatus', 3)
+    created         = messages.StringField(4)
+    error           = messages.StringField(5)
+
 class Conference(ndb.Model):
     """Conference -- Conference object"""
     name            = ndb.StringProperty(required=True)
     description     = ndb.StringProperty()
     organizerUserId = ndb.StringProperty()
+    organizerDisplayName = ndb.StringProperty(indexed=False)
     topics          = ndb.StringProperty(repeated=True)
     city            = ndb.StringProperty()
     startDate       = ndb.DateProperty()
@@ -58,6 +113,49 @@ class Conference(ndb.Model):
     maxAttendees    = ndb.IntegerProperty()
     seatsAvailable  = ndb.IntegerProperty()
     endDate         = ndb.DateProperty()
+    queuedRegistration = ndb.BooleanProperty(default=False, indexed=False)
+
+class SeatCounter(ndb.Model):
+    """SeatCounter -- shard configuration of a Conference seat counter"""
+    numShards = ndb.IntegerProperty(default=5, indexed=False)
+
+class SeatShard(ndb.Model):
+    """SeatShard -- one shard of a Conference seat counter"""
+    count = ndb.IntegerProperty(default=0, indexed=False)
+
+class TeeShirtShard(ndb.Model):
+    """TeeShirtShard -- one shard of a Conference tee-shirt histogram"""
+    counts = ndb.JsonProperty()
+
+class RosterShard(ndb.Model):
+    """RosterShard -- one shard of a Conference attendee roster"""
+    conference = ndb.KeyProperty(kind='Conference', indexed=False)
+    numChunks = ndb.IntegerProperty(default=0, indexed=False)
+    count = ndb.IntegerProperty(default=0, indexed=False)
+
+class RosterChunk(ndb.Model):
+    """RosterChunk -- [user id, display name] pairs of a RosterShard (parent)"""
+    conference = ndb.KeyProperty(kind='Conference')
+    attendees = ndb.JsonProperty()
+
+class MapperState(ndb.Model):
+    """MapperState -- checkpoint of a mapper run, keyed by job URL"""
+    run             = ndb.IntegerProperty(default=0, indexed=False)
+    slice           = ndb.IntegerProperty(default=0, indexed=False)
+    cursor          = ndb.StringProperty(indexed=False)
+    status          = ndb.StringProperty(indexed=False,
+                        choices=('RUNNING', 'DONE', 'FAILED'))
+    sliceSize       = ndb.IntegerProperty(indexed=False)
+    concurrency     = ndb.IntegerProperty(indexed=False)
+    processed       = ndb.IntegerProperty(default=0, indexed=False)
+    written         = ndb.IntegerProperty(default=0, indexed=False)
+    started         = ndb.DateTimeProperty(indexed=False)
+    updated         = ndb.DateTimeProperty(indexed=False)
+    error           = ndb.TextProperty()
+
+class Announcement(ndb.Model):
+    """Announcement -- websafe keys & names of nearly sold out Conferences"""
+    conferences = ndb.JsonProperty()
 
 class ConferenceForm(messages.Message):
     """ConferenceForm -- Conference outbound form message"""
@@ -73,10 +171,28 @@ class ConferenceForm(messages.Message):
     endDate         = messages.StringField(10) #DateTimeField()
     websafeKey      = messages.StringField(11)
     organizerDisplayName = messages.StringField(12)
+    queuedRegistration = messages.BooleanField(13)
+
+class ConferenceSummaryForm(messages.Message):
+    """ConferenceSummaryForm -- Conference list entry outbound form message"""
+    name            = messages.StringField(1)
+    city            = messages.StringField(2)
+    startDate       = messages.StringField(3)
+    endDate         = messages.StringField(4)
+    seatsAvailable  = messages.IntegerField(5)
+    websafeKey      = messages.StringField(6)
 
 class ConferenceForms(messages.Message):
     """ConferenceForms -- multiple Conference outbound form message"""
     items = messages.MessageField(ConferenceForm, 1, repeated=True)
+    nextPageToken = messages.StringField(2)
+    explain = messages.StringField(3)
+    summaries = messages.MessageField(ConferenceSummaryForm, 4, repeated=True)
+
+class ListView(messages.Enum):
+    """ListView -- FULL forms or SUMMARY forms in list responses"""
+    FULL = 1
+    SUMMARY = 2
 
 class TeeShirtSize(messages.Enum):
     """TeeShirtSize -- t-shirt size enumeration value"""
@@ -96,6 +212,37 @@ class TeeShirtSize(messages.Enum):
     XXXL_M = 14
     XXXL_W = 15
 
+class TeeShirtCount(messages.Message):
+    """TeeShirtCount -- number of attendees of one t-shirt size"""
+    size = messages.EnumField('TeeShirtSize', 1)
+    count = messages.IntegerField(2)
+
+class TeeShirtCounts(messages.Message):
+    """TeeShirtCounts -- t-shirt size histogram outbound form message"""
+    items = messages.MessageField(TeeShirtCount, 1, repeated=True)
+    total = messages.IntegerField(2)
+
+class AttendeeForm(messages.Message):
+    """AttendeeForm -- Conference attendee outbound form message"""
+    displayName = messages.StringField(1)
+    teeShirtSize = messages.EnumField('TeeShirtSize', 2)
+
+class AttendeeForms(messages.Message):
+    """AttendeeForms -- multiple AttendeeForm outbound form message"""
+    items = messages.MessageField(AttendeeForm, 1, repeated=True)
+    nextPageToken = messages.StringField(2)
+
+class RosterEntryForm(messages.Message):
+    """RosterEntryForm -- Conference roster entry outbound form message"""
+    userId = messages.StringField(1)
+    displayName = messages.StringField(2)
+
+class RosterForms(messages.Message):
+    """RosterForms -- page of a Conference roster outbound form message"""
+    items = messages.MessageField(RosterEntryForm, 1, repeated=True)
+    nextPageToken = messages.StringField(2)
+    count = messages.IntegerField(3)
+
 class ConferenceQueryForm(messages.Message):
     """ConferenceQueryForm -- Conference query inbound form message"""
     field = messages.StringField(1)
@@ -105,6 +252,10 @@ class ConferenceQueryForm(messages.Message):
 class ConferenceQueryForms(messages.Message):
     """ConferenceQueryForms -- multiple ConferenceQueryForm inbound form message"""
     filters = messages.MessageField(ConferenceQueryForm, 1, repeated=True)
+    pageSize = messages.IntegerField(2, variant=messages.Variant.INT32)
+    pageToken = messages.StringField(3)
+    explain = messages.BooleanField(4)
+    view = messages.EnumField('ListView', 5, default='FULL')
 
 class StringMessage(messages.Message):
     """StringMessage-- outbound (single) string message"""
@@ -119,6 +270,40 @@ class Session(ndb.Model):
     sessionType     = ndb.StringProperty()
     date            = ndb.DateProperty()
     startTime       = ndb.TimeProperty()
+    # computed & indexed so time-of-day queries are a single index scan
+    startMinute     = ndb.ComputedProperty(lambda self: self.startTime.hour
+                        * 60 + self.startTime.minute if self.startTime
+                        else None)
+    isWorkshop      = ndb.ComputedProperty(lambda self:
+                        (self.sessionType or '').lower() == 'workshop')
+    # calendar buckets of date, see buckets.py
+    year            = ndb.ComputedProperty(lambda self:
+                        buckets.yearOf(self.date))
+    season          = ndb.ComputedProperty(lambda self:
+                        buckets.seasonOf(self.date))
+    week            = ndb.ComputedProperty(lambda self:
+                        buckets.weekOf(self.date))
+    # Speaker of speaker, see speakers.py
+    speakerKey      = ndb.KeyProperty(kind='Speaker')
+
+class Speaker(ndb.Model):
+    """Speaker -- speaker of Sessions, keyed by canonical name"""
+    name            = ndb.StringProperty(indexed=False)
+    sessionKeys     = ndb.KeyProperty(kind='Session', repeated=True,
+                        indexed=False)
+
+class SpeakerIndex(ndb.Model):
+    """SpeakerIndex -- per-Conference speaker -> session names index"""
+    sessions        = ndb.JsonProperty()
+    featuredSpeaker = ndb.StringProperty(indexed=False)
+
+class SearchPosting(ndb.Model):
+    """SearchPosting -- one shard of the postings of a search term"""
+    postings        = ndb.JsonProperty(compressed=True)
+
+class SearchDocument(ndb.Model):
+    """SearchDocument -- term frequencies of an indexed entity"""
+    terms           = ndb.JsonProperty(compressed=True)
 
 class SessionForm(messages.Message):
     """SessionForm -- Session outbound form message"""
@@ -132,6 +317,17 @@ class SessionForm(messages.Message):
     websafeKey      = messages.StringField(8)
     organizerDisplayName = messages.StringField(9)
 
+class SessionSummaryForm(messages.Message):
+    """SessionSummaryForm -- Session list entry outbound form message"""
+    name            = messages.StringField(1)
+    speaker         = messages.StringField(2)
+    sessionType     = messages.StringField(3)
+    date            = messages.StringField(4)
+    startTime       = messages.StringField(5)
+    websafeKey      = messages.StringField(6)
+
 class SessionForms(messages.Message):
     """SessionForms -- multiple Sessions outbound form message"""
-    items = messages.MessageField(SessionForm, 1, repeated=True)
\ No newline at end of file
+    items = messages.MessageField(SessionForm, 1, repeated=True)
+    nextPageToken = messages.StringField(2)
+    summaries = messages.MessageField(SessionSummaryForm, 3, repeated=True)
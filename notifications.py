@@ -0,0 +1,167 @@
+#!/usr/bin/env python
+
+"""
+notifications.py -- batched email notification pipeline
+
+Producers add notifications to the "notifications" pull queue with
+async RPCs, tagged with the recipient. A cron-driven worker leases them
+a few recipients at a time, all notifications of a recipient in one
+lease, coalesces them into one digest mail per recipient and sends the
+digests over a few threads at a time. A notification is only deleted
+from the queue once its mail went out; otherwise its lease runs out and
+it is retried, up to MAX_SEND_ATTEMPTS times. Notifications whose mail
+can never be sent, eg. to an invalid address, are dropped right away.
+
+"""
+
+import json
+import logging
+import threading
+import time
+import Queue
+
+from google.appengine.api import app_identity
+from google.appengine.api import mail
+from google.appengine.api import taskqueue
+
+import stats
+
+
+NOTIFICATION_QUEUE = 'notifications'
+LEASE_SECONDS = 60
+LEASE_BATCH_SIZE = 100
+MAX_CONCURRENT_SENDS = 5
+# stop leasing new batches after this many seconds
+WORKER_TIME_BUDGET = 50
+# leases after which a notification that was not sent is dropped
+MAX_SEND_ATTEMPTS = 5
+# send_mail errors that retrying does not fix
+PERMANENT_ERRORS = (mail.InvalidEmailError, mail.InvalidSenderError,
+    mail.MissingRecipientsError)
+
+STAT_NAMES = ('notifications.enqueued', 'notifications.leased',
+    'notifications.sent', 'notifications.mails', 'notifications.failed',
+    'notifications.dropped', 'notifications.worker_ms')
+
+
+def enqueueAsync(notifications):
+    """Add (recipient, subject, body) notifications to the queue;
+    return the RPC, the caller must get_result() it before returning."""
+    tasks = [taskqueue.Task(method='PULL', tag=recipient,
+        payload=json.dumps({'to': recipient, 'subject': subject,
+            'body': body})) for recipient, subject, body in notifications]
+    stats.record('notifications.enqueued', len(tasks))
+    return taskqueue.Queue(NOTIFICATION_QUEUE).add_async(tasks)
+
+
+def _digests(tasks):
+    """Group leased tasks by recipient; return a list of
+    (recipient, subject, body, tasks) digests."""
+    by_recipient = {}
+    for task in tasks:
+        by_recipient.setdefault(json.loads(task.payload)['to'], []).append(
+            task)
+
+    digests = []
+    for recipient, group in by_recipient.items():
+        payloads = [json.loads(task.payload) for task in group]
+        if len(payloads) == 1:
+            subject, body = payloads[0]['subject'], payloads[0]['body']
+        else:
+            subject = 'You have %d new notifications' % len(payloads)
+            body = '\r\n\r\n- - - - -\r\n\r\n'.join(
+                '%s\r\n\r\n%s' % (p['subject'], p['body']) for p in payloads)
+        digests.append((recipient, subject, body, group))
+    return digests
+
+
+def _sendAll(digests):
+    """Send digests on at most MAX_CONCURRENT_SENDS threads; return the
+    tasks of the digests that were sent and the tasks to drop."""
+    sender = 'noreply@%s.appspotmail.com' % app_identity.get_application_id()
+    pending = Queue.Queue()
+    for digest in digests:
+        pending.put(digest)
+    sent = []
+    dropped = []
+    lock = threading.Lock()
+
+    def worker():
+        while True:
+            try:
+                recipient, subject, body, group = pending.get_nowait()
+            except Queue.Empty:
+                return
+            try:
+                mail.send_mail(sender, recipient, subject, body)
+            except PERMANENT_ERRORS:
+                logging.exception('Dropping notifications to %s', recipient)
+                with lock:
+                    dropped.extend(group)
+                continue
+            except Exception:
+                logging.exception('Sending notifications to %s failed',
+                    recipient)
+                stats.record('notifications.failed', len(group))
+                # retry_count is the number of earlier leases
+                with lock:
+                    dropped.extend(task for task in group
+                        if task.retry_count + 1 >= MAX_SEND_ATTEMPTS)
+                continue
+            with lock:
+                sent.extend(group)
+
+    threads = [threading.Thread(target=worker)
+        for i in range(min(MAX_CONCURRENT_SENDS, len(digests)))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return sent, dropped
+
+
+def _lease(queue):
+    """Lease the notifications of up to MAX_CONCURRENT_SENDS recipients,
+    up to LEASE_BATCH_SIZE each."""
+    tasks = []
+    for i in range(MAX_CONCURRENT_SENDS):
+        # without a tag, leases the tasks tagged like the oldest one
+        group = queue.lease_tasks_by_tag(LEASE_SECONDS, LEASE_BATCH_SIZE)
+        if not group:
+            break
+        tasks.extend(group)
+    return tasks
+
+
+def processBatch(queue=None):
+    """Lease, send and delete one batch; return the number leased."""
+    queue = queue or taskqueue.Queue(NOTIFICATION_QUEUE)
+    tasks = _lease(queue)
+    if not tasks:
+        return 0
+    digests = _digests(tasks)
+    sent, dropped = _sendAll(digests)
+    if sent or dropped:
+        queue.delete_tasks(sent + dropped)
+    stats.record('notifications.leased', len(tasks))
+    stats.record('notifications.sent', len(sent))
+    stats.record('notifications.dropped', len(dropped))
+    stats.record('notifications.mails', len(digests))
+    return len(tasks)
+
+
+def run():
+    """Drain the queue batch by batch within WORKER_TIME_BUDGET; return
+    the number of notifications leased."""
+    start = time.time()
+    queue = taskqueue.Queue(NOTIFICATION_QUEUE)
+    leased = 0
+    while time.time() - start < WORKER_TIME_BUDGET:
+        count = processBatch(queue)
+        if not count:
+            break
+        leased += count
+    stats.record('notifications.worker_ms',
+        int((time.time() - start) * 1000))
+    stats.flush()
+    return leased
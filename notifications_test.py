@@ -0,0 +1,115 @@
+#!/usr/bin/env python
+
+"""
+notifications_test.py -- tests of the notification pipeline against the
+    local taskqueue and mail stubs
+
+usage: python notifications_test.py (with $APPENGINE_SDK set as for
+    benchmark.py)
+
+"""
+
+import time
+import unittest
+
+import benchmark
+
+benchmark._fixSysPath(benchmark.DEFAULT_SDK_PATH)
+
+from google.appengine.api import mail
+
+import notifications
+
+
+class NotificationsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.env = benchmark.StubEnvironment()
+        self.send_mail = mail.send_mail
+        self.lease_seconds = notifications.LEASE_SECONDS
+        self.max_attempts = notifications.MAX_SEND_ATTEMPTS
+        # short leases, so a failed send can be retried within a test
+        notifications.LEASE_SECONDS = 1
+
+    def tearDown(self):
+        mail.send_mail = self.send_mail
+        notifications.LEASE_SECONDS = self.lease_seconds
+        notifications.MAX_SEND_ATTEMPTS = self.max_attempts
+        self.env.close()
+
+    def _enqueue(self, recipients):
+        notifications.enqueueAsync([(recipient, 'Subject %d' % i,
+            'Body %d' % i) for i, recipient in enumerate(recipients)]
+            ).get_result()
+
+    def _queued(self):
+        return self.env.testbed.get_stub('taskqueue').get_filtered_tasks(
+            queue_names=[notifications.NOTIFICATION_QUEUE])
+
+    def _mails(self):
+        return self.env.testbed.get_stub('mail').get_sent_messages()
+
+    def _failSends(self, error, times=None):
+        """Make the next times send_mail calls (all if None) raise error."""
+        calls = [0]
+        def send_mail(*args, **kwargs):
+            calls[0] += 1
+            if times is None or calls[0] <= times:
+                raise error
+            return self.send_mail(*args, **kwargs)
+        mail.send_mail = send_mail
+
+    def testEnqueueAndRun(self):
+        self._enqueue(['a@example.com'])
+        self.assertEqual(len(self._queued()), 1)
+        self.assertEqual(notifications.run(), 1)
+        mails = self._mails()
+        self.assertEqual([m.to for m in mails], ['a@example.com'])
+        self.assertEqual(mails[0].subject, 'Subject 0')
+        self.assertEqual(self._queued(), [])
+
+    def testOneDigestPerRecipient(self):
+        recipients = ['user%d@example.com' % (i % 7) for i in range(300)]
+        self._enqueue(recipients)
+        self.assertEqual(notifications.run(), len(recipients))
+        mails = self._mails()
+        self.assertEqual(sorted(m.to for m in mails),
+            sorted(set(recipients)))
+        for m in mails:
+            self.assertEqual(m.subject, 'You have %d new notifications' %
+                recipients.count(m.to))
+        self.assertEqual(self._queued(), [])
+
+    def testFailedSendIsRetried(self):
+        self._failSends(Exception('mail service unavailable'), times=1)
+        self._enqueue(['a@example.com'])
+        self.assertEqual(notifications.run(), 1)
+        self.assertEqual(self._mails(), [])
+        self.assertEqual(len(self._queued()), 1)
+
+        time.sleep(notifications.LEASE_SECONDS + 0.5)
+        self.assertEqual(notifications.run(), 1)
+        self.assertEqual([m.to for m in self._mails()], ['a@example.com'])
+        self.assertEqual(self._queued(), [])
+
+    def testDroppedAfterMaxAttempts(self):
+        notifications.MAX_SEND_ATTEMPTS = 2
+        self._failSends(Exception('mail service unavailable'))
+        self._enqueue(['a@example.com'])
+        self.assertEqual(notifications.run(), 1)
+        self.assertEqual(len(self._queued()), 1)
+
+        time.sleep(notifications.LEASE_SECONDS + 0.5)
+        self.assertEqual(notifications.run(), 1)
+        self.assertEqual(self._queued(), [])
+
+    def testPermanentErrorIsDropped(self):
+        self._failSends(mail.InvalidEmailError('bad address'))
+        self._enqueue(['not an address'])
+        self.assertEqual(notifications.run(), 1)
+        self.assertEqual(self._mails(), [])
+        self.assertEqual(self._queued(), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
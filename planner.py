@@ -0,0 +1,160 @@
+#!/usr/bin/env python
+
+"""
+planner.py -- query planner for queryConferences
+
+Passing every user filter straight to the datastore needed a composite
+index for each combination of fields, and every Conference.put() paid
+for all of them. The planner instead pushes a single filter down to one
+of the declared (field, name) indexes, runs that query keys-only and
+applies the remaining predicates in memory over batched get_multi
+results. As a side effect inequalities on several fields are allowed.
+
+Unfiltered plans can instead be run as a projection query, which the
+SUMMARY list view uses to skip loading whole entities.
+
+"""
+
+import operator
+
+from google.appengine.ext import ndb
+
+from models import Conference
+
+
+# fields with a (field, name) composite index in index.yaml,
+# most selective first
+DECLARED_INDEXES = ('maxAttendees', 'city', 'topics', 'month')
+
+# upper bound of rows looked at for one page
+MAX_SCAN = 1000
+SCAN_BATCH_SIZE = 50
+
+COMPARATORS = {
+    '=':  operator.eq,
+    '!=': operator.ne,
+    '>':  operator.gt,
+    '>=': operator.ge,
+    '<':  operator.lt,
+    '<=': operator.le,
+}
+
+
+def _formatFilter(filtr):
+    return '%s %s %r' % (filtr['field'], filtr['operator'], filtr['value'])
+
+
+class QueryPlan(object):
+    """QueryPlan -- datastore query plus in-memory residual filters"""
+
+    def __init__(self, pushed, residual, index_field=None):
+        self.pushed = pushed
+        self.residual = residual
+        self.index_field = index_field
+        self.projection = None
+        self.scanned = 0
+        self.matched = 0
+
+    def query(self):
+        """Return the keys-only part of the plan as an ndb query."""
+        q = Conference.query()
+        for filtr in self.pushed:
+            q = q.filter(ndb.query.FilterNode(filtr['field'],
+                filtr['operator'], filtr['value']))
+        # an inequality has to be the first sort order
+        if self.pushed and self.pushed[0]['operator'] != '=':
+            q = q.order(ndb.GenericProperty(self.index_field))
+        return q.order(Conference.name, Conference.key)
+
+    def matches(self, conf):
+        """Return True if conf satisfies every residual filter."""
+        for filtr in self.residual:
+            values = getattr(conf, filtr['field'], None)
+            if not isinstance(values, list):
+                values = [values]
+            # like the datastore, a repeated property matches when any
+            # of its values does; missing values never match
+            compare = COMPARATORS[filtr['operator']]
+            if not any(compare(value, filtr['value']) for value in values
+                    if value is not None):
+                return False
+        return True
+
+    def fetchPage(self, page_size, start_cursor=None):
+        """Return (conferences, next_cursor, more) for one page."""
+        it = self.query().iter(keys_only=True, start_cursor=start_cursor,
+            produce_cursors=True, batch_size=SCAN_BATCH_SIZE)
+        results = []
+        cursor = start_cursor
+        unread = False
+        while len(results) < page_size and self.scanned < MAX_SCAN \
+                and it.has_next():
+            keys, cursors = [], []
+            while len(keys) < SCAN_BATCH_SIZE and it.has_next():
+                keys.append(it.next())
+                cursors.append(it.cursor_after())
+            self.scanned += len(keys)
+
+            for i, conf in enumerate(ndb.get_multi(keys)):
+                cursor = cursors[i]
+                if conf and self.matches(conf):
+                    results.append(conf)
+                    if len(results) == page_size:
+                        # the rest of this batch is read again next page
+                        unread = i < len(keys) - 1
+                        break
+        self.matched = len(results)
+        return results, cursor, unread or it.has_next()
+
+    def projectable(self):
+        """Return True if the plan can run as a projection query: a
+        filtered property can't be projected and residual filters
+        need whole entities."""
+        return not self.pushed and not self.residual
+
+    def fetchProjectedPage(self, page_size, projection, start_cursor=None):
+        """Return (projected conferences, next_cursor, more) for one
+        page of a projectable plan."""
+        self.projection = projection
+        results, cursor, more = self.query().fetch_page(page_size,
+            start_cursor=start_cursor, projection=projection)
+        self.scanned = self.matched = len(results)
+        return results, cursor, more
+
+    def explain(self):
+        """Describe the chosen plan and the rows it scanned."""
+        if self.index_field:
+            index = 'Conference(%s, name)' % self.index_field
+        elif self.projection:
+            index = 'Conference(%s)' % ', '.join(self.projection)
+        else:
+            index = 'Conference(name)'
+        return 'index: %s; pushed: %s; in memory: %s; scanned: %d; ' \
+            'matched: %d' % (index,
+            ', '.join(_formatFilter(f) for f in self.pushed) or '-',
+            ', '.join(_formatFilter(f) for f in self.residual) or '-',
+            self.scanned, self.matched)
+
+
+def planConferenceQuery(filters):
+    """Return a QueryPlan for a list of formatted filters.
+
+    The first equality filter on the most selective declared index is
+    pushed down; without one, the range filters on a single declared
+    field are. Everything else is evaluated in memory."""
+    for field in DECLARED_INDEXES:
+        for filtr in filters:
+            if filtr['field'] == field and filtr['operator'] == '=':
+                residual = [f for f in filters if f is not filtr]
+                return QueryPlan([filtr], residual, field)
+
+    # "!=" is never pushed down: ndb would split it into two queries
+    for field in DECLARED_INDEXES:
+        pushed = [f for f in filters if f['field'] == field and
+            f['operator'] not in ('=', '!=')]
+        if pushed:
+            residual = [f for f in filters if not
+                any(f is p for p in pushed)]
+            return QueryPlan(pushed, residual, field)
+
+    return QueryPlan([], list(filters))
@@ -0,0 +1,75 @@
+#!/usr/bin/env python
+
+"""
+profiles.py -- Profile cache for ConferenceApi
+
+Profiles are looked up through three tiers: a per-request memo, a
+versioned memcache entry and finally the datastore. Reads made inside a
+transaction always go to the datastore, and every profile write drops
+the memcache entry once the write has committed.
+
+"""
+
+from google.appengine.api import memcache
+from google.appengine.ext import ndb
+
+from models import Profile
+
+import stats
+
+
+# bump when Profile changes shape so old pickles are never loaded
+PROFILE_CACHE_VERSION = 1
+MEMCACHE_PROFILE_KEY = 'PROFILE_v%d_%s'
+PROFILE_CACHE_TIME = 600
+# seconds a dropped entry refuses adds, longer than a cache miss takes
+PROFILE_LOCK_TIME = 5
+
+STAT_NAMES = ('profile.memo_hit', 'profile.memcache_hit', 'profile.miss')
+
+
+def _cacheKey(user_id):
+    return MEMCACHE_PROFILE_KEY % (PROFILE_CACHE_VERSION, user_id)
+
+
+def getProfile(user_id, memo):
+    """Return the Profile of user_id (or None), memoizing it in memo."""
+    if ndb.in_transaction():
+        # cached copies must not be written back in a transaction
+        return ndb.Key(Profile, user_id).get()
+
+    if user_id in memo:
+        stats.record('profile.memo_hit')
+        return memo[user_id]
+
+    profile = memcache.get(_cacheKey(user_id))
+    if profile is not None:
+        stats.record('profile.memcache_hit')
+    else:
+        stats.record('profile.miss')
+        profile = ndb.Key(Profile, user_id).get()
+        if profile:
+            # add, not set: putProfile locks the entry against adds for
+            # a moment, so a profile read before a write isn't put back
+            memcache.add(_cacheKey(user_id), profile, time=PROFILE_CACHE_TIME)
+    memo[user_id] = profile
+    return profile
+
+
+def putProfile(profile, memo):
+    """Write profile and invalidate its cached copies on commit."""
+    profile.put()
+    user_id = profile.key.id()
+
+    def invalidate():
+        memcache.delete(_cacheKey(user_id), seconds=PROFILE_LOCK_TIME)
+        memo[user_id] = profile
+    # runs immediately when not in a transaction
+    ndb.get_context().call_on_commit(invalidate)
+
+
+def dropCached(user_ids):
+    """Drop the cached copies of profiles written without putProfile,
+    eg. in bulk by a mapper."""
+    memcache.delete_multi([_cacheKey(user_id) for user_id in user_ids],
+        seconds=PROFILE_LOCK_TIME)
@@ -0,0 +1,72 @@
+#!/usr/bin/env python
+
+"""
+querycache.py -- result cache for queryConferences
+
+The home page sends the same few filter sets over and over. A page of
+results is cached as the list of conference keys plus the next page
+token, under a key made of the normalized filters and paging
+arguments; a hit is rehydrated with one get_multi. Every cached page
+also carries a global generation number which conference writes bump,
+so no page is served after a conference changed. Entries expire after
+a short TTL regardless.
+
+"""
+
+import hashlib
+
+from google.appengine.api import memcache
+from google.appengine.ext import ndb
+
+import stats
+from utils import bumpGenerations
+from utils import getGeneration
+
+
+MEMCACHE_GENERATION_KEY = 'QUERY_GENERATION'
+MEMCACHE_QUERY_KEY = 'QUERY_%s'
+QUERY_CACHE_TIME = 30
+
+STAT_NAMES = ('query.hit', 'query.miss')
+
+
+def invalidate():
+    """Drop all cached pages once the current transaction (if any)
+    has committed."""
+    # runs immediately when not in a transaction
+    ndb.get_context().call_on_commit(
+        lambda: bumpGenerations([MEMCACHE_GENERATION_KEY]))
+
+
+def cacheKey(filters, *args):
+    """Return the cache key of a page of results for typed filters
+    (as passed to planner.planConferenceQuery) and the paging
+    arguments args, or None if memcache is unavailable."""
+    generation = getGeneration(MEMCACHE_GENERATION_KEY)
+    if generation is None:
+        return None
+    normalized = sorted((f['field'], f['operator'], f['value'])
+        for f in filters)
+    return MEMCACHE_QUERY_KEY % hashlib.sha1(repr((generation, normalized,
+        args))).hexdigest()
+
+
+def get(key):
+    """Return the cached (conferences, next page token) of key or None."""
+    if key is None:
+        return None
+    cached = memcache.get(key)
+    if cached is None:
+        stats.record('query.miss')
+        return None
+    stats.record('query.hit')
+    keys, next_token = cached
+    # a conference may have been deleted since
+    return [conf for conf in ndb.get_multi(keys) if conf], next_token
+
+
+def put(key, conferences, next_token):
+    """Cache a page of conferences and its next page token under key."""
+    if key is not None:
+        memcache.set(key, ([conf.key for conf in conferences], next_token),
+            time=QUERY_CACHE_TIME)
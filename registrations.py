@@ -0,0 +1,81 @@
+#!/usr/bin/env python
+
+"""
+registrations.py -- conference registrations & session wishlists
+
+Profiles used to keep the conferences they attend and the sessions on
+their wishlist in two repeated KeyProperty lists: every change rewrote
+the whole profile and membership was a scan of the list. Each of them
+is now a small child entity of the Profile whose id is the websafe key
+of the conference (Registration) or session (WishlistEntry), so
+membership is a single get and keys-only ancestor queries list them.
+
+Profiles that still have the old lists are moved over by
+migrateProfile, lazily when they are loaded and in bulk by the
+migrate_profiles task.
+
+"""
+
+from google.appengine.ext import ndb
+
+from models import Registration
+from models import WishlistEntry
+
+import profiles
+
+
+def registrationKey(p_key, c_key):
+    """Return the key of the Registration of profile p_key for c_key."""
+    return ndb.Key(Registration, c_key.urlsafe(), parent=p_key)
+
+
+def wishlistKey(p_key, s_key):
+    """Return the key of the WishlistEntry of profile p_key for s_key."""
+    return ndb.Key(WishlistEntry, s_key.urlsafe(), parent=p_key)
+
+
+def _targets(kind, p_key):
+    """Return the keys named by the ids of p_key's children of kind."""
+    return [ndb.Key(urlsafe=key.id()) for key in
+        ndb.Query(kind=kind, ancestor=p_key).iter(keys_only=True)]
+
+
+def conferenceKeys(p_key):
+    """Return the keys of the conferences profile p_key attends."""
+    return _targets('Registration', p_key)
+
+
+def sessionKeys(p_key):
+    """Return the keys of the sessions on the wishlist of p_key."""
+    return _targets('WishlistEntry', p_key)
+
+
+def attendeesQuery(c_key):
+    """Return the query of the Registrations of c_key, ordered by key
+    for paging; their parents are the attending Profiles."""
+    return Registration.query(Registration.conference == c_key).order(
+        Registration.key)
+
+
+def hasLegacyLists(prof):
+    return bool(prof.conferenceKeysToAttend or prof.sessionKeysToAttend)
+
+
+@ndb.transactional()
+def migrateProfile(p_key, memo):
+    """Move the legacy lists of a Profile to Registration & WishlistEntry
+    entities; return the updated Profile. Only touches the profile's
+    entity group, so it can't race with a registration. memo is the
+    Profile memo of profiles.putProfile."""
+    prof = p_key.get()
+    if not prof or not hasLegacyLists(prof):
+        return prof
+    entities = [Registration(key=registrationKey(p_key, c_key),
+        conference=c_key) for c_key in prof.conferenceKeysToAttend]
+    entities += [WishlistEntry(key=wishlistKey(p_key, s_key),
+        session=s_key) for s_key in prof.sessionKeysToAttend]
+    prof.conferenceKeysToAttend = []
+    prof.sessionKeysToAttend = []
+    ndb.put_multi(entities)
+    profiles.putProfile(prof, memo)
+    return prof
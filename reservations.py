@@ -0,0 +1,126 @@
+#!/usr/bin/env python
+
+"""
+reservations.py -- queued registration for high-demand conferences
+
+Registration normally commits a cross-group transaction while the user
+waits. Conferences with queuedRegistration set take registrations in
+two steps instead:
+
+1. registerForConference takes a seat from a memcache allocator with a
+   single decr, writes a PENDING Reservation in the user's own entity
+   group and returns its websafe key as the reservation token.
+2. A worker task, scheduled at most once per conference every
+   COMMIT_DELAY seconds, commits the pending reservations of the
+   conference a batch at a time through the normal registration
+   transaction, marking them CONFIRMED or FAILED.
+
+The allocator only decides which requests are worth queueing; the seat
+shards stay the source of truth. It is rebuilt from the seats left
+minus the pending reservations whenever it is missing, expires after
+ALLOCATOR_TIME and is dropped after a failed reservation, so it never
+stays out of step with the datastore for long.
+
+"""
+
+import time
+
+from google.appengine.api import memcache
+from google.appengine.api import taskqueue
+from google.appengine.ext import ndb
+
+from models import Reservation
+
+import counters
+
+
+MEMCACHE_ALLOCATOR_KEY = 'RESERVABLE_%s'
+# memcache decr stops at zero, so the allocator holds seats + OFFSET
+# and a value below OFFSET means sold out
+ALLOCATOR_OFFSET = 1 << 32
+ALLOCATOR_TIME = 300
+COMMIT_BATCH_SIZE = 50
+COMMIT_DELAY = 2
+COMMIT_URL = '/tasks/commit_reservations'
+COMMIT_QUEUE = 'reservations'
+
+
+def reservationKey(p_key, c_key):
+    """Return the key of the Reservation of profile p_key for c_key."""
+    return ndb.Key(Reservation, c_key.urlsafe(), parent=p_key)
+
+
+def pendingQuery(c_key=None):
+    """Return the query of the pending reservations, oldest first, of
+    c_key or of all conferences."""
+    q = Reservation.query(Reservation.status == 'PENDING')
+    if c_key:
+        q = q.filter(Reservation.conference == c_key)
+    return q.order(Reservation.created)
+
+
+def _allocatorKey(c_key):
+    return MEMCACHE_ALLOCATOR_KEY % c_key.urlsafe()
+
+
+def _initAllocator(c_key):
+    """Add the allocator of c_key unless another request just did."""
+    seats = counters.getSeatsForKeys([c_key])[c_key]
+    pending = pendingQuery(c_key).count()
+    memcache.add(_allocatorKey(c_key),
+        ALLOCATOR_OFFSET + max(0, seats - pending), time=ALLOCATOR_TIME)
+
+
+def allocate(c_key):
+    """Take a seat of c_key from the allocator; return False when it
+    is sold out."""
+    key = _allocatorKey(c_key)
+    value = memcache.decr(key)
+    if value is None:
+        _initAllocator(c_key)
+        value = memcache.decr(key)
+        if value is None:
+            # memcache is unavailable, let the worker decide
+            return True
+    if value < ALLOCATOR_OFFSET:
+        memcache.incr(key)
+        return False
+    return True
+
+
+def release(c_key):
+    """Give a seat of c_key back to the allocator."""
+    memcache.incr(_allocatorKey(c_key))
+
+
+def resync(c_key):
+    """Drop the allocator of c_key, the next reservation rebuilds it."""
+    memcache.delete(_allocatorKey(c_key))
+
+
+@ndb.transactional()
+def reserve(p_key, c_key):
+    """Write a pending Reservation of p_key for c_key; return it, or
+    None if one is already pending."""
+    res_key = reservationKey(p_key, c_key)
+    reservation = res_key.get()
+    if reservation and reservation.status == 'PENDING':
+        return None
+    reservation = Reservation(key=res_key, conference=c_key)
+    reservation.put()
+    return reservation
+
+
+def scheduleCommit(c_key):
+    """Make sure a worker commits the pending reservations of c_key
+    within about COMMIT_DELAY seconds."""
+    # one named task per conference and time slot collects the
+    # reservations made meanwhile
+    slot = int(time.time()) // COMMIT_DELAY
+    try:
+        taskqueue.add(url=COMMIT_URL, queue_name=COMMIT_QUEUE,
+            countdown=COMMIT_DELAY,
+            name='reservations-%s-%d' % (c_key.urlsafe(), slot),
+            params={'websafeConferenceKey': c_key.urlsafe()})
+    except (taskqueue.TaskAlreadyExistsError, taskqueue.TombstonedTaskError):
+        pass
@@ -0,0 +1,65 @@
+#!/usr/bin/env python
+
+"""
+responses.py -- versioned response cache for public GET endpoints
+
+Responses are stored in memcache as encoded messages under a key made
+of the endpoint, the request and the current generation number of the
+conference they were built from. Writes to a conference bump its
+generation once they have committed, so all of its cached responses
+are invalidated with a single memcache.incr and old entries simply age
+out.
+
+"""
+
+import hashlib
+
+from google.appengine.api import memcache
+from google.appengine.ext import ndb
+from protorpc import protobuf
+
+import stats
+from utils import bumpGenerations
+from utils import getGeneration
+
+
+MEMCACHE_GENERATION_KEY = 'GENERATION_%s'
+MEMCACHE_RESPONSE_KEY = 'RESPONSE_%s'
+RESPONSE_CACHE_TIME = 600
+
+STAT_NAMES = ('response.hit', 'response.miss')
+
+
+def _generationKey(conf_key):
+    return MEMCACHE_GENERATION_KEY % conf_key.urlsafe()
+
+
+def bump(*conf_keys):
+    """Invalidate the cached responses of the given conferences once
+    the current transaction (if any) has committed."""
+    if conf_keys:
+        # runs immediately when not in a transaction
+        ndb.get_context().call_on_commit(lambda: bumpGenerations(
+            [_generationKey(conf_key) for conf_key in conf_keys]))
+
+
+def getResponse(endpoint, conf_key, request, response_class, build):
+    """Return the cached response of endpoint for request, calling
+    build() and caching its result on a miss."""
+    generation = getGeneration(_generationKey(conf_key))
+    if generation is None:
+        # memcache is unavailable
+        return build()
+    key = MEMCACHE_RESPONSE_KEY % hashlib.sha1('%s|%s|%d|%s' % (endpoint,
+        conf_key.urlsafe(), generation,
+        protobuf.encode_message(request))).hexdigest()
+
+    cached = memcache.get(key)
+    if cached is not None:
+        stats.record('response.hit')
+        return protobuf.decode_message(response_class, cached)
+    stats.record('response.miss')
+    response = build()
+    memcache.set(key, protobuf.encode_message(response),
+        time=RESPONSE_CACHE_TIME)
+    return response
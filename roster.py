@@ -0,0 +1,153 @@
+#!/usr/bin/env python
+
+"""
+roster.py -- per-conference attendee rosters
+
+Listing the attendees of a conference used to mean querying profiles by
+the conferences they attend. Every conference now has a roster of
+[user id, display name] pairs, spread over ROSTER_SHARDS root-level
+RosterShard entity groups like the seat counter. A registration appends
+to the last RosterChunk of a random shard and starts a new chunk once
+that one holds CHUNK_SIZE attendees; its Registration remembers the
+chunk so unregistering only rewrites that chunk.
+
+Pages of the roster are read by walking the chunks in key order, and
+the number of attendees is the sum of the shard counts. Neither touches
+Profile entities. Names are the display names at registration time.
+
+"""
+
+import random
+
+from google.appengine.datastore.datastore_query import Cursor
+from google.appengine.ext import ndb
+
+from models import Registration
+from models import RosterChunk
+from models import RosterShard
+
+
+ROSTER_SHARDS = 5
+CHUNK_SIZE = 500
+
+
+def _shardKeys(c_key):
+    return [ndb.Key(RosterShard, '%s-%d' % (c_key.urlsafe(), i))
+        for i in range(ROSTER_SHARDS)]
+
+
+def _chunkKey(shard_key, n):
+    return ndb.Key(RosterChunk, n, parent=shard_key)
+
+
+def _chunkQuery(c_key):
+    return RosterChunk.query(RosterChunk.conference == c_key).order(
+        RosterChunk.key)
+
+
+def _append(shard, entries):
+    """Append [user id, name] entries to the chunks of shard; return
+    the entities to put and the chunk key of every entry."""
+    chunk = None
+    if shard.numChunks:
+        chunk = _chunkKey(shard.key, shard.numChunks).get()
+    chunks = [chunk] if chunk else []
+    chunk_keys = []
+    for entry in entries:
+        if not chunk or len(chunk.attendees) >= CHUNK_SIZE:
+            shard.numChunks += 1
+            chunk = RosterChunk(key=_chunkKey(shard.key, shard.numChunks),
+                conference=shard.conference, attendees=[])
+            chunks.append(chunk)
+        # copy, JsonProperty values are not change tracked
+        chunk.attendees = chunk.attendees + [entry]
+        chunk_keys.append(chunk.key)
+    shard.count += len(entries)
+    return [shard] + chunks, chunk_keys
+
+
+@ndb.transactional(xg=True)
+def add(c_key, user_id, display_name):
+    """Add an attendee to the roster of c_key; return the key of the
+    chunk holding them."""
+    shard_key = random.choice(_shardKeys(c_key))
+    shard = shard_key.get() or RosterShard(key=shard_key, conference=c_key)
+    entities, chunk_keys = _append(shard, [[user_id, display_name]])
+    ndb.put_multi(entities)
+    return chunk_keys[0]
+
+
+@ndb.transactional(xg=True)
+def remove(chunk_key, user_id):
+    """Remove an attendee from the roster chunk chunk_key."""
+    chunk, shard = ndb.get_multi([chunk_key, chunk_key.parent()])
+    if not chunk:
+        return
+    attendees = [entry for entry in chunk.attendees if entry[0] != user_id]
+    if len(attendees) == len(chunk.attendees):
+        return
+    shard.count -= len(chunk.attendees) - len(attendees)
+    chunk.attendees = attendees
+    ndb.put_multi([chunk, shard])
+
+
+def getCount(c_key):
+    """Return the number of attendees of c_key."""
+    return sum(shard.count for shard in ndb.get_multi(_shardKeys(c_key))
+        if shard)
+
+
+def getPage(c_key, page_size, token=None):
+    """Return ([user id, name] entries, next page token) of one page of
+    the roster of c_key. Raises ValueError for an invalid token."""
+    offset, cursor = 0, None
+    if token:
+        offset, _, websafe = token.partition(':')
+        try:
+            offset = int(offset)
+            cursor = Cursor(urlsafe=websafe) if websafe else None
+        except Exception:
+            raise ValueError('Invalid page token: %s' % token)
+
+    it = _chunkQuery(c_key).iter(start_cursor=cursor, produce_cursors=True)
+    entries = []
+    while it.has_next():
+        chunk = it.next()
+        wanted = page_size - len(entries)
+        rest = chunk.attendees[offset:]
+        entries.extend(rest[:wanted])
+        if len(rest) > wanted:
+            # continue within this chunk
+            before = it.cursor_before()
+            return entries, '%d:%s' % (offset + wanted,
+                before.urlsafe() if before else '')
+        offset = 0
+        if len(entries) == page_size:
+            return entries, ('0:%s' % it.cursor_after().urlsafe()
+                if it.has_next() else None)
+    return entries, None
+
+
+def rebuild(c_key):
+    """Rebuild the roster of c_key from its registrations, eg. for
+    registrations migrated from profiles; not safe to run while
+    attendees register."""
+    registrations = Registration.query(Registration.conference == c_key) \
+        .order(Registration.key).fetch()
+    profs = ndb.get_multi([reg.key.parent() for reg in registrations])
+
+    old = _chunkQuery(c_key).fetch(keys_only=True)
+    ndb.delete_multi(old + _shardKeys(c_key))
+
+    shards = [RosterShard(key=shard_key, conference=c_key)
+        for shard_key in _shardKeys(c_key)]
+    entities = []
+    for i, shard in enumerate(shards):
+        regs = registrations[i::ROSTER_SHARDS]
+        shard_entities, chunk_keys = _append(shard, [[reg.key.parent().id(),
+            getattr(prof, 'displayName', None)] for reg, prof in
+            zip(regs, profs[i::ROSTER_SHARDS])])
+        for reg, chunk_key in zip(regs, chunk_keys):
+            reg.rosterChunk = chunk_key
+        entities += shard_entities + regs
+    ndb.put_multi(entities)
@@ -0,0 +1,207 @@
+#!/usr/bin/env python
+
+"""
+search.py -- full-text search over conferences and sessions
+
+A small inverted index kept in the datastore. Text is split into
+lower-case words, stop words are dropped and the rest is stemmed with
+a light suffix-stripping stemmer (Porter step 1 style). For every
+(kind, term) the postings -- websafe document key -> term frequency --
+are spread over POSTING_SHARDS SearchPosting entities by document, so
+no entity grows past the size limit and concurrent updates rarely
+touch the same one. A SearchDocument per indexed entity remembers its
+term frequencies, so reindexing only rewrites the postings of terms
+that changed.
+
+A document's postings of all its terms are in the same shard number,
+so a search intersects the query terms shard by shard: it reads the
+shards of every term SHARD_BATCH_SIZE shard numbers at a time with one
+get_multi, keeps the documents that contain all terms and stops once it
+has MAX_CANDIDATES of them. Only those candidates are ranked, by their
+summed term frequencies, so common words cost a fraction of the index
+and results past MAX_CANDIDATES are not paged through.
+
+"""
+
+import heapq
+import re
+import unicodedata
+import zlib
+
+from google.appengine.ext import ndb
+
+from models import SearchDocument
+from models import SearchPosting
+
+
+POSTING_SHARDS = 32
+# shard numbers read per get_multi of a search
+SHARD_BATCH_SIZE = 8
+# matching documents after which a search stops reading postings
+MAX_CANDIDATES = 1000
+# concurrent posting transactions of one indexDocuments call
+MAX_CONCURRENT_UPDATES = 50
+
+# indexed text properties per kind
+SEARCH_FIELDS = {
+    'Conference': ('name', 'description', 'topics', 'city'),
+    'Session': ('name', 'highlights'),
+}
+
+STOP_WORDS = frozenset('''a about an and are as at be by for from has have
+    how in into is it its of on or that the their this to was what when
+    where which who will with'''.split())
+
+_WORD_RE = re.compile(r'\w+', re.UNICODE)
+_VOWEL_RE = re.compile(r'[aeiouy]')
+
+
+def _stem(word):
+    """Strip plural and -ed/-ing/-ly endings."""
+    if word.endswith('sses'):
+        word = word[:-2]
+    elif word.endswith('ies') and len(word) > 4:
+        word = word[:-3] + 'y'
+    elif word.endswith('s') and not word.endswith(('ss', 'us', 'is')):
+        word = word[:-1]
+    if word.endswith('eed'):
+        return word
+    for suffix in ('ingly', 'edly', 'ing', 'ed', 'ly'):
+        stem = word[:-len(suffix)]
+        if word.endswith(suffix) and len(stem) > 2 and _VOWEL_RE.search(stem):
+            # "running" -> "run"
+            if len(stem) > 3 and stem[-1] == stem[-2] and \
+                    stem[-1] not in 'lsz':
+                stem = stem[:-1]
+            return stem
+    return word
+
+
+def tokenize(text):
+    """Return the stemmed terms of text, stop words removed."""
+    if isinstance(text, str):
+        text = text.decode('utf-8')
+    text = u''.join(c for c in unicodedata.normalize('NFKD', text.lower())
+        if not unicodedata.combining(c))
+    return [_stem(word) for word in _WORD_RE.findall(text)
+        if len(word) > 1 and word not in STOP_WORDS]
+
+
+def _documentTerms(entity):
+    """Return the term -> frequency dict of entity's text fields."""
+    terms = {}
+    for field in SEARCH_FIELDS[entity.key.kind()]:
+        values = getattr(entity, field, None) or []
+        if not isinstance(values, list):
+            values = [values]
+        for value in values:
+            for term in tokenize(value):
+                terms[term] = terms.get(term, 0) + 1
+    return terms
+
+
+def _postingKey(kind, term, doc_id):
+    shard = zlib.crc32(doc_id) % POSTING_SHARDS
+    return _shardKey(kind, term, shard)
+
+
+def _shardKey(kind, term, shard):
+    return ndb.Key(SearchPosting,
+        '%s:%s:%d' % (kind, term.encode('utf-8'), shard))
+
+
+@ndb.transactional_tasklet
+def _updatePosting(p_key, changes):
+    posting = yield p_key.get_async()
+    postings = dict(posting.postings) if posting else {}
+    for doc_id, tf in changes.items():
+        if tf:
+            postings[doc_id] = tf
+        else:
+            postings.pop(doc_id, None)
+    if postings:
+        yield SearchPosting(key=p_key, postings=postings).put_async()
+    elif posting:
+        yield p_key.delete_async()
+
+
+def indexDocuments(entities):
+    """Add or update the postings of Conference/Session entities."""
+    doc_keys = [ndb.Key(SearchDocument, entity.key.urlsafe())
+        for entity in entities]
+    changes = {}
+    docs = []
+    for entity, doc_key, old in zip(entities, doc_keys,
+            ndb.get_multi(doc_keys)):
+        doc_id = doc_key.id()
+        old_terms = old and old.terms or {}
+        new_terms = _documentTerms(entity)
+        for term in set(old_terms) | set(new_terms):
+            if old_terms.get(term) != new_terms.get(term):
+                changes.setdefault(_postingKey(entity.key.kind(), term,
+                    doc_id), {})[doc_id] = new_terms.get(term, 0)
+        if not old or old_terms != new_terms:
+            docs.append(SearchDocument(key=doc_key, terms=new_terms))
+
+    items = changes.items()
+    for i in range(0, len(items), MAX_CONCURRENT_UPDATES):
+        futures = [_updatePosting(p_key, doc_changes) for p_key, doc_changes
+            in items[i:i + MAX_CONCURRENT_UPDATES]]
+        ndb.Future.wait_all(futures)
+        for future in futures:
+            future.check_success()
+    ndb.put_multi(docs)
+
+
+def buildIndex(entities):
+    """Write the index of entities in bulk, replacing existing postings
+    of their terms; only for an initial build of an empty index."""
+    postings = {}
+    docs = []
+    for entity in entities:
+        doc_id = entity.key.urlsafe()
+        terms = _documentTerms(entity)
+        for term, tf in terms.items():
+            postings.setdefault(_postingKey(entity.key.kind(), term,
+                doc_id), {})[doc_id] = tf
+        docs.append(SearchDocument(id=doc_id, terms=terms))
+    ndb.put_multi([SearchPosting(key=p_key, postings=doc_tfs)
+        for p_key, doc_tfs in postings.items()] + docs)
+
+
+def search(kind, query, page_size, offset=0):
+    """Return (entities, next offset or None) of one page of the kind
+    entities matching all terms of query, best match first."""
+    terms = sorted(set(tokenize(query)))
+    if not terms:
+        return [], None
+    scores = {}
+    # the same shard numbers are read whatever the page, so every page
+    # ranks the same candidates
+    for first in range(0, POSTING_SHARDS, SHARD_BATCH_SIZE):
+        shard_nums = range(first, min(first + SHARD_BATCH_SIZE,
+            POSTING_SHARDS))
+        postings = ndb.get_multi([_shardKey(kind, term, shard)
+            for shard in shard_nums for term in terms])
+        for i in range(len(shard_nums)):
+            per_term = [posting.postings if posting else {} for posting
+                in postings[i * len(terms):(i + 1) * len(terms)]]
+            # intersect starting with the rarest term
+            per_term.sort(key=len)
+            for doc_id, tf in per_term[0].items():
+                if all(doc_id in other for other in per_term[1:]):
+                    scores[doc_id] = tf + sum(other[doc_id]
+                        for other in per_term[1:])
+        if len(scores) >= MAX_CANDIDATES:
+            break
+
+    candidates = min(len(scores), MAX_CANDIDATES)
+    end = min(offset + page_size, candidates)
+    page = heapq.nsmallest(end, scores.items(),
+        key=lambda item: (-item[1], item[0]))[offset:]
+    entities = [entity for entity in ndb.get_multi(
+        [ndb.Key(urlsafe=doc_id) for doc_id, score in page]) if entity]
+    next_offset = None
+    if end < candidates:
+        next_offset = end
+    return entities, next_offset
@@ -0,0 +1,144 @@
+#!/usr/bin/env python
+
+"""
+speakers.py -- per-conference speaker index and featured speakers
+
+Each conference keeps one SpeakerIndex entity (in its own entity group)
+mapping canonical speaker name -> names of their sessions. It is updated in the same
+transaction that stores a new session, so the featured speaker of a
+conference is always one get away, with memcache in front of it.
+
+Across conferences, every speaker has a Speaker entity keyed by the
+canonical form of their name, so spelling variants such as "Dr. Jane
+Doe" and "dr jane  doe" are the same speaker. It keeps the keys of all
+of their sessions, so listing them is a get plus a get_multi.
+
+"""
+
+import unicodedata
+
+from google.appengine.api import memcache
+from google.appengine.ext import ndb
+
+from models import Session
+from models import Speaker
+from models import SpeakerIndex
+
+
+MEMCACHE_FEATURED_SPEAKER_KEY = 'FEATURED_SPEAKER_%s'
+
+
+def _indexKey(c_key):
+    return ndb.Key(SpeakerIndex, 'speakers', parent=c_key)
+
+
+def _cacheKey(c_key):
+    return MEMCACHE_FEATURED_SPEAKER_KEY % c_key.urlsafe()
+
+
+def _featuredMessage(index):
+    """Return the featured speaker announcement of index, or ''."""
+    if not index or not index.featuredSpeaker:
+        return ''
+    return '%s %s %s' % (
+        'The following sessions '
+        'feature the main speaker',
+        index.featuredSpeaker + ':',
+        ', '.join(sorted(index.sessions.get(
+            canonicalName(index.featuredSpeaker), []))))
+
+
+def _count(index, speaker, session_name):
+    """Add a session of speaker to index under the canonical name, the
+    key of the Speaker entity, so spelling variants count together."""
+    canonical = canonicalName(speaker)
+    if not canonical:
+        return
+    names = index.sessions.setdefault(canonical, [])
+    names.append(session_name)
+    # the latest speaker with more than one session is featured
+    if len(names) > 1:
+        index.featuredSpeaker = speaker
+
+
+def addSessions(c_key, new_sessions):
+    """Count new (speaker, session name) pairs in the index of
+    conference c_key; call in the transaction that stores the sessions."""
+    if not new_sessions:
+        return
+    index = _indexKey(c_key).get() or SpeakerIndex(key=_indexKey(c_key))
+    index.sessions = index.sessions or {}
+    for speaker, session_name in new_sessions:
+        _count(index, speaker, session_name)
+    index.put()
+    ndb.get_context().call_on_commit(
+        lambda: memcache.set(_cacheKey(c_key), _featuredMessage(index)))
+
+
+def getFeaturedSpeaker(c_key):
+    """Return the featured speaker announcement of conference c_key."""
+    featured = memcache.get(_cacheKey(c_key))
+    if featured is None:
+        # evicted; the index is durable, so fall back to it
+        featured = _featuredMessage(_indexKey(c_key).get())
+        memcache.set(_cacheKey(c_key), featured)
+    return featured
+
+
+def rebuild(c_key, ignore_speaker=None):
+    """Rebuild the index of conference c_key from its sessions."""
+    index = SpeakerIndex(key=_indexKey(c_key), sessions={})
+    for sess in Session.query(ancestor=c_key).order(Session.key):
+        if sess.speaker and sess.speaker != ignore_speaker:
+            _count(index, sess.speaker, sess.name)
+    index.put()
+    memcache.delete(_cacheKey(c_key))
+
+
+def canonicalName(name):
+    """Return the canonical form of a speaker name: lower case, without
+    accents or punctuation, single spaces; None for an empty name."""
+    if not name:
+        return None
+    if isinstance(name, str):
+        name = name.decode('utf-8')
+    name = unicodedata.normalize('NFKD', name.lower())
+    name = u''.join(c if c.isalnum() else u' ' for c in name
+        if not unicodedata.combining(c))
+    return u' '.join(name.split()) or None
+
+
+def speakerKey(name):
+    """Return the Speaker key of name, or None for an empty name."""
+    canonical = canonicalName(name)
+    return canonical and ndb.Key(Speaker, canonical)
+
+
+@ndb.transactional()
+def _link(s_key, name, session_keys):
+    speaker = s_key.get() or Speaker(key=s_key, name=name)
+    known = set(speaker.sessionKeys)
+    new = [key for key in session_keys if key not in known]
+    if new:
+        speaker.sessionKeys.extend(new)
+        speaker.put()
+
+
+def linkSessions(sessions):
+    """Add (speaker name, session key) pairs to the session lists of
+    their Speakers, creating new speakers; one transaction per speaker."""
+    by_speaker = {}
+    for name, sess_key in sessions:
+        s_key = speakerKey(name)
+        if s_key:
+            by_speaker.setdefault(s_key, (name, []))[1].append(sess_key)
+    for s_key, (name, session_keys) in by_speaker.items():
+        _link(s_key, name, session_keys)
+
+
+def getSessionKeys(name):
+    """Return the session keys of the speaker called name (in any
+    spelling), oldest first."""
+    s_key = speakerKey(name)
+    speaker = s_key and s_key.get()
+    return speaker.sessionKeys if speaker else []
@@ -0,0 +1,57 @@
+#!/usr/bin/env python
+
+"""
+stats.py -- cheap hit/miss counters kept in memcache
+
+Counts are accumulated in-process and flushed to memcache in one
+offset_multi call every FLUSH_EVERY records, so recording a hit does
+not cost an RPC.
+
+"""
+
+import threading
+
+from google.appengine.api import memcache
+
+
+MEMCACHE_STATS_KEY = 'STATS_%s'
+FLUSH_EVERY = 50
+
+_pending = {}
+_records = [0]
+_lock = threading.Lock()
+
+
+def record(name, delta=1):
+    """Add delta to counter name."""
+    recordMulti({name: delta})
+
+
+def recordMulti(deltas):
+    """Add a dict of counter name -> delta as one record."""
+    with _lock:
+        for name, delta in deltas.items():
+            _pending[name] = _pending.get(name, 0) + delta
+        _records[0] += 1
+        full = _records[0] >= FLUSH_EVERY
+    if full:
+        flush()
+
+
+def flush():
+    """Write pending counts to memcache."""
+    with _lock:
+        pending = dict(_pending)
+        _pending.clear()
+        _records[0] = 0
+    if pending:
+        memcache.offset_multi(dict((MEMCACHE_STATS_KEY % name, delta)
+            for name, delta in pending.items()), initial_value=0)
+
+
+def getStats(names):
+    """Return a dict of counter name -> value."""
+    flush()
+    values = memcache.get_multi([MEMCACHE_STATS_KEY % name for name in names])
+    return dict((name, values.get(MEMCACHE_STATS_KEY % name, 0))
+        for name in names)
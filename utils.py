@@ -1,11 +1,143 @@
+import hashlib
 import json
 import os
+import threading
 import time
 import uuid
+from collections import OrderedDict
 
+from google.appengine.api import memcache
 from google.appengine.api import urlfetch
 from models import Profile
 
+# point this at a local stub responder when testing
+TOKENINFO_URL = os.getenv('TOKENINFO_URL',
+    'https://www.googleapis.com/oauth2/v1/tokeninfo')
+TOKENINFO_DEADLINE = 5
+TOKENINFO_ATTEMPTS = 2
+TOKEN_CACHE_SIZE = 1000
+MEMCACHE_TOKEN_KEY = 'TOKEN_%s'
+
+
+class _TokenCache(object):
+    """In-process LRU of token hash -> (user_id, expires_at)."""
+
+    def __init__(self, size):
+        self.size = size
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if not entry or entry[1] <= time.time():
+                return None
+            # re-insert as most recently used
+            self._entries[key] = entry
+            return entry[0]
+
+    def set(self, key, user_id, expires_at):
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = (user_id, expires_at)
+            while len(self._entries) > self.size:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+_token_cache = _TokenCache(TOKEN_CACHE_SIZE)
+
+
+def _now():
+    return int(time.time() * 1000)
+
+
+def getGeneration(key):
+    """Return the generation number stored under memcache key, starting
+    one if there is none; None if memcache is unavailable.
+
+    A generation is started at the current time in milliseconds, so one
+    that was evicted never comes back at a value that old entries were
+    cached under."""
+    generation = memcache.get(key)
+    if generation is None:
+        memcache.add(key, _now())
+        generation = memcache.get(key)
+    return generation
+
+
+def bumpGenerations(keys):
+    """Advance the generation numbers stored under memcache keys."""
+    memcache.offset_multi(dict((key, 1) for key in keys),
+        initial_value=_now())
+
+
+def clearTokenCache():
+    """Drop all in-process token lookups (memcache entries expire
+    with their tokens)."""
+    _token_cache.clear()
+
+
+def _fetchTokenInfo(token, token_type):
+    """Look token up at the tokeninfo endpoint, return its info dict.
+
+    The given token type and the access_token fallback are requested
+    concurrently through async urlfetch RPCs; failed lookups are
+    retried straight away instead of sleeping on the request thread."""
+    token_types = [token_type]
+    if token_type != 'access_token':
+        token_types.append('access_token')
+
+    for i in range(TOKENINFO_ATTEMPTS):
+        rpcs = []
+        for t_type in token_types:
+            rpc = urlfetch.create_rpc(deadline=TOKENINFO_DEADLINE)
+            urlfetch.make_fetch_call(rpc, '%s?%s=%s'
+                % (TOKENINFO_URL, t_type, token))
+            rpcs.append(rpc)
+
+        retry = False
+        for rpc in rpcs:
+            try:
+                resp = rpc.get_result()
+            except urlfetch.Error:
+                retry = True
+                continue
+            if resp.status_code == 200:
+                return json.loads(resp.content)
+            # a 400 is a definite answer for that token type
+            if resp.status_code != 400:
+                retry = True
+        if not retry:
+            break
+    return {}
+
+
+def _resolveToken(token, token_type):
+    """Return the user_id of an OAuth token, cached until it expires."""
+    token_hash = hashlib.sha1(token).hexdigest()
+    user_id = _token_cache.get(token_hash)
+    if user_id:
+        return user_id
+
+    cached = memcache.get(MEMCACHE_TOKEN_KEY % token_hash)
+    if cached and cached[1] > time.time():
+        _token_cache.set(token_hash, *cached)
+        return cached[0]
+
+    info = _fetchTokenInfo(token, token_type)
+    user_id = info.get('user_id', '')
+    expires_in = int(info.get('expires_in', 0))
+    if user_id and expires_in > 0:
+        expires_at = time.time() + expires_in
+        _token_cache.set(token_hash, user_id, expires_at)
+        memcache.set(MEMCACHE_TOKEN_KEY % token_hash, (user_id, expires_at),
+            time=expires_in)
+    return user_id
+
+
 def getUserId(user, id_type="email"):
     if id_type == "email":
         return user.email()
@@ -17,22 +149,7 @@ def getUserId(user, id_type="email"):
         token_type = 'id_token'
         if 'OAUTH_USER_ID' in os.environ:
             token_type = 'access_token'
-        url = ('https://www.googleapis.com/oauth2/v1/tokeninfo?%s=%s'
-               % (token_type, token))
-        user = {}
-        wait = 1
-        for i in range(3):
-            resp = urlfetch.fetch(url)
-            if resp.status_code == 200:
-                user = json.loads(resp.content)
-                break
-            elif resp.status_code == 400 and 'invalid_token' in resp.content:
-                url = ('https://www.googleapis.com/oauth2/v1/tokeninfo?%s=%s'
-                       % ('access_token', token))
-            else:
-                time.sleep(wait)
-                wait = wait + i
-        return user.get('user_id', '')
+        return _resolveToken(token, token_type)
 
     if id_type == "custom":
         # implement your own user_id creation and getting algorythm